@@ -1,7 +1,15 @@
-from WordEmbedding import WordEmbedding
 from VectorUtils import add_vectors
-import json
-import codecs
+from EmbeddingMatrix import EmbeddingMatrix
+from SimilarityIndex import ExactIndex, QuantizedIndex
+from QuantizedEmbeddingMatrix import QuantizedEmbeddingMatrix
+from LSHIndex import LSHIndex
+from PQIndex import PQIndex
+from random import Random
+import VectorUtils
+import EmbeddingIO
+import Instrumentation
+import numpy as np
+import time
 
 
 class DocEmbedding:
@@ -14,21 +22,26 @@ class DocEmbedding:
     particularly sensitive to the 'word_blacklist' argument in doc_embedding trainer
     """
 
-    def __init__(self, doc_embedding_object=None, doc_embedding_file=None):
+    def __init__(self, doc_embedding_object=None, doc_embedding_file=None, embedding_store='dict'):
         """
         if doc_embedding_object is not None, doc_embedding_file is ignored.
-        :param doc_embedding_object:
-        :param doc_embedding_file:
+        :param doc_embedding_object: a dict, an EmbeddingMatrix or a ShardedEmbeddingStore (for embeddings that do
+        not fit in memory)
+        :param doc_embedding_file: either a json lines file, or a binary file (see write_embeddings_to_binary_file),
+        which is memory-mapped rather than read into memory.
+        :param embedding_store: only used when reading from a json lines doc_embedding_file. If 'matrix', the vectors
+        are stored in a (float32) EmbeddingMatrix rather than a dict of lists, which takes a fraction of the memory.
+        If 'quantized', they are stored in an (int8) QuantizedEmbeddingMatrix, which takes a quarter of that.
         """
         self._doc_embedding_dict = dict()
+        self._exact_index = None
+        self._lsh_index = None
+        self._pq_index = None
         if doc_embedding_object:
             self._doc_embedding_dict = doc_embedding_object
         elif doc_embedding_file:
-            with codecs.open(doc_embedding_file, 'r', 'utf-8') as f:
-                for line in f:
-                    obj = json.loads(line)
-                    for k, v in obj.items():
-                        self._doc_embedding_dict[k] = v
+            with Instrumentation.timer('DocEmbedding.load'):
+                self._doc_embedding_dict = EmbeddingIO.read_embeddings(doc_embedding_file, embedding_store)
         else:
             raise Exception('Expected either a doc embeddings file or a doc embeddings object!')
 
@@ -38,22 +51,76 @@ class DocEmbedding:
         :param output_file:
         :return: None
         """
-        out = codecs.open(output_file, 'w', 'utf-8')
-        for k, v in self._doc_embedding_dict.items():
-            answer = dict()
-            answer[k] = v
-            json.dump(answer, out)
-            out.write('\n')
-        out.close()
+        with Instrumentation.timer('DocEmbedding.write'):
+            EmbeddingIO.write_jlines_embeddings(self._doc_embedding_dict, output_file)
 
-    def get_similar_docs(self, doc_ids, k=10, print_warning=True):
+    def write_embeddings_to_binary_file(self, output_file):
+        """
+        Writes the embeddings out in the binary format of EmbeddingIO, which loads much faster than json lines
+        and can be memory-mapped.
+        :param output_file:
+        :return: None
+        """
+        with Instrumentation.timer('DocEmbedding.write'):
+            EmbeddingIO.write_binary_embeddings(self._doc_embedding_dict, output_file)
+
+    def write_embeddings_to_quantized_file(self, output_file, dtype=np.int8):
+        """
+        Like write_embeddings_to_binary_file, but the vectors are quantized (see QuantizedEmbeddingMatrix) to a
+        quarter (int8) or half (int16) of the size. Read the file back in as usual; it is memory-mapped, and
+        searched with a QuantizedIndex.
+        :param output_file:
+        :param dtype: np.int8 (default) or np.int16
+        :return: None
+        """
+        embeddings = self._doc_embedding_dict
+        if not isinstance(embeddings, QuantizedEmbeddingMatrix):
+            embeddings = QuantizedEmbeddingMatrix.quantize(embeddings, dtype=dtype)
+        EmbeddingIO.write_binary_embeddings(embeddings, output_file)
+
+    def quantize(self, dtype=np.int8):
+        """
+        Replaces the embeddings by a QuantizedEmbeddingMatrix, to save memory. Similarity search then scores the
+        quantized vectors directly (see QuantizedIndex). Use measure_quantization_recall first, to see what
+        this costs in accuracy.
+        :param dtype: np.int8 (default) or np.int16
+        :return: None
+        """
+        if not isinstance(self._doc_embedding_dict, QuantizedEmbeddingMatrix):
+            self._doc_embedding_dict = QuantizedEmbeddingMatrix.quantize(self._doc_embedding_dict, dtype=dtype)
+            self._exact_index = None
+
+    def measure_quantization_recall(self, dtype=np.int8, k=10, sample_size=100, seed=0):
+        """
+        Measures recall@k of search over the quantized vectors against search over the (float) vectors, over a
+        random sample of queries. The embeddings themselves are not modified.
+        :param dtype: np.int8 (default) or np.int16
+        :param k:
+        :param sample_size: number of queries
+        :param seed: seed for sampling the queries
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        if isinstance(self._doc_embedding_dict, QuantizedEmbeddingMatrix):
+            raise Exception('The embeddings are already quantized; there are no float vectors to compare to.')
+        keys = list(self._doc_embedding_dict.keys())
+        sample = Random(seed).sample(keys, min(sample_size, len(keys)))
+        return QuantizedIndex(self._doc_embedding_dict, dtype=dtype).measure_recall(self.build_index(), sample, k=k)
+
+    def get_similar_docs(self, doc_ids, k=10, print_warning=True, approximate=False, rerank_size=0):
         """
 
         :param doc_ids: either a single doc_id or a list of doc_ids
         :param k: number of similar results to return
         :param print_warning: if True (by default), it will print out a warning if it does not find a docid
         in the embeddings dictionary. Disable at your own risk.
+        :param approximate: if True (or 'lsh'), use the LSH index (see build_lsh_index) instead of an exact scan.
+        This is much faster on big collections, but may miss some of the true k most similar docs. If 'pq', use
+        the (much smaller) product-quantization index instead (see build_pq_index).
+        :param rerank_size: only used with approximate='pq'. If greater than k, this many candidates are re-ranked
+        with the exact doc vectors.
         :return: A list of doc_ids
+
+        As in WordEmbedding.get_similar_words, all the doc_ids are scored together against a cached ExactIndex.
         """
         list_of_docids = list()
         if type(doc_ids) != list:
@@ -65,17 +132,69 @@ class DocEmbedding:
                 return None
         else:
             list_of_docids = doc_ids
-        results = dict()
+        present_docids = list()
         for docid in list_of_docids:
             if docid not in self._doc_embedding_dict:
                 if print_warning:
                     print 'Warning. Your docid ' + docid + ' is not in the embeddings dictionary. Skipping...'
                 continue
-            scored_dict = self._generate_scored_dict(docid)
-            results[docid] = WordEmbedding.extract_top_k(scored_dict, k=k)
+            present_docids.append(docid)
 
+        if approximate == 'pq':
+            if self._pq_index is None:
+                raise Exception('No PQ index found. Use build_pq_index or set_pq_index first.')
+            start = time.time()
+            results = dict()
+            for docid in present_docids:
+                results[docid] = self._pq_index.query(self._doc_embedding_dict[docid], k=k, exclude_key=docid,
+                                                      rerank_size=rerank_size, exact_vectors=self._doc_embedding_dict)
+            Instrumentation.add_time('DocEmbedding.pq_query', time.time() - start, calls=len(present_docids))
+            return results
+        elif approximate:
+            if self._lsh_index is None:
+                raise Exception('No LSH index found. Use build_lsh_index or set_lsh_index first.')
+            start = time.time()
+            results = dict()
+            for docid in present_docids:
+                results[docid] = self._lsh_index.query(self._doc_embedding_dict[docid], self._doc_embedding_dict, k=k,
+                                                       exclude_key=docid)
+            Instrumentation.add_time('DocEmbedding.lsh_query', time.time() - start, calls=len(present_docids))
+            return results
+        index = self.build_index()
+        start = time.time()
+        results = index.query_keys_batch(present_docids, k=k)
+        Instrumentation.add_time('DocEmbedding.query', time.time() - start, calls=len(present_docids))
         return results
 
+    def get_similar_docs_to_vectors(self, vectors, k=10):
+        """
+        Like get_similar_docs, but the queries are arbitrary vectors. All queries are scored together, in
+        memory-bounded blocks.
+        :param vectors: a list of vectors, or a 2-d numpy array with one query per row
+        :param k: number of similar results to return per query
+        :return: a list, with the i-th element holding the k most similar doc_ids to the i-th vector
+        """
+        index = self.build_index()
+        start = time.time()
+        results = index.query_vectors_batch(vectors, k=k)
+        Instrumentation.add_time('DocEmbedding.query', time.time() - start, calls=len(vectors))
+        return results
+
+    def build_index(self, rebuild=False):
+        """
+        Builds the (normalized, vectorized) index used by get_similar_docs, if it has not been built already.
+        Call with rebuild=True if you modified the embeddings after the index was built.
+        :param rebuild:
+        :return: the ExactIndex (a QuantizedIndex, if the embeddings are quantized)
+        """
+        if self._exact_index is None or rebuild:
+            with Instrumentation.timer('DocEmbedding.build_index'):
+                if isinstance(self._doc_embedding_dict, QuantizedEmbeddingMatrix):
+                    self._exact_index = QuantizedIndex(self._doc_embedding_dict)
+                else:
+                    self._exact_index = ExactIndex(self._doc_embedding_dict)
+        return self._exact_index
+
     def get_vector(self, doc_ids, print_warning=True):
         """
 
@@ -109,15 +228,96 @@ class DocEmbedding:
         else:
             return add_vectors(result)
 
-    def _generate_scored_dict(self, doc_id):
-        scored_dict = dict()
-        seed_vector = self._doc_embedding_dict[doc_id]
-        for token, vector in self._doc_embedding_dict.items():
-            if token == doc_id:
-                continue
-            else:
-                score = WordEmbedding.compute_abs_cosine_sim(seed_vector, vector)
-                if score not in scored_dict:
-                    scored_dict[score] = list()
-                scored_dict[score].append(token)
-        return scored_dict
\ No newline at end of file
+    def build_lsh_index(self, num_tables=8, num_bits=16, seed=0, output_file=None):
+        """
+        Builds an LSHIndex over all the doc vectors, to be used by get_similar_docs(..., approximate=True).
+        :param num_tables: see LSHIndex
+        :param num_bits: see LSHIndex
+        :param seed: see LSHIndex
+        :param output_file: if not None, the index is also written out to this file (see LSHIndex.load)
+        :return: the LSHIndex. You can add more docs to it incrementally with LSHIndex.add, as long as they are also
+        added to this object's doc vectors (the index only holds their codes, see LSHIndex).
+        """
+        keys = list(self._doc_embedding_dict.keys())
+        index = LSHIndex(len(self._doc_embedding_dict[keys[0]]), num_tables=num_tables, num_bits=num_bits, seed=seed)
+        batch_size = 10000
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            index.add_batch(batch, [self._doc_embedding_dict[key] for key in batch])
+        if output_file:
+            index.save(output_file)
+        self._lsh_index = index
+        return index
+
+    def set_lsh_index(self, lsh_index):
+        """
+        Use a previously built index e.g. LSHIndex.load(path)
+        :param lsh_index:
+        :return: None
+        """
+        self._lsh_index = lsh_index
+
+    def measure_lsh_recall(self, k=10, sample_size=100, seed=0):
+        """
+        Measures recall@k of the LSH index against exact search, over a random sample of doc_ids.
+        :param k:
+        :param sample_size: number of doc_ids to use as queries
+        :param seed: seed for sampling the doc_ids
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        if self._lsh_index is None:
+            raise Exception('No LSH index found. Use build_lsh_index or set_lsh_index first.')
+        keys = [key for key in self._doc_embedding_dict.keys() if key in self._lsh_index]
+        sample = Random(seed).sample(keys, min(sample_size, len(keys)))
+        return self._lsh_index.measure_recall(self.build_index(), sample, self._doc_embedding_dict, k=k)
+
+    def build_pq_index(self, num_subspaces=8, num_centroids=256, num_iterations=20, training_sample_size=100000,
+                       seed=0, output_file=None):
+        """
+        Builds a PQIndex over all the doc vectors, to be used by get_similar_docs(..., approximate='pq'). The
+        codebooks are trained on a random sample of the docs.
+        :param num_subspaces: see PQIndex
+        :param num_centroids: see PQIndex
+        :param num_iterations: see PQIndex.train
+        :param training_sample_size: the number of docs to train the codebooks on
+        :param seed: seed for sampling the training docs, and for k-means
+        :param output_file: if not None, the index is also written out to this file (see PQIndex.load)
+        :return: the PQIndex. You can add more docs to it incrementally with PQIndex.add.
+        """
+        keys = list(self._doc_embedding_dict.keys())
+        index = PQIndex(len(self._doc_embedding_dict[keys[0]]), num_subspaces=num_subspaces,
+                        num_centroids=num_centroids, seed=seed)
+        sample = Random(seed).sample(keys, min(training_sample_size, len(keys)))
+        index.train([self._doc_embedding_dict[key] for key in sample], num_iterations=num_iterations)
+        batch_size = 10000
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            index.add_batch(batch, [self._doc_embedding_dict[key] for key in batch])
+        if output_file:
+            index.save(output_file)
+        self._pq_index = index
+        return index
+
+    def set_pq_index(self, pq_index):
+        """
+        Use a previously built index e.g. PQIndex.load(path)
+        :param pq_index:
+        :return: None
+        """
+        self._pq_index = pq_index
+
+    def measure_pq_recall(self, k=10, sample_size=100, seed=0, rerank_size=0):
+        """
+        Measures recall@k of the PQ index against exact search, over a random sample of doc_ids.
+        :param k:
+        :param sample_size: number of doc_ids to use as queries
+        :param seed: seed for sampling the doc_ids
+        :param rerank_size: see get_similar_docs
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        if self._pq_index is None:
+            raise Exception('No PQ index found. Use build_pq_index or set_pq_index first.')
+        keys = [key for key in self._doc_embedding_dict.keys() if key in self._pq_index]
+        sample = Random(seed).sample(keys, min(sample_size, len(keys)))
+        return self._pq_index.measure_recall(self.build_index(), sample, k=k, rerank_size=rerank_size,
+                                             exact_vectors=self._doc_embedding_dict)
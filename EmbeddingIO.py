@@ -0,0 +1,313 @@
+# Use this module to read and write embedding objects (word or doc embeddings) from/to files. Two formats are
+# supported: json lines (one {key: vector} object per line, as written by the trainer) and a binary format that
+# can be memory-mapped.
+#
+# Binary format (all integers little-endian):
+#   bytes 0-63: header. 8-byte magic (FWEMBED1), uint32 dtype code, uint32 flags, uint64 number of rows,
+#               uint64 dimensions, uint64 offset of the vocabulary, uint64 size of the vocabulary in bytes,
+#               zero padding.
+#   bytes 64-:  the matrix, row-major, one row per key.
+#   scales:     only if flag 1 is set (quantized embeddings, see QuantizedEmbeddingMatrix): one float32 scale
+#               factor per row, right after the matrix.
+#   vocabulary: the utf-8 encoded keys, in row order, separated by newlines.
+# The vocabulary is at the end so that the file can be written incrementally, without knowing the keys
+# (or their number) up front.
+from EmbeddingMatrix import EmbeddingMatrix
+from QuantizedEmbeddingMatrix import QuantizedEmbeddingMatrix
+import VectorUtils
+import numpy as np
+import codecs
+import json
+import struct
+import tempfile
+import shutil
+
+_MAGIC = 'FWEMBED1'
+_HEADER_FORMAT = '<8sIIQQQQ'
+_HEADER_SIZE = 64
+_DTYPE_CODES = {1: np.dtype('<f4'), 2: np.dtype('<i4'), 3: np.dtype('i1'), 4: np.dtype('<i2')}
+_FLAG_SCALES = 1
+
+
+class BinaryEmbeddingWriter:
+    """
+    Writes vectors to a binary embeddings file one at a time (or one batch at a time), so that the whole
+    embedding never needs to be in memory. Keys are spilled to a temporary file until close is called.
+    """
+
+    def __init__(self, output_file, dimensions, dtype=np.float32, with_scales=False):
+        """
+
+        :param output_file:
+        :param dimensions:
+        :param dtype: np.float32 (default), np.int32, np.int16 or np.int8
+        :param with_scales: if True, every row comes with a scale factor (see add_batch), as for quantized
+        embeddings
+        """
+        self._dtype_code = _get_dtype_code(dtype)
+        self._scales_file = tempfile.TemporaryFile() if with_scales else None
+        self._dtype = _DTYPE_CODES[self._dtype_code]
+        self._dimensions = dimensions
+        self._num_rows = 0
+        self._out = open(output_file, 'wb')
+        self._out.write('\0' * _HEADER_SIZE)   # placeholder, see close
+        self._keys_file = tempfile.TemporaryFile()
+
+    def add(self, key, vector):
+        """
+        :param key: a word or doc-id. May not contain a newline.
+        :param vector:
+        :return: None
+        """
+        self.add_batch([key], [vector])
+
+    def add_batch(self, keys, vectors, scales=None):
+        """
+        :param keys: a list of keys
+        :param vectors: a list of vectors, or a 2-d numpy array with one row per key
+        :param scales: a scale factor per key. Required if (and only if) the writer was opened with_scales.
+        :return: None
+        """
+        matrix = np.asarray(vectors, dtype=self._dtype)
+        if matrix.shape != (len(keys), self._dimensions):
+            raise Exception('Expected ' + str(len(keys)) + ' vectors with ' + str(self._dimensions) + ' dimensions.')
+        if (scales is None) != (self._scales_file is None):
+            raise Exception('Scales must be given if and only if the writer was opened with_scales.')
+        if scales is not None:
+            self._scales_file.write(np.asarray(scales, dtype='<f4').tostring())
+        for key in keys:
+            if u'\n' in key:
+                raise Exception('Keys may not contain newlines: ' + repr(key))
+            if self._num_rows > 0:
+                self._keys_file.write('\n')
+            self._keys_file.write(key.encode('utf-8'))
+            self._num_rows += 1
+        self._out.write(np.ascontiguousarray(matrix).tostring())
+
+    def close(self):
+        """
+        Appends the vocabulary, writes the header and closes the file.
+        :return: None
+        """
+        flags = 0
+        if self._scales_file is not None:
+            self._scales_file.seek(0)
+            shutil.copyfileobj(self._scales_file, self._out)
+            self._scales_file.close()
+            flags |= _FLAG_SCALES
+        vocab_offset = self._out.tell()
+        vocab_size = self._keys_file.tell()
+        self._keys_file.seek(0)
+        shutil.copyfileobj(self._keys_file, self._out)
+        self._keys_file.close()
+        self._out.seek(0)
+        self._out.write(struct.pack(_HEADER_FORMAT, _MAGIC, self._dtype_code, flags, self._num_rows,
+                                    self._dimensions, vocab_offset, vocab_size))
+        self._out.close()
+
+
+class JlinesEmbeddingWriter:
+    """
+    Writes vectors to a json lines embeddings file one at a time. Same interface as BinaryEmbeddingWriter.
+    """
+
+    def __init__(self, output_file):
+        self._out = codecs.open(output_file, 'w', 'utf-8')
+
+    def add(self, key, vector):
+        answer = dict()
+        answer[key] = VectorUtils.to_list(vector)
+        json.dump(answer, self._out)
+        self._out.write('\n')
+
+    def add_batch(self, keys, vectors):
+        for i in range(0, len(keys)):
+            self.add(keys[i], vectors[i])
+
+    def close(self):
+        self._out.close()
+
+
+def open_embeddings_writer(output_file, dimensions, output_format='json'):
+    """
+    :param output_file:
+    :param dimensions: only used by the binary format
+    :param output_format: 'json' (json lines, default) or 'binary'
+    :return: a JlinesEmbeddingWriter or a BinaryEmbeddingWriter. Call add/add_batch, and finally close.
+    """
+    if output_format == 'json':
+        return JlinesEmbeddingWriter(output_file)
+    elif output_format == 'binary':
+        return BinaryEmbeddingWriter(output_file, dimensions)
+    else:
+        raise Exception('Unrecognized output format: ' + str(output_format))
+
+
+def write_binary_embeddings(embedding_object, output_file, dtype=np.float32):
+    """
+    :param embedding_object: a dict, an EmbeddingMatrix or a QuantizedEmbeddingMatrix (which is written out as
+    is, with its codes and scales; dtype is ignored)
+    :param output_file:
+    :param dtype: see BinaryEmbeddingWriter
+    :return: None
+    """
+    if isinstance(embedding_object, QuantizedEmbeddingMatrix):
+        writer = BinaryEmbeddingWriter(output_file, embedding_object.get_dimensions(),
+                                       dtype=embedding_object.get_codes().dtype, with_scales=True)
+        writer.add_batch(embedding_object.get_keys(), embedding_object.get_codes(), embedding_object.get_scales())
+    elif isinstance(embedding_object, EmbeddingMatrix):
+        writer = BinaryEmbeddingWriter(output_file, embedding_object.get_dimensions(), dtype=dtype)
+        writer.add_batch(embedding_object.get_keys(), embedding_object.get_matrix())
+    else:
+        keys = list(embedding_object.keys())
+        writer = BinaryEmbeddingWriter(output_file, len(embedding_object[keys[0]]) if keys else 0, dtype=dtype)
+        batch_size = 10000
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            writer.add_batch(batch, [embedding_object[key] for key in batch])
+    writer.close()
+
+
+def read_binary_embeddings(input_file, mmap=True):
+    """
+    :param input_file: a file written by write_binary_embeddings or BinaryEmbeddingWriter
+    :param mmap: if True (default), the matrix is memory-mapped (read-only) rather than read into memory. Loading
+    is then near-instant, and processes that map the same file share one copy in the page cache.
+    :return: an EmbeddingMatrix, or a QuantizedEmbeddingMatrix if the file holds quantized embeddings
+    """
+    with open(input_file, 'rb') as f:
+        magic, dtype_code, flags, num_rows, dimensions, vocab_offset, vocab_size = \
+            struct.unpack(_HEADER_FORMAT, f.read(struct.calcsize(_HEADER_FORMAT)))
+        if magic != _MAGIC:
+            raise Exception('Not a binary embeddings file: ' + input_file)
+        f.seek(vocab_offset)
+        vocab = f.read(vocab_size).decode('utf-8')
+        keys = vocab.split(u'\n') if num_rows > 0 else list()
+        dtype = _DTYPE_CODES[dtype_code]
+        if mmap and num_rows > 0:
+            matrix = np.memmap(input_file, dtype=dtype, mode='r', offset=_HEADER_SIZE, shape=(num_rows, dimensions))
+        else:
+            f.seek(_HEADER_SIZE)
+            matrix = np.fromstring(f.read(num_rows * dimensions * dtype.itemsize), dtype=dtype)
+            matrix = matrix.reshape((num_rows, dimensions))
+        if flags & _FLAG_SCALES:
+            f.seek(_HEADER_SIZE + num_rows * dimensions * dtype.itemsize)
+            scales = np.fromstring(f.read(num_rows * 4), dtype='<f4')
+            return QuantizedEmbeddingMatrix(keys, matrix, scales)
+    return EmbeddingMatrix.from_arrays(keys, matrix)
+
+
+def is_binary_embeddings_file(input_file):
+    """
+    :param input_file:
+    :return: True if input_file starts with the magic bytes of the binary format
+    """
+    with open(input_file, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def write_jlines_embeddings(embedding_object, output_file):
+    """
+    Writes out the embedding object in json lines format, one {key: vector} object per line.
+    :param embedding_object: a dict or an EmbeddingMatrix
+    :param output_file:
+    :return: None
+    """
+    writer = JlinesEmbeddingWriter(output_file)
+    for k, v in embedding_object.items():
+        writer.add(k, v)
+    writer.close()
+
+
+def read_embeddings(input_file, embedding_store='dict'):
+    """
+    Reads an embeddings file in either format (detected automatically).
+    :param input_file:
+    :param embedding_store: only used for json lines files. If 'matrix', the vectors are read into a (float32)
+    EmbeddingMatrix rather than a dict of lists. If 'quantized', they are quantized to an (int8)
+    QuantizedEmbeddingMatrix. Binary files are always read into a memory-mapped EmbeddingMatrix
+    (or QuantizedEmbeddingMatrix).
+    :return: a dict, an EmbeddingMatrix or a QuantizedEmbeddingMatrix
+    """
+    if is_binary_embeddings_file(input_file):
+        return read_binary_embeddings(input_file)
+    embedding_object = dict()
+    with codecs.open(input_file, 'r', 'utf-8') as f:
+        for line in f:
+            obj = json.loads(line)
+            for k, v in obj.items():
+                if embedding_store in ('matrix', 'quantized') and not embedding_object:
+                    embedding_object = EmbeddingMatrix(len(v))
+                embedding_object[k] = v
+    if embedding_store == 'quantized' and embedding_object:
+        return QuantizedEmbeddingMatrix.quantize(embedding_object)
+    return embedding_object
+
+
+def write_embeddings(embedding_object, output_file, output_format='json'):
+    """
+    :param embedding_object: a dict or an EmbeddingMatrix
+    :param output_file:
+    :param output_format: 'json' (json lines, default) or 'binary'
+    :return: None
+    """
+    if output_format == 'json':
+        write_jlines_embeddings(embedding_object, output_file)
+    elif output_format == 'binary':
+        write_binary_embeddings(embedding_object, output_file)
+    else:
+        raise Exception('Unrecognized output format: ' + str(output_format))
+
+
+def write_context_vectors(context_vector_dict, output_file, dimensions):
+    """
+    Writes out sparse context vectors (as used by the trainer) in a compact form: for each key, the positions of
+    its non-zero elements as int16s, and their signs as int8s. Stored in numpy's .npz format.
+    :param context_vector_dict: a dict with a key referencing a tuple (list of +1 indices, list of -1 indices).
+    All vectors must have the same number of non-zero elements.
+    :param output_file:
+    :param dimensions: at most 32767
+    :return: None
+    """
+    if dimensions > np.iinfo(np.int16).max:
+        raise Exception('Context vectors with more than 32767 dimensions cannot be written in compact form.')
+    keys = list(context_vector_dict.keys())
+    num_non_zero = len(context_vector_dict[keys[0]][0]) + len(context_vector_dict[keys[0]][1]) if keys else 0
+    indices = np.zeros((len(keys), num_non_zero), dtype=np.int16)
+    signs = np.zeros((len(keys), num_non_zero), dtype=np.int8)
+    for i in range(0, len(keys)):
+        plus_indices, minus_indices = context_vector_dict[keys[i]]
+        if len(plus_indices) + len(minus_indices) != num_non_zero:
+            raise Exception('All context vectors must have the same number of non-zero elements.')
+        indices[i] = list(plus_indices) + list(minus_indices)
+        signs[i, 0:len(plus_indices)] = 1
+        signs[i, len(plus_indices):] = -1
+    keys_json = json.dumps(keys).encode('utf-8')
+    with open(output_file, 'wb') as out:
+        np.savez(out, dimensions=dimensions, indices=indices, signs=signs,
+                 keys=np.frombuffer(keys_json, dtype=np.uint8))
+
+
+def read_context_vectors(input_file):
+    """
+    Reads context vectors written out by write_context_vectors.
+    :param input_file:
+    :return: a tuple (dict with a key referencing a tuple (list of +1 indices, list of -1 indices), dimensions)
+    """
+    data = np.load(input_file)
+    keys = json.loads(data['keys'].tostring().decode('utf-8'))
+    indices = data['indices'].tolist()
+    signs = data['signs']
+    context_vector_dict = dict()
+    for i in range(0, len(keys)):
+        plus = signs[i] > 0
+        context_vector_dict[keys[i]] = ([indices[i][j] for j in range(0, len(plus)) if plus[j]],
+                                        [indices[i][j] for j in range(0, len(plus)) if not plus[j]])
+    return context_vector_dict, int(data['dimensions'])
+
+
+def _get_dtype_code(dtype):
+    for code, candidate in _DTYPE_CODES.items():
+        if np.dtype(dtype).kind == candidate.kind and np.dtype(dtype).itemsize == candidate.itemsize:
+            return code
+    raise Exception('Unsupported dtype: ' + str(dtype))
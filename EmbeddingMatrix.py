@@ -0,0 +1,136 @@
+import numpy as np
+
+
+class EmbeddingMatrix:
+    """
+    An array-backed alternative to the dict-of-lists embedding objects returned by the trainer. All vectors live
+    in one contiguous numpy matrix, and a dict maps each key (word or doc-id) to its row. For a 200-dimensional
+    int32/float32 embedding, this takes about 800 bytes per key, versus several KB for a python list of ints.
+
+    The class supports the dict-like access used throughout this package (in, [], len, keys, items etc.), so
+    it can be passed wherever a word/doc embedding object is expected. Note that [] returns a row of the matrix
+    (a numpy view), not a copy; modifying it modifies the stored vector.
+    """
+
+    def __init__(self, dimensions, dtype=np.float32, initial_capacity=1024):
+        """
+
+        :param dimensions: the number of dimensions of each vector
+        :param dtype: typically np.float32, or np.int32 for the (integer) vectors built by the trainer
+        :param initial_capacity: number of rows to allocate up front. The matrix doubles in size whenever it fills
+        up, so this only matters for performance.
+        """
+        self._dimensions = dimensions
+        self._matrix = np.zeros((max(initial_capacity, 1), dimensions), dtype=dtype)
+        self._keys = list()
+        self._index = dict()
+
+    @staticmethod
+    def from_dict(embedding_dict, dtype=np.float32):
+        """
+        Copies a dict-of-lists embedding object (e.g. as returned by the trainer) into a new EmbeddingMatrix.
+        :param embedding_dict:
+        :param dtype:
+        :return: an EmbeddingMatrix
+        """
+        if not embedding_dict:
+            raise Exception('Cannot build an embedding matrix from an empty embedding object!')
+        dimensions = len(next(iter(embedding_dict.values())))
+        result = EmbeddingMatrix(dimensions, dtype=dtype, initial_capacity=len(embedding_dict))
+        for k, v in embedding_dict.items():
+            result[k] = v
+        return result
+
+    @staticmethod
+    def from_arrays(keys, matrix):
+        """
+        Wraps an existing matrix (which may be an np.memmap) without copying it.
+        :param keys: a list of keys, with keys[i] referencing row i of the matrix
+        :param matrix: a 2-d numpy array with len(keys) rows
+        :return: an EmbeddingMatrix
+        """
+        if len(keys) != matrix.shape[0]:
+            raise Exception('The number of keys does not match the number of rows in the matrix!')
+        result = EmbeddingMatrix(matrix.shape[1], dtype=matrix.dtype, initial_capacity=1)
+        result._matrix = matrix
+        result._keys = list(keys)
+        result._index = dict()
+        for i in range(0, len(result._keys)):
+            result._index[result._keys[i]] = i
+        return result
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        return self._matrix[self._index[key]]
+
+    def __setitem__(self, key, vector):
+        if key not in self._index:
+            self._append_key(key)
+        self._matrix[self._index[key]] = vector
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self._matrix[self._index[key]]
+        else:
+            return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self._matrix[i] for i in range(0, len(self._keys))]
+
+    def items(self):
+        return [(self._keys[i], self._matrix[i]) for i in range(0, len(self._keys))]
+
+    def iteritems(self):
+        for i in range(0, len(self._keys)):
+            yield self._keys[i], self._matrix[i]
+
+    def get_dimensions(self):
+        return self._dimensions
+
+    def get_keys(self):
+        """
+        :return: the list of keys, in row order. Do not modify it.
+        """
+        return self._keys
+
+    def get_matrix(self):
+        """
+        :return: a (len(self) x dimensions) view of the underlying matrix, with row i holding the vector of
+        get_keys()[i]. Modifying the view modifies the stored vectors.
+        """
+        return self._matrix[0:len(self._keys)]
+
+    def get_row_index(self, key):
+        """
+        :param key:
+        :return: the row of key in get_matrix(), or None if key is not present
+        """
+        return self._index.get(key)
+
+    def to_dict(self):
+        """
+        :return: a dict-of-lists copy, in the same format as the trainer's embedding objects.
+        """
+        answer = dict()
+        for i in range(0, len(self._keys)):
+            answer[self._keys[i]] = self._matrix[i].tolist()
+        return answer
+
+    def _append_key(self, key):
+        if len(self._keys) == self._matrix.shape[0]:
+            new_matrix = np.zeros((2 * self._matrix.shape[0], self._dimensions), dtype=self._matrix.dtype)
+            new_matrix[0:len(self._keys)] = self._matrix[0:len(self._keys)]
+            self._matrix = new_matrix
+        self._index[key] = len(self._keys)
+        self._keys.append(key)
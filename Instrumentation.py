@@ -0,0 +1,265 @@
+"""
+Opt-in instrumentation for the hot paths of this package (training, tokenization, loading, writing and querying).
+Nothing is measured until enable is called; while disabled, every hook is a single flag check (or a no-op method
+call), so the overhead is negligible. For example:
+    import Instrumentation
+    Instrumentation.enable(sinks=[Instrumentation.stderr_sink], progress_interval=30.0)
+    trainer.train_word_embeddings('raw-lines.txt', 'embeddings.jl', additional_params={'tokenizer': 'regex'})
+    print Instrumentation.report()
+
+Three kinds of measurements are kept, by (dotted) name:
+    counters: e.g. trainer.lines, trainer.tokens, trainer.pairs, ShardedEmbeddingStore.cache_hits
+    timers: total seconds and number of calls e.g. trainer.vocabulary_pass, TextUtils.tokenize, WordEmbedding.query
+    progress: long loops (e.g. the training pass) periodically report their counts and throughput
+
+Sinks are callables that receive events (dicts). Every event has a 'type' ('timer', 'progress' or 'summary') and
+a 'name'. Timer events (for coarse stages only; per-call timings are just accumulated) have 'seconds'. Progress
+events have 'seconds' (elapsed), 'counts' and 'rates' (per second). Summary events (see report) have 'counters'
+and 'timers'.
+"""
+import json
+import sys
+import time
+
+_enabled = False
+_sinks = list()
+_progress_interval = 10.0
+_counters = dict()
+_timers = dict()    # name -> [total seconds, number of calls]
+
+
+def enable(sinks=None, progress_interval=10.0):
+    """
+    Turns instrumentation on. Counters and timers are not reset (see reset).
+    :param sinks: a list of callables that receive events. Defaults to [stderr_sink].
+    :param progress_interval: the minimum number of seconds between two progress events of a loop
+    :return: None
+    """
+    global _enabled, _sinks, _progress_interval
+    _sinks = list(sinks) if sinks is not None else [stderr_sink]
+    _progress_interval = progress_interval
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+
+def reset():
+    """
+    Clears all counters and timers.
+    :return: None
+    """
+    _counters.clear()
+    _timers.clear()
+
+
+def increment(name, amount=1):
+    """
+    :param name: the counter
+    :param amount:
+    :return: None
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def add_time(name, seconds, calls=1):
+    """
+    Adds to a timer without emitting an event. Use this (under an is_enabled check) for timings in hot paths.
+    :param name: the timer
+    :param seconds:
+    :param calls: the number of calls the time was spent on
+    :return: None
+    """
+    if _enabled:
+        total = _timers.get(name)
+        if total is None:
+            total = _timers[name] = [0.0, 0]
+        total[0] += seconds
+        total[1] += calls
+
+
+def timer(name):
+    """
+    Times a (coarse) stage: with Instrumentation.timer('trainer.vocabulary_pass'): ...
+    The time is added to the timer, and a timer event is sent to the sinks at the end of the stage.
+    :param name: the timer
+    :return: a context manager
+    """
+    if not _enabled:
+        return _NO_OP
+    return _Timer(name)
+
+
+def progress(name):
+    """
+    Tracks a long loop: call update on the returned object once per iteration (e.g. per line), and close at
+    the end. Counts are also added to the counters of the same names, prefixed with the module e.g. 'trainer.'.
+    :param name: e.g. 'trainer.train_word_embeddings'
+    :return: a Progress object (a no-op one, if instrumentation is disabled)
+    """
+    if not _enabled:
+        return _NO_OP
+    return Progress(name)
+
+
+def get_counters():
+    return dict(_counters)
+
+
+def get_timers():
+    """
+    :return: a dict with each timer referencing a dict with the total seconds and the number of calls
+    """
+    return dict((name, {'seconds': total[0], 'calls': total[1]}) for name, total in _timers.items())
+
+
+def report():
+    """
+    Sends a summary event (with all the counters and timers) to the sinks.
+    :return: the summary event
+    """
+    event = {'type': 'summary', 'name': 'summary', 'counters': get_counters(), 'timers': get_timers()}
+    _emit(event)
+    return event
+
+
+def stderr_sink(event):
+    """
+    A sink that prints a human-readable line per event to stderr.
+    """
+    if event['type'] == 'timer':
+        message = '%s took %.3f s' % (event['name'], event['seconds'])
+    elif event['type'] == 'progress':
+        counts = ', '.join('%s=%d (%.1f/s)' % (k, event['counts'][k], event['rates'][k])
+                           for k in sorted(event['counts']))
+        message = '%s: %.1f s, %s%s' % (event['name'], event['seconds'], counts, ' [done]' if event['done'] else '')
+    else:
+        message = json.dumps(event, sort_keys=True)
+    sys.stderr.write('[instrumentation] ' + message + '\n')
+
+
+class MemorySink:
+    """
+    A sink that keeps all the events in a list (e.g. for benchmarks).
+    """
+
+    def __init__(self):
+        self.events = list()
+
+    def __call__(self, event):
+        self.events.append(event)
+
+
+class JsonLinesSink:
+    """
+    A sink that appends each event, as a json line, to a file.
+    """
+
+    def __init__(self, output_file):
+        self._out = open(output_file, 'a')
+
+    def __call__(self, event):
+        self._out.write(json.dumps(event) + '\n')
+        self._out.flush()
+
+    def close(self):
+        self._out.close()
+
+
+class Progress:
+    """
+    See progress.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._prefix = name.split('.')[0] + '.'
+        self._counts = dict()
+        self._start = time.time()
+        self._next_report = self._start + _progress_interval
+
+    def update(self, **counts):
+        """
+        :param counts: increments, by name e.g. update(lines=1, tokens=12)
+        :return: None
+        """
+        for k, v in counts.items():
+            self._counts[k] = self._counts.get(k, 0) + v
+        now = time.time()
+        if now >= self._next_report:
+            self._next_report = now + _progress_interval
+            self._report(now, False)
+
+    def get_counts(self):
+        return dict(self._counts)
+
+    def close(self):
+        """
+        Adds the counts to the counters, and sends a final progress event.
+        :return: None
+        """
+        for k, v in self._counts.items():
+            increment(self._prefix + k, v)
+        self._report(time.time(), True)
+
+    def _report(self, now, done):
+        elapsed = max(now - self._start, 1e-9)
+        _emit({'type': 'progress', 'name': self._name, 'seconds': now - self._start, 'done': done,
+               'counts': dict(self._counts), 'rates': dict((k, v / elapsed) for k, v in self._counts.items())})
+
+
+class _Timer:
+
+    def __init__(self, name):
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self._start
+        add_time(self._name, seconds)
+        _emit({'type': 'timer', 'name': self._name, 'seconds': seconds})
+        return False
+
+
+class _NoOp:
+    """
+    Stands in for both _Timer and Progress while instrumentation is disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def update(self, **counts):
+        pass
+
+    def get_counts(self):
+        return dict()
+
+    def close(self):
+        pass
+
+
+_NO_OP = _NoOp()
+
+
+def _emit(event):
+    for sink in _sinks:
+        sink(event)
@@ -0,0 +1,213 @@
+import VectorUtils
+import numpy as np
+import json
+
+
+class LSHIndex:
+    """
+    Approximate similarity search using sign-random-projection (random hyperplane) locality sensitive hashing.
+    Each of num_tables tables hashes a vector to num_bits bits, one per random hyperplane (the sign of the
+    dot product). Vectors with a small angle between them are likely to collide in at least one table. At query
+    time, we collect all the vectors that collide with the query in some table, and re-rank these candidates
+    with the exact (absolute) cosine similarity. The index only holds the codes; the exact vectors are looked up
+    in an embedding object passed in at query time (e.g. the doc vectors of a DocEmbedding), so that they are not
+    kept twice.
+
+    Since we use absolute cosine similarity throughout this package, by default we also probe the bucket of the
+    negated query (whose code is the complement of the query's code).
+
+    Buckets are kept as sorted numpy arrays of codes (searched with searchsorted) rather than python dicts, so that
+    the index stays compact at tens of millions of vectors. Newly inserted vectors go into a small pending
+    dict, which is merged into the sorted arrays once it grows large enough.
+    """
+
+    def __init__(self, dimensions, num_tables=8, num_bits=16, seed=0):
+        """
+
+        :param dimensions: the number of dimensions of the indexed vectors
+        :param num_tables: more tables means higher recall, but more candidates to re-rank per query
+        :param num_bits: more bits means smaller buckets (fewer candidates) but lower recall. At most 62.
+        :param seed: the seed for generating the random hyperplanes
+        """
+        if num_bits > 62:
+            raise Exception('At most 62 bits per table are supported.')
+        self._num_tables = num_tables
+        self._num_bits = num_bits
+        self._seed = seed
+        self._hyperplanes = np.random.RandomState(seed).randn(dimensions, num_tables * num_bits).astype(np.float32)
+        self._bit_weights = np.left_shift(np.int64(1), np.arange(num_bits, dtype=np.int64))
+        self._codes = np.zeros((1024, num_tables), dtype=np.int64)
+        self._sorted_codes = [np.zeros(0, dtype=np.int64) for t in range(num_tables)]
+        self._sorted_rows = [np.zeros(0, dtype=np.int64) for t in range(num_tables)]
+        self._num_sorted = 0
+        self._pending = [dict() for t in range(num_tables)]
+        self._keys = list()
+        self._index = dict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def add(self, key, vector):
+        """
+        Inserts a single vector. If key is already in the index, an exception is raised.
+        :param key: e.g. a doc-id
+        :param vector:
+        :return: None
+        """
+        self.add_batch([key], [vector])
+
+    def add_batch(self, keys, vectors):
+        """
+        Hashes and inserts many vectors at once (much faster than calling add for each one). Only their codes are
+        kept, so the same vectors must be passed to query as exact_vectors.
+        :param keys: a list of distinct keys, none of which may already be in the index
+        :param vectors: a list of vectors, or a 2-d numpy array with one vector per row
+        :return: None
+        """
+        # all the keys are checked before anything is inserted, so that a failed batch leaves the index as it was
+        for key in keys:
+            if key in self._index:
+                raise Exception('Key is already in the index: ' + unicode(key))
+        if len(set(keys)) != len(keys):
+            raise Exception('The batch contains duplicate keys.')
+        if not keys:
+            return
+        # the sign of a dot product does not depend on the length of the vector, so there is no need to normalize
+        codes = self._hash(np.asarray(vectors, dtype=np.float32))
+        start = len(self._keys)
+        for i in range(0, len(keys)):
+            self._index[keys[i]] = start + i
+            self._keys.append(keys[i])
+        if start + len(keys) > self._codes.shape[0]:
+            new_codes = np.zeros((max(2 * self._codes.shape[0], start + len(keys)), self._num_tables),
+                                 dtype=np.int64)
+            new_codes[0:start] = self._codes[0:start]
+            self._codes = new_codes
+        self._codes[start:start + len(keys)] = codes
+        for t in range(0, self._num_tables):
+            pending = self._pending[t]
+            for i in range(0, len(keys)):
+                code = int(codes[i, t])
+                if code not in pending:
+                    pending[code] = list()
+                pending[code].append(start + i)
+        if len(self._keys) - self._num_sorted > max(1024, self._num_sorted / 8):
+            self._merge_pending()
+
+    def query(self, vector, exact_vectors, k=10, exclude_key=None, probe_negated=True):
+        """
+        :param vector: the query vector. Need not be normalized.
+        :param exact_vectors: an embedding object (e.g. a dict or a memory-mapped EmbeddingMatrix) holding the
+        exact vectors of the indexed keys, used to re-rank the candidates
+        :param k:
+        :param exclude_key: a key that should not be returned (typically, the key of the query itself)
+        :param probe_negated: if True, also probe the buckets of the negated query (see class docstring)
+        :return: a list of (at most) k keys, most similar first. Only keys that collide with the query in at
+        least one table can be returned.
+        """
+        query_vector = VectorUtils.normalize_matrix(np.asarray(vector, dtype=np.float32)[np.newaxis, :])[0]
+        candidates = self._get_candidates(self._hash(query_vector[np.newaxis, :])[0], probe_negated)
+        if exclude_key is not None and exclude_key in self._index:
+            candidates.discard(self._index[exclude_key])
+        if not candidates:
+            return list()
+        rows = sorted(candidates)
+        candidate_matrix = np.array([exact_vectors[self._keys[row]] for row in rows], dtype=np.float32)
+        scores = np.abs(VectorUtils.normalize_matrix(candidate_matrix).dot(query_vector)).astype(np.float64)
+        return [self._keys[rows[i]] for i in VectorUtils.top_k_indices(scores, k)]
+
+    def query_key(self, key, exact_vectors, k=10, probe_negated=True):
+        """
+        :param key: must be in the index (and in exact_vectors)
+        :param exact_vectors: see query
+        :param k:
+        :param probe_negated: see query
+        :return: a list of (at most) k keys most similar to key, not including key itself
+        """
+        return self.query(exact_vectors[key], exact_vectors, k=k, exclude_key=key, probe_negated=probe_negated)
+
+    def measure_recall(self, exact_index, query_keys, exact_vectors, k=10, probe_negated=True):
+        """
+        Measures recall@k against brute-force search i.e. the fraction of the true k nearest neighbours (as
+        returned by exact_index) that this index also returns, averaged over the queries.
+        :param exact_index: an ExactIndex over the same vectors
+        :param query_keys: the keys to use as queries. Must be in both indexes.
+        :param exact_vectors: see query
+        :param k:
+        :param probe_negated: see query
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        exact_results = exact_index.query_keys_batch(query_keys, k=k)
+        total = 0.0
+        count = 0
+        for key in query_keys:
+            truth = set(exact_results[key])
+            if not truth:
+                continue
+            approximate = set(self.query_key(key, exact_vectors, k=k, probe_negated=probe_negated))
+            total += len(truth & approximate) / float(len(truth))
+            count += 1
+        if count == 0:
+            return 0.0
+        return total / count
+
+    def save(self, path):
+        """
+        Writes the index out to path (in numpy's .npz format). The vectors are not written out; see query.
+        :param path:
+        :return: None
+        """
+        keys_json = json.dumps(self._keys).encode('utf-8')
+        with open(path, 'wb') as out:
+            np.savez(out, num_tables=self._num_tables, num_bits=self._num_bits, seed=self._seed,
+                     hyperplanes=self._hyperplanes, codes=self._codes[0:len(self._keys)],
+                     keys=np.frombuffer(keys_json, dtype=np.uint8))
+
+    @staticmethod
+    def load(path):
+        """
+        Reads an index written out by save.
+        :param path:
+        :return: an LSHIndex
+        """
+        data = np.load(path)
+        index = LSHIndex(data['hyperplanes'].shape[0], num_tables=int(data['num_tables']),
+                         num_bits=int(data['num_bits']), seed=int(data['seed']))
+        index._hyperplanes = data['hyperplanes']
+        index._keys = json.loads(data['keys'].tostring().decode('utf-8'))
+        for i in range(0, len(index._keys)):
+            index._index[index._keys[i]] = i
+        index._codes = data['codes']
+        index._merge_pending()
+        return index
+
+    def _hash(self, matrix):
+        bits = (matrix.dot(self._hyperplanes) > 0).astype(np.int64)
+        return bits.reshape(matrix.shape[0], self._num_tables, self._num_bits).dot(self._bit_weights)
+
+    def _get_candidates(self, codes, probe_negated):
+        candidates = set()
+        mask = (1 << self._num_bits) - 1
+        for t in range(0, self._num_tables):
+            probes = [int(codes[t])]
+            if probe_negated:
+                probes.append(codes[t] ^ mask)
+            for code in probes:
+                left = np.searchsorted(self._sorted_codes[t], code, side='left')
+                right = np.searchsorted(self._sorted_codes[t], code, side='right')
+                candidates.update(self._sorted_rows[t][left:right].tolist())
+                if code in self._pending[t]:
+                    candidates.update(self._pending[t][code])
+        return candidates
+
+    def _merge_pending(self):
+        num_rows = len(self._keys)
+        for t in range(0, self._num_tables):
+            order = np.argsort(self._codes[0:num_rows, t], kind='mergesort')
+            self._sorted_rows[t] = order
+            self._sorted_codes[t] = self._codes[0:num_rows, t][order]
+            self._pending[t] = dict()
+        self._num_sorted = num_rows
@@ -0,0 +1,249 @@
+import VectorUtils
+import numpy as np
+import json
+
+
+class PQIndex:
+    """
+    Approximate similarity search over product-quantized vectors, for collections too big to keep even int8
+    vectors in memory. Each (l2-normalized) vector is split into num_subspaces contiguous subvectors, and each
+    subvector is replaced by the index of its nearest centroid in a per-subspace codebook, learned with k-means.
+    A vector is thus stored as num_subspaces bytes (e.g. 8 bytes instead of 800 for 200 float32 dimensions).
+
+    Queries use asymmetric distance computation: the query itself is not quantized. For each subspace we compute
+    a lookup table with the dot product of the query subvector and every centroid, and the (approximate) score
+    of a stored vector is the sum of its num_subspaces table entries. As elsewhere in this package, we rank by
+    absolute cosine similarity. Optionally, the best candidates are re-ranked with the exact vectors.
+
+    Call train (on a sample of the vectors) before adding any vectors.
+    """
+
+    def __init__(self, dimensions, num_subspaces=8, num_centroids=256, seed=0):
+        """
+
+        :param dimensions: the number of dimensions of the indexed vectors
+        :param num_subspaces: the number of bytes per vector. More subspaces means better accuracy, but a bigger
+        index and slower queries. If dimensions is not a multiple of num_subspaces, some subspaces get one
+        dimension more than others.
+        :param num_centroids: the size of each codebook. At most 256.
+        :param seed: the seed for initializing k-means
+        """
+        if num_centroids > 256:
+            raise Exception('At most 256 centroids per subspace are supported.')
+        if num_subspaces > dimensions:
+            raise Exception('There cannot be more subspaces than dimensions.')
+        self._dimensions = dimensions
+        self._num_subspaces = num_subspaces
+        self._num_centroids = num_centroids
+        self._seed = seed
+        self._boundaries = np.linspace(0, dimensions, num_subspaces + 1).astype(np.int64)
+        self._codebooks = None
+        self._codes = np.zeros((1024, num_subspaces), dtype=np.uint8)
+        self._keys = list()
+        self._index = dict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def train(self, vectors, num_iterations=20):
+        """
+        Learns the codebooks with k-means, one subspace at a time. A sample of a few hundred thousand vectors is
+        typically enough, even for a huge collection.
+        :param vectors: a list of vectors, or a 2-d numpy array with one vector per row. There must be at least
+        num_centroids of them.
+        :param num_iterations: the number of k-means iterations
+        :return: None
+        """
+        matrix = VectorUtils.normalize_matrix(np.asarray(vectors, dtype=np.float32)).astype(np.float32)
+        if matrix.shape[0] < self._num_centroids:
+            raise Exception('Need at least ' + str(self._num_centroids) + ' vectors to train the codebooks.')
+        rng = np.random.RandomState(self._seed)
+        self._codebooks = list()
+        for m in range(0, self._num_subspaces):
+            subvectors = matrix[:, self._boundaries[m]:self._boundaries[m + 1]]
+            self._codebooks.append(PQIndex._kmeans(subvectors, self._num_centroids, num_iterations, rng))
+
+    def add(self, key, vector):
+        """
+        Inserts a single vector. If key is already in the index, an exception is raised.
+        :param key: e.g. a doc-id
+        :param vector:
+        :return: None
+        """
+        self.add_batch([key], [vector])
+
+    def add_batch(self, keys, vectors):
+        """
+        Encodes and inserts many vectors at once (much faster than calling add for each one).
+        :param keys: a list of distinct keys, none of which may already be in the index
+        :param vectors: a list of vectors, or a 2-d numpy array with one vector per row
+        :return: None
+        """
+        if self._codebooks is None:
+            raise Exception('The index has not been trained yet. Call train first.')
+        # all the keys are checked before anything is inserted, so that a failed batch leaves the index as it was
+        for key in keys:
+            if key in self._index:
+                raise Exception('Key is already in the index: ' + unicode(key))
+        if len(set(keys)) != len(keys):
+            raise Exception('The batch contains duplicate keys.')
+        if not keys:
+            return
+        codes = self._encode(VectorUtils.normalize_matrix(np.asarray(vectors, dtype=np.float32)).astype(np.float32))
+        start = len(self._keys)
+        for i in range(0, len(keys)):
+            self._index[keys[i]] = start + i
+            self._keys.append(keys[i])
+        if len(self._keys) > self._codes.shape[0]:
+            new_codes = np.zeros((max(2 * self._codes.shape[0], len(self._keys)), self._num_subspaces),
+                                 dtype=np.uint8)
+            new_codes[0:start] = self._codes[0:start]
+            self._codes = new_codes
+        self._codes[start:len(self._keys)] = codes
+
+    def query(self, vector, k=10, exclude_key=None, rerank_size=0, exact_vectors=None, max_block_elements=2**24):
+        """
+        :param vector: the query vector. Need not be normalized.
+        :param k:
+        :param exclude_key: a key that should not be returned (typically, the key of the query itself)
+        :param rerank_size: if greater than k (and exact_vectors is given), the rerank_size best candidates by
+        approximate score are re-ranked by their exact scores.
+        :param exact_vectors: an embedding object (e.g. a dict or a memory-mapped EmbeddingMatrix) holding the
+        exact vectors of the indexed keys. Only used for re-ranking.
+        :param max_block_elements: bounds the memory used for scoring (see ExactIndex.query_keys_batch)
+        :return: a list of (at most) k keys, most similar first
+        """
+        query_vector = VectorUtils.normalize_matrix(np.asarray(vector, dtype=np.float32)[np.newaxis, :])[0]
+        tables = np.zeros((self._num_subspaces, self._num_centroids), dtype=np.float32)
+        for m in range(0, self._num_subspaces):
+            tables[m] = self._codebooks[m].dot(query_vector[self._boundaries[m]:self._boundaries[m + 1]])
+        scores = np.zeros(len(self._keys), dtype=np.float64)
+        subspaces = np.arange(0, self._num_subspaces)
+        block_size = max(1, max_block_elements / self._num_subspaces)
+        for start in range(0, len(self._keys), block_size):
+            block = self._codes[start:min(start + block_size, len(self._keys))]
+            scores[start:start + len(block)] = np.abs(tables[subspaces, block].sum(axis=1))
+        if exclude_key is not None and exclude_key in self._index:
+            scores[self._index[exclude_key]] = -np.inf
+        if exact_vectors is None or rerank_size <= k:
+            return [self._keys[i] for i in VectorUtils.top_k_indices(scores, k)]
+        candidates = VectorUtils.top_k_indices(scores, rerank_size)
+        candidate_matrix = np.array([exact_vectors[self._keys[i]] for i in candidates], dtype=np.float32)
+        exact_scores = np.abs(VectorUtils.normalize_matrix(candidate_matrix).dot(query_vector)).astype(np.float64)
+        return [self._keys[candidates[i]] for i in VectorUtils.top_k_indices(exact_scores, k)]
+
+    def query_key(self, key, k=10, rerank_size=0, exact_vectors=None):
+        """
+        :param key: must be in the index
+        :param k:
+        :param rerank_size: see query
+        :param exact_vectors: see query. If given, the exact vector of key is used as the query; otherwise, its
+        reconstruction from the codebooks.
+        :return: a list of (at most) k keys most similar to key, not including key itself
+        """
+        if exact_vectors is not None:
+            vector = exact_vectors[key]
+        else:
+            vector = self.reconstruct(key)
+        return self.query(vector, k=k, exclude_key=key, rerank_size=rerank_size, exact_vectors=exact_vectors)
+
+    def reconstruct(self, key):
+        """
+        :param key: must be in the index
+        :return: the (normalized) vector of key, as approximated by its codes
+        """
+        codes = self._codes[self._index[key]]
+        return np.concatenate([self._codebooks[m][codes[m]] for m in range(0, self._num_subspaces)])
+
+    def measure_recall(self, exact_index, query_keys, k=10, rerank_size=0, exact_vectors=None):
+        """
+        Measures recall@k against brute-force search i.e. the fraction of the true k nearest neighbours (as
+        returned by exact_index) that this index also returns, averaged over the queries.
+        :param exact_index: an ExactIndex over the same vectors
+        :param query_keys: the keys to use as queries. Must be in both indexes.
+        :param k:
+        :param rerank_size: see query
+        :param exact_vectors: see query_key
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        exact_results = exact_index.query_keys_batch(query_keys, k=k)
+        total = 0.0
+        count = 0
+        for key in query_keys:
+            truth = set(exact_results[key])
+            if not truth:
+                continue
+            approximate = set(self.query_key(key, k=k, rerank_size=rerank_size, exact_vectors=exact_vectors))
+            total += len(truth & approximate) / float(len(truth))
+            count += 1
+        if count == 0:
+            return 0.0
+        return total / count
+
+    def save(self, path):
+        """
+        Writes the index out to path (in numpy's .npz format).
+        :param path:
+        :return: None
+        """
+        if self._codebooks is None:
+            raise Exception('The index has not been trained yet. Call train first.')
+        keys_json = json.dumps(self._keys).encode('utf-8')
+        arrays = {'dimensions': self._dimensions, 'num_subspaces': self._num_subspaces,
+                  'num_centroids': self._num_centroids, 'seed': self._seed, 'codes': self._codes[0:len(self._keys)],
+                  'keys': np.frombuffer(keys_json, dtype=np.uint8)}
+        for m in range(0, self._num_subspaces):
+            arrays['codebook_' + str(m)] = self._codebooks[m]
+        with open(path, 'wb') as out:
+            np.savez(out, **arrays)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads an index written out by save.
+        :param path:
+        :return: a PQIndex
+        """
+        data = np.load(path)
+        index = PQIndex(int(data['dimensions']), num_subspaces=int(data['num_subspaces']),
+                        num_centroids=int(data['num_centroids']), seed=int(data['seed']))
+        index._codebooks = [data['codebook_' + str(m)] for m in range(0, index._num_subspaces)]
+        index._keys = json.loads(data['keys'].tostring().decode('utf-8'))
+        for i in range(0, len(index._keys)):
+            index._index[index._keys[i]] = i
+        index._codes = data['codes']
+        return index
+
+    def _encode(self, matrix):
+        codes = np.zeros((matrix.shape[0], self._num_subspaces), dtype=np.uint8)
+        for m in range(0, self._num_subspaces):
+            subvectors = matrix[:, self._boundaries[m]:self._boundaries[m + 1]]
+            codes[:, m] = PQIndex._assign(subvectors, self._codebooks[m])
+        return codes
+
+    @staticmethod
+    def _assign(subvectors, centroids, block_size=65536):
+        # nearest centroid by euclidean distance; |x|^2 is the same for every centroid, so we can drop it
+        centroid_norms = (centroids * centroids).sum(axis=1)
+        assignments = np.zeros(subvectors.shape[0], dtype=np.int64)
+        for start in range(0, subvectors.shape[0], block_size):
+            block = subvectors[start:start + block_size]
+            assignments[start:start + len(block)] = np.argmin(centroid_norms - 2.0 * block.dot(centroids.T), axis=1)
+        return assignments
+
+    @staticmethod
+    def _kmeans(subvectors, num_centroids, num_iterations, rng):
+        centroids = subvectors[rng.choice(subvectors.shape[0], num_centroids, replace=False)].copy()
+        for iteration in range(0, num_iterations):
+            assignments = PQIndex._assign(subvectors, centroids)
+            counts = np.bincount(assignments, minlength=num_centroids)
+            for j in range(0, subvectors.shape[1]):
+                centroids[:, j] = np.bincount(assignments, weights=subvectors[:, j], minlength=num_centroids)
+            empty = counts == 0
+            centroids[~empty] /= counts[~empty][:, np.newaxis]
+            if empty.any():     # re-seed empty clusters with random points
+                centroids[empty] = subvectors[rng.choice(subvectors.shape[0], int(empty.sum()), replace=False)]
+        return centroids
@@ -0,0 +1,218 @@
+import numpy as np
+import codecs
+import json
+import re
+import zlib
+
+_WORD_CHARACTER = re.compile(r'\w', re.UNICODE)
+_PRIME = 2147483647     # 2**31 - 1
+
+
+class PhraseDetector:
+    """
+    Detects frequent phrases (n-grams of 2 up to max_n_grams tokens) in a stream of tokenized lines, in bounded
+    memory. A phrase is a sequence of tokens that occurs together much more often than chance, as in word2vec's
+    phrase detection: the score of a phrase with count c, whose tokens have counts c_1 ... c_n, is
+        (c - min_count) * num_tokens**(n-1) / (c_1 * ... * c_n)
+    and phrases with c >= min_count and a score above threshold are kept.
+
+    Two bounded structures replace the (unbounded) dict of all n-gram counts:
+        a count-min sketch (sketch_depth x sketch_width counters) estimates the count of any n-gram (including
+        unigrams). Estimates never undercount, and overcount by a small fraction of the stream length.
+        a candidate table keeps at most capacity n-grams (n >= 2). When it is full, the less frequent half is
+        dropped (as in lossy counting), so only frequent n-grams survive to the end.
+
+    N-grams that contain a token without any word characters (e.g. punctuation) are never phrases.
+    """
+
+    def __init__(self, max_n_grams=2, min_count=5, threshold=10.0, capacity=100000, sketch_width=2**20,
+                 sketch_depth=4, seed=0):
+        """
+
+        :param max_n_grams: the maximum number of tokens in a phrase
+        :param min_count: phrases occurring fewer times than this are ignored
+        :param threshold: the minimum score (see class docstring) of a phrase. Higher means fewer phrases.
+        :param capacity: the maximum number of candidate phrases kept in memory
+        :param sketch_width: the number of counters per row of the count-min sketch
+        :param sketch_depth: the number of rows (hash functions) of the count-min sketch
+        :param seed: the seed for the sketch's hash functions
+        """
+        self._max_n_grams = max_n_grams
+        self._min_count = min_count
+        self._threshold = threshold
+        self._capacity = capacity
+        self._sketch_width = sketch_width
+        self._sketch = np.zeros((sketch_depth, sketch_width), dtype=np.int32)
+        rng = np.random.RandomState(seed)
+        self._hash_a = rng.randint(1, 2**30, size=sketch_depth).astype(np.int64)
+        self._hash_b = rng.randint(0, 2**30, size=sketch_depth).astype(np.int64)
+        self._candidates = dict()
+        self._pending_hashes = list()
+        self._pending_weights = list()
+        self._num_tokens = 0
+
+    def update(self, tokens, weight=1):
+        """
+        Counts the n-grams of a line.
+        :param tokens: the list of tokens of a line
+        :param weight: the number of times the line occurs
+        :return: None
+        """
+        self._num_tokens += len(tokens) * weight
+        valid = [_WORD_CHARACTER.search(token) is not None for token in tokens]
+        for i in range(0, len(tokens)):
+            if not valid[i]:
+                continue
+            key = tokens[i]
+            self._pending_hashes.append(_hash(key))
+            self._pending_weights.append(weight)
+            for n in range(2, self._max_n_grams + 1):
+                if i + n > len(tokens) or not valid[i + n - 1]:
+                    break
+                key = key + u' ' + tokens[i + n - 1]
+                self._pending_hashes.append(_hash(key))
+                self._pending_weights.append(weight)
+                self._candidates[key] = self._candidates.get(key, 0) + weight
+        if len(self._pending_hashes) >= 65536:
+            self._flush()
+        if len(self._candidates) > self._capacity:
+            self._prune()
+
+    def estimate_counts(self, keys):
+        """
+        :param keys: a list of n-grams (tokens joined by single spaces)
+        :return: a numpy array with the (count-min sketch) estimate of the count of each key
+        """
+        self._flush()
+        if not keys:
+            return np.zeros(0, dtype=np.int64)
+        columns = self._get_columns(np.array([_hash(key) for key in keys], dtype=np.int64))
+        rows = np.arange(0, self._sketch.shape[0])[:, np.newaxis]
+        return self._sketch[rows, columns].min(axis=0).astype(np.int64)
+
+    def get_phrases(self):
+        """
+        :return: the set of detected phrases (tokens joined by single spaces)
+        """
+        candidates = list(self._candidates.keys())
+        counts = self.estimate_counts(candidates)
+        tokens = list(set(token for candidate in candidates for token in candidate.split(u' ')))
+        token_counts = dict(zip(tokens, self.estimate_counts(tokens).tolist()))
+        phrases = set()
+        for i in range(0, len(candidates)):
+            if counts[i] < self._min_count:
+                continue
+            parts = candidates[i].split(u' ')
+            score = float(counts[i] - self._min_count)
+            for part in parts:
+                score *= float(self._num_tokens) / max(token_counts[part], 1)
+            score /= self._num_tokens
+            if score > self._threshold:
+                phrases.add(candidates[i])
+        return phrases
+
+    def get_matcher(self):
+        """
+        :return: a PhraseMatcher for the detected phrases
+        """
+        return PhraseMatcher(self.get_phrases(), self._max_n_grams)
+
+    def save(self, output_file):
+        """
+        Writes out the detected phrases (not the counts), as json. Read them back in with PhraseMatcher.load.
+        :param output_file:
+        :return: None
+        """
+        self.get_matcher().save(output_file)
+
+    def _flush(self):
+        if not self._pending_hashes:
+            return
+        columns = self._get_columns(np.array(self._pending_hashes, dtype=np.int64))
+        weights = np.array(self._pending_weights, dtype=np.float64)
+        for row in range(0, self._sketch.shape[0]):
+            self._sketch[row] += np.bincount(columns[row], weights=weights,
+                                             minlength=self._sketch_width).astype(np.int32)
+        self._pending_hashes = list()
+        self._pending_weights = list()
+
+    def _get_columns(self, hashes):
+        return (self._hash_a[:, np.newaxis] * hashes[np.newaxis, :] + self._hash_b[:, np.newaxis]) % _PRIME \
+               % self._sketch_width
+
+    def _prune(self):
+        # keep the more frequent half; their counts (like every count) are re-estimated from the sketch at the end
+        median = np.median(np.fromiter(self._candidates.itervalues(), dtype=np.int64, count=len(self._candidates)))
+        self._candidates = dict((k, v) for k, v in self._candidates.iteritems() if v > median)
+
+
+class PhraseMatcher:
+    """
+    Finds the occurrences of a fixed set of phrases in tokenized lines. Small and picklable, unlike
+    PhraseDetector, so it can be sent to worker processes.
+    """
+
+    def __init__(self, phrases, max_n_grams=None):
+        """
+
+        :param phrases: an iterable of phrases (tokens joined by single spaces)
+        :param max_n_grams: the maximum number of tokens in a phrase. Computed from phrases if None.
+        """
+        self._phrases = set(phrases)
+        self._first_tokens = set(phrase.split(u' ')[0] for phrase in self._phrases)
+        if max_n_grams is None:
+            max_n_grams = max([len(phrase.split(u' ')) for phrase in self._phrases] + [1])
+        self._max_n_grams = max_n_grams
+
+    def __len__(self):
+        return len(self._phrases)
+
+    def __contains__(self, phrase):
+        return phrase in self._phrases
+
+    def get_phrases(self):
+        return self._phrases
+
+    def get_max_n_grams(self):
+        return self._max_n_grams
+
+    def find(self, tokens):
+        """
+        At each position, finds the longest phrase starting there (so occurrences may overlap, e.g. 'new york city'
+        and 'york city').
+        :param tokens: the list of tokens of a line
+        :return: a list of (start, end, phrase) tuples, with tokens[start:end] making up the phrase
+        """
+        spans = list()
+        for i in range(0, len(tokens)):
+            if tokens[i] not in self._first_tokens:
+                continue
+            for n in range(min(self._max_n_grams, len(tokens) - i), 1, -1):
+                phrase = u' '.join(tokens[i:i + n])
+                if phrase in self._phrases:
+                    spans.append((i, i + n, phrase))
+                    break
+        return spans
+
+    def save(self, output_file):
+        """
+        :param output_file:
+        :return: None
+        """
+        with codecs.open(output_file, 'w', 'utf-8') as out:
+            json.dump({'max_n_grams': self._max_n_grams, 'phrases': sorted(self._phrases)}, out)
+
+    @staticmethod
+    def load(input_file):
+        """
+        Reads phrases written out by save (or PhraseDetector.save).
+        :param input_file:
+        :return: a PhraseMatcher
+        """
+        with codecs.open(input_file, 'r', 'utf-8') as f:
+            obj = json.load(f)
+        return PhraseMatcher(obj['phrases'], obj['max_n_grams'])
+
+
+def _hash(key):
+    return zlib.crc32(key.encode('utf-8')) & 0xffffffff
@@ -0,0 +1,126 @@
+import numpy as np
+
+
+class QuantizedEmbeddingMatrix:
+    """
+    A compressed, read-only alternative to EmbeddingMatrix. Each vector is stored as int8 (or int16) codes plus a
+    float32 scale factor, with vector ~= scale * codes. That is 4x (or 2x) smaller than float32, and far smaller
+    than json lists. Random-indexing vectors are sums of +1/-1 increments, i.e. small integers; a vector whose
+    values already fit in the code range is stored exactly (with a scale of 1.0).
+
+    The class supports the same dict-like access as EmbeddingMatrix ([] returns a dequantized float32 copy), so it
+    can be passed wherever a word/doc embedding object is expected. Similarity search should use QuantizedIndex
+    (in SimilarityIndex), which scores the codes directly, without dequantizing the whole matrix.
+    """
+
+    def __init__(self, keys, codes, scales):
+        """
+        See also quantize. Wraps the arrays without copying them (so they may be np.memmaps).
+        :param keys: a list of keys, with keys[i] referencing row i of codes
+        :param codes: a 2-d int8 or int16 numpy array with len(keys) rows
+        :param scales: a 1-d float32 numpy array with len(keys) elements
+        """
+        if len(keys) != codes.shape[0] or len(keys) != scales.shape[0]:
+            raise Exception('The number of keys does not match the number of codes or scales!')
+        self._keys = list(keys)
+        self._codes = codes
+        self._scales = scales
+        self._index = dict()
+        for i in range(0, len(self._keys)):
+            self._index[self._keys[i]] = i
+
+    @staticmethod
+    def quantize(embedding_object, dtype=np.int8, block_size=65536):
+        """
+        :param embedding_object: a dict, an EmbeddingMatrix or anything else with keys and []
+        :param dtype: np.int8 (default) or np.int16
+        :param block_size: the number of vectors converted at a time, which bounds the temporary memory used
+        :return: a QuantizedEmbeddingMatrix
+        """
+        if np.dtype(dtype) not in (np.dtype(np.int8), np.dtype(np.int16)):
+            raise Exception('Unsupported dtype for quantization: ' + str(dtype))
+        keys = list(embedding_object.keys())
+        if not keys:
+            raise Exception('Cannot quantize an empty embedding object!')
+        max_code = np.iinfo(dtype).max
+        codes = np.zeros((len(keys), len(embedding_object[keys[0]])), dtype=dtype)
+        scales = np.zeros(len(keys), dtype=np.float32)
+        for start in range(0, len(keys), block_size):
+            block = np.array([embedding_object[key] for key in keys[start:start + block_size]], dtype=np.float64)
+            max_values = np.abs(block).max(axis=1)
+            block_scales = max_values / max_code
+            integral = (block == np.rint(block)).all(axis=1)
+            block_scales[integral] = np.maximum(block_scales[integral], 1.0)   # exact, if the values fit
+            block_scales[block_scales == 0.0] = 1.0
+            codes[start:start + len(block)] = np.rint(block / block_scales[:, np.newaxis])
+            scales[start:start + len(block)] = block_scales
+        return QuantizedEmbeddingMatrix(keys, codes, scales)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        row = self._index[key]
+        return self._codes[row].astype(np.float32) * self._scales[row]
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self[key]
+        else:
+            return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return [self[key] for key in self._keys]
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, self[key]
+
+    def get_dimensions(self):
+        return self._codes.shape[1]
+
+    def get_keys(self):
+        """
+        :return: the list of keys, in row order. Do not modify it.
+        """
+        return self._keys
+
+    def get_codes(self):
+        """
+        :return: the (len(self) x dimensions) matrix of codes, with row i holding the codes of get_keys()[i]
+        """
+        return self._codes
+
+    def get_scales(self):
+        """
+        :return: the scale factor of each row of get_codes()
+        """
+        return self._scales
+
+    def get_row_index(self, key):
+        """
+        :param key:
+        :return: the row of key in get_codes(), or None if key is not present
+        """
+        return self._index.get(key)
+
+    def to_dict(self):
+        """
+        :return: a dict-of-lists (dequantized) copy, in the same format as the trainer's embedding objects.
+        """
+        answer = dict()
+        for key in self._keys:
+            answer[key] = self[key].tolist()
+        return answer
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+import EmbeddingIO
+import Instrumentation
+import numpy as np
+import codecs
+import json
+import os
+import zlib
+
+_MANIFEST_FILE = 'manifest.json'
+
+
+class ShardedEmbeddingStore:
+    """
+    A disk-backed embedding object for embeddings that do not fit in memory. The vectors are partitioned across
+    several binary embedding files (see EmbeddingIO) by a hash of the key. A shard is only opened (memory-mapped,
+    with its vocabulary read into a key index) the first time one of its keys is looked up, and the most recently
+    used vectors are kept in an in-memory LRU cache. With a skewed query distribution, a small cache serves most
+    lookups.
+
+    The class supports the same dict-like access as EmbeddingMatrix (in, [], len, keys, items etc.), so it can be
+    passed as the embedding object of WordEmbedding or DocEmbedding; get_vector then works as before, including
+    summing the vectors of a list of keys. Note that similarity search (build_index etc.) still reads every vector.
+
+    Use write to build the shard directory from an existing embedding object.
+    """
+
+    def __init__(self, directory, cache_size=100000):
+        """
+
+        :param directory: a directory written by ShardedEmbeddingStore.write
+        :param cache_size: the maximum number of vectors to keep in the LRU cache. Set to 0 to disable the cache.
+        """
+        with codecs.open(os.path.join(directory, _MANIFEST_FILE), 'r', 'utf-8') as f:
+            manifest = json.load(f)
+        self._directory = directory
+        self._num_shards = manifest['num_shards']
+        self._dimensions = manifest['dimensions']
+        self._shard_sizes = manifest['shard_sizes']
+        self._shards = [None] * self._num_shards
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def write(embedding_object, directory, num_shards=16, dtype=np.float32):
+        """
+        Partitions an embedding object into num_shards binary files in directory (which is created if need be).
+        The vectors are streamed out one at a time, so only the embedding object itself needs to fit in memory;
+        embedding_object may also be a memory-mapped EmbeddingMatrix or another ShardedEmbeddingStore.
+        :param embedding_object: a dict or an EmbeddingMatrix (anything with iteritems or items)
+        :param directory:
+        :param num_shards:
+        :param dtype: see EmbeddingIO.BinaryEmbeddingWriter
+        :return: None
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        items = embedding_object.iteritems() if hasattr(embedding_object, 'iteritems') else embedding_object.items()
+        writers = None
+        shard_sizes = [0] * num_shards
+        dimensions = 0
+        for key, vector in items:
+            if writers is None:
+                dimensions = len(vector)
+                writers = [EmbeddingIO.BinaryEmbeddingWriter(ShardedEmbeddingStore._get_shard_file(directory, i),
+                                                             dimensions, dtype=dtype) for i in range(num_shards)]
+            shard = ShardedEmbeddingStore._get_shard(key, num_shards)
+            writers[shard].add(key, vector)
+            shard_sizes[shard] += 1
+        if writers is None:
+            raise Exception('Cannot build a sharded store from an empty embedding object!')
+        for writer in writers:
+            writer.close()
+        manifest = {'num_shards': num_shards, 'dimensions': dimensions, 'shard_sizes': shard_sizes}
+        with codecs.open(os.path.join(directory, _MANIFEST_FILE), 'w', 'utf-8') as out:
+            json.dump(manifest, out)
+
+    def __len__(self):
+        return sum(self._shard_sizes)
+
+    def __contains__(self, key):
+        return key in self._cache or key in self._open_shard(ShardedEmbeddingStore._get_shard(key, self._num_shards))
+
+    def __iter__(self):
+        for i in range(0, self._num_shards):
+            for key in self._open_shard(i).get_keys():
+                yield key
+
+    def __getitem__(self, key):
+        if key in self._cache:
+            self._hits += 1
+            Instrumentation.increment('ShardedEmbeddingStore.cache_hits')
+            vector = self._cache.pop(key)
+            self._cache[key] = vector   # move to the most recently used end
+            return vector
+        self._misses += 1
+        Instrumentation.increment('ShardedEmbeddingStore.cache_misses')
+        vector = np.array(self._open_shard(ShardedEmbeddingStore._get_shard(key, self._num_shards))[key])
+        if self._cache_size > 0:
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+            self._cache[key] = vector
+        return vector
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        else:
+            return default
+
+    def keys(self):
+        return list(iter(self))
+
+    def values(self):
+        return [vector for key, vector in self.iteritems()]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        """
+        Iterates over all the vectors, shard by shard. Bypasses (and does not disturb) the cache.
+        """
+        for i in range(0, self._num_shards):
+            for key, vector in self._open_shard(i).iteritems():
+                yield key, vector
+
+    def get_dimensions(self):
+        return self._dimensions
+
+    def get_cache_stats(self):
+        """
+        :return: a dict with the number of cache hits and misses (of [] lookups) so far, the hit rate and the
+        number of cached vectors
+        """
+        lookups = self._hits + self._misses
+        return {'hits': self._hits, 'misses': self._misses, 'size': len(self._cache),
+                'hit_rate': self._hits / float(lookups) if lookups else 0.0}
+
+    def reset_cache_stats(self):
+        self._hits = 0
+        self._misses = 0
+
+    def clear_cache(self):
+        self._cache = OrderedDict()
+
+    def _open_shard(self, shard):
+        if self._shards[shard] is None:
+            self._shards[shard] = EmbeddingIO.read_binary_embeddings(
+                ShardedEmbeddingStore._get_shard_file(self._directory, shard))
+        return self._shards[shard]
+
+    @staticmethod
+    def _get_shard(key, num_shards):
+        # crc32 rather than hash(), so that the assignment is the same in every process and python version
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % num_shards
+
+    @staticmethod
+    def _get_shard_file(directory, shard):
+        return os.path.join(directory, 'shard-%05d.bin' % shard)
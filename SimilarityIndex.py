@@ -0,0 +1,260 @@
+from EmbeddingMatrix import EmbeddingMatrix
+from QuantizedEmbeddingMatrix import QuantizedEmbeddingMatrix
+import VectorUtils
+import EmbeddingIO
+import numpy as np
+
+
+class ExactIndex:
+    """
+    Exact (brute-force) similarity search over an embedding object, vectorized with numpy. We store an
+    l2-normalized float32 copy of all the vectors, along with their non-zero element fractions, so that a query
+    is a single matrix-vector product followed by a partial sort, instead of a python loop over the vocabulary.
+
+    Scores are absolute cosine similarities, as in WordEmbedding.compute_abs_cosine_sim. The index is a snapshot;
+    if you modify the embedding object afterwards, build a new index.
+    """
+
+    def __init__(self, embedding_object, normalized=False):
+        """
+
+        :param embedding_object: a dict (e.g. as returned by the trainer) or an EmbeddingMatrix
+        :param normalized: if True, embedding_object must be an EmbeddingMatrix of l2-normalized float32 vectors
+        (e.g. as written out by save), and its matrix is used as is, without a copy. See load.
+        """
+        if normalized:
+            if not isinstance(embedding_object, EmbeddingMatrix) or embedding_object.get_matrix().dtype != np.float32:
+                raise Exception('A normalized index must be built from a float32 EmbeddingMatrix.')
+            self._keys = list(embedding_object.get_keys())
+            matrix = embedding_object.get_matrix()
+        elif isinstance(embedding_object, EmbeddingMatrix):
+            self._keys = list(embedding_object.get_keys())
+            matrix = np.array(embedding_object.get_matrix(), dtype=np.float32)
+        else:
+            self._keys = list(embedding_object.keys())
+            matrix = np.array([embedding_object[key] for key in self._keys], dtype=np.float32)
+        self._index = dict()
+        for i in range(0, len(self._keys)):
+            self._index[self._keys[i]] = i
+        self._non_zero_fractions = (matrix != 0).mean(axis=1)
+        if not normalized:
+            norms = np.sqrt((matrix * matrix).sum(axis=1))
+            norms[norms == 0.0] = 1.0   # zero vectors stay zero, and score 0.0 against everything
+            matrix /= norms[:, np.newaxis]
+        self._normalized_matrix = matrix
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get_keys(self):
+        return self._keys
+
+    def get_normalized_matrix(self):
+        return self._normalized_matrix
+
+    def get_non_zero_fractions(self):
+        return self._non_zero_fractions
+
+    def save(self, path):
+        """
+        Writes the normalized vectors out in the binary format of EmbeddingIO.
+        :param path:
+        :return: None
+        """
+        EmbeddingIO.write_binary_embeddings(EmbeddingMatrix.from_arrays(self._keys, self._normalized_matrix), path)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads an index written out by save. The normalized matrix is memory-mapped rather than read into memory,
+        so loading is fast, and processes that load the same file share a single copy of it.
+        :param path:
+        :return: an ExactIndex
+        """
+        return ExactIndex(EmbeddingIO.read_binary_embeddings(path), normalized=True)
+
+    def query_key(self, key, k=10, prune_threshold=1.0):
+        """
+        Retrieves the k keys most similar to key (not including key itself).
+        :param key: must be in the index
+        :param k:
+        :param prune_threshold: keys whose vectors have more than this fraction of non-zero elements are ignored.
+        :return: a list of (at most) k keys, most similar first
+        """
+        row = self._index[key]
+        return self.query_vector(self._get_query_vectors([row])[0], k=k, prune_threshold=prune_threshold,
+                                 exclude_rows=[row])
+
+    def query_vector(self, vector, k=10, prune_threshold=1.0, exclude_rows=None):
+        """
+        Retrieves the k keys most similar to an arbitrary vector.
+        :param vector: a list or numpy array. Need not be normalized.
+        :param k:
+        :param prune_threshold: see query_key
+        :param exclude_rows: rows of the index that should not be returned
+        :return: a list of (at most) k keys, most similar first
+        """
+        scores = self._score(np.asarray(vector, dtype=np.float32)[np.newaxis, :])[0]
+        if prune_threshold < 1.0:
+            scores[self._non_zero_fractions > prune_threshold] = -np.inf
+        if exclude_rows:
+            scores[exclude_rows] = -np.inf
+        return [self._keys[i] for i in VectorUtils.top_k_indices(scores, k)]
+
+    def query_keys_batch(self, keys, k=10, prune_threshold=1.0, max_block_elements=2**24):
+        """
+        Batch version of query_key. All the queries are scored with matrix-matrix products, one block of
+        queries at a time.
+        :param keys: a list of keys, all of which must be in the index
+        :param k:
+        :param prune_threshold: see query_key
+        :param max_block_elements: bounds the memory used for scoring. Each block of queries produces a
+        (block size x len(self)) score matrix with at most this many elements (2**24 float32s = 64 MB).
+        :return: a dict with each key referencing a list of (at most) k keys, most similar first
+        """
+        rows = [self._index[key] for key in keys]
+        results = self._query_batch(self._get_query_vectors(rows), k, prune_threshold, max_block_elements,
+                                    exclude_rows=rows)
+        answer = dict()
+        for i in range(0, len(keys)):
+            answer[keys[i]] = results[i]
+        return answer
+
+    def query_vectors_batch(self, vectors, k=10, prune_threshold=1.0, max_block_elements=2**24):
+        """
+        Batch version of query_vector.
+        :param vectors: a list of vectors, or a 2-d numpy array with one query per row. Need not be normalized.
+        :param k:
+        :param prune_threshold: see query_key
+        :param max_block_elements: see query_keys_batch
+        :return: a list with the i-th element holding the (at most) k keys most similar to the i-th vector
+        """
+        return self._query_batch(np.asarray(vectors, dtype=np.float32), k, prune_threshold, max_block_elements)
+
+    def _query_batch(self, query_matrix, k, prune_threshold, max_block_elements, exclude_rows=None):
+        block_size = max(1, max_block_elements / max(len(self._keys), 1))
+        pruned = None
+        if prune_threshold < 1.0:
+            pruned = self._non_zero_fractions > prune_threshold
+        results = list()
+        for start in range(0, query_matrix.shape[0], block_size):
+            block = query_matrix[start:start + block_size]
+            scores = self._score(block)
+            if pruned is not None:
+                scores[:, pruned] = -np.inf
+            if exclude_rows:
+                block_rows = np.arange(0, block.shape[0])
+                scores[block_rows, exclude_rows[start:start + block_size]] = -np.inf
+            for i in range(0, block.shape[0]):
+                results.append([self._keys[j] for j in VectorUtils.top_k_indices(scores[i], k)])
+        return results
+
+    def _score(self, query_matrix):
+        """
+        :param query_matrix: one (float32) query per row
+        :return: a (num queries x len(self)) float64 matrix of absolute cosine similarities (up to the norms of
+        the queries)
+        """
+        return np.abs(query_matrix.dot(self._normalized_matrix.T)).astype(np.float64)
+
+    def _get_query_vectors(self, rows):
+        return self._normalized_matrix[rows]
+
+
+class QuantizedIndex(ExactIndex):
+    """
+    Exact similarity search over quantized vectors (see QuantizedEmbeddingMatrix), with the same interface as
+    ExactIndex. The int8 (or int16) codes are scored directly: since cosine similarity does not depend on the
+    scale of a vector, we only need the norm of each row of codes, and the codes are converted to float32 one
+    block of rows at a time. The index thus takes a quarter (or half) of the memory of an ExactIndex.
+
+    Scores are slightly perturbed by the rounding, so results may differ from ExactIndex on near-ties; use
+    measure_recall to see how much. Random-indexing word vectors usually fit in int8 (or int16) exactly.
+    """
+
+    def __init__(self, embedding_object, dtype=np.int8, max_block_elements=2**24):
+        """
+
+        :param embedding_object: a QuantizedEmbeddingMatrix, which is used as is (e.g. memory-mapped), or any
+        other embedding object, which is quantized first
+        :param dtype: np.int8 (default) or np.int16. Only used if embedding_object needs to be quantized.
+        :param max_block_elements: the number of codes converted to float32 at a time, while scoring
+        """
+        if not isinstance(embedding_object, QuantizedEmbeddingMatrix):
+            embedding_object = QuantizedEmbeddingMatrix.quantize(embedding_object, dtype=dtype)
+        self._quantized_matrix = embedding_object
+        self._keys = list(embedding_object.get_keys())
+        self._index = dict()
+        for i in range(0, len(self._keys)):
+            self._index[self._keys[i]] = i
+        codes = embedding_object.get_codes()
+        self._block_size = max(1, max_block_elements / max(codes.shape[1], 1))
+        self._norms = np.zeros(len(self._keys), dtype=np.float32)
+        self._non_zero_fractions = np.zeros(len(self._keys), dtype=np.float64)
+        for start in range(0, len(self._keys), self._block_size):
+            block = codes[start:start + self._block_size].astype(np.float32)
+            self._norms[start:start + len(block)] = np.sqrt((block * block).sum(axis=1))
+            self._non_zero_fractions[start:start + len(block)] = (block != 0).mean(axis=1)
+        self._norms[self._norms == 0.0] = 1.0
+        self._normalized_matrix = None
+
+    def get_normalized_matrix(self):
+        raise Exception('A QuantizedIndex does not keep a normalized matrix; see get_quantized_matrix.')
+
+    def get_quantized_matrix(self):
+        return self._quantized_matrix
+
+    def save(self, path):
+        """
+        Writes the codes and scales out in the binary format of EmbeddingIO.
+        :param path:
+        :return: None
+        """
+        EmbeddingIO.write_binary_embeddings(self._quantized_matrix, path)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads an index written out by save, memory-mapping the codes.
+        :param path:
+        :return: a QuantizedIndex
+        """
+        return QuantizedIndex(EmbeddingIO.read_binary_embeddings(path))
+
+    def measure_recall(self, exact_index, query_keys, k=10):
+        """
+        Measures recall@k against float search i.e. the fraction of the true k nearest neighbours (as returned
+        by exact_index) that this index also returns, averaged over the queries.
+        :param exact_index: an ExactIndex over the original (float) vectors
+        :param query_keys: the keys to use as queries. Must be in both indexes.
+        :param k:
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        exact_results = exact_index.query_keys_batch(query_keys, k=k)
+        quantized_results = self.query_keys_batch(query_keys, k=k)
+        total = 0.0
+        count = 0
+        for key in query_keys:
+            truth = set(exact_results[key])
+            if not truth:
+                continue
+            total += len(truth & set(quantized_results[key])) / float(len(truth))
+            count += 1
+        if count == 0:
+            return 0.0
+        return total / count
+
+    def _score(self, query_matrix):
+        codes = self._quantized_matrix.get_codes()
+        scores = np.zeros((query_matrix.shape[0], len(self._keys)), dtype=np.float64)
+        for start in range(0, len(self._keys), self._block_size):
+            block = codes[start:start + self._block_size].astype(np.float32)
+            end = start + len(block)
+            scores[:, start:end] = np.abs(query_matrix.dot(block.T)) / self._norms[start:end]
+        return scores
+
+    def _get_query_vectors(self, rows):
+        return self._quantized_matrix.get_codes()[rows].astype(np.float32) / self._norms[rows][:, np.newaxis]
@@ -1,5 +1,6 @@
 # Use this module to do various things with vectors e.g. normalize them. We do not claim they are efficient.
 from sklearn.preprocessing import normalize
+import numpy as np
 import warnings
 
 
@@ -55,4 +56,32 @@ def non_zero_element_fraction(vector):
     for v in vector:
         if v != 0:
             num += 1.0
-    return num/len(vector)
\ No newline at end of file
+    return num/len(vector)
+
+
+def to_list(vector):
+    """
+    Converts a vector (e.g. a row of an EmbeddingMatrix, or a list holding numpy scalars) into a plain list of
+    python numbers, so that it can be written out with json.
+    :param vector:
+    :return: a list
+    """
+    return np.asarray(vector).tolist()
+
+
+def top_k_indices(scores, k):
+    """
+    Selects the indices of the k highest scores using a partial sort (argpartition), which is linear in the
+    number of scores, and then sorts only those k.
+    :param scores: a 1-d numpy array. Entries set to -np.inf are never returned.
+    :param k:
+    :return: a numpy array of (at most k) indices, in descending order of score
+    """
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    if k < len(scores):
+        indices = np.argpartition(-scores, k - 1)[0:k]
+    else:
+        indices = np.arange(len(scores))
+    indices = indices[np.argsort(-scores[indices], kind='mergesort')]
+    return indices[np.isfinite(scores[indices])]
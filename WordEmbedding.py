@@ -1,9 +1,14 @@
 from trainer import train_word_embeddings
 from VectorUtils import add_vectors
+from EmbeddingMatrix import EmbeddingMatrix
+from SimilarityIndex import ExactIndex, QuantizedIndex
+from QuantizedEmbeddingMatrix import QuantizedEmbeddingMatrix
 import math
-import VectorUtils
-import json
-import codecs
+from random import Random
+import EmbeddingIO
+import Instrumentation
+import numpy as np
+import time
 
 
 class WordEmbedding:
@@ -12,21 +17,24 @@ class WordEmbedding:
     at the word level
     """
 
-    def __init__(self, word_embedding_object=None, word_embedding_file=None):
+    def __init__(self, word_embedding_object=None, word_embedding_file=None, embedding_store='dict'):
         """
         if word_embedding_object is not None, word_embedding_file is ignored.
-        :param word_embedding_object:
-        :param word_embedding_file:
+        :param word_embedding_object: a dict, an EmbeddingMatrix or a ShardedEmbeddingStore (for embeddings that do
+        not fit in memory)
+        :param word_embedding_file: either a json lines file, or a binary file (see write_embeddings_to_binary_file),
+        which is memory-mapped rather than read into memory.
+        :param embedding_store: only used when reading from a json lines word_embedding_file. If 'matrix', the vectors
+        are stored in a (float32) EmbeddingMatrix rather than a dict of lists, which takes a fraction of the memory.
+        If 'quantized', they are stored in an (int8) QuantizedEmbeddingMatrix, which takes a quarter of that.
         """
         self._word_embedding_dict = dict()
+        self._exact_index = None
         if word_embedding_object:
             self._word_embedding_dict = word_embedding_object
         elif word_embedding_file:
-            with codecs.open(word_embedding_file, 'r', 'utf-8') as f:
-                for line in f:
-                    obj = json.loads(line)
-                    for k, v in obj.items():
-                        self._word_embedding_dict[k] = v
+            with Instrumentation.timer('WordEmbedding.load'):
+                self._word_embedding_dict = EmbeddingIO.read_embeddings(word_embedding_file, embedding_store)
         else:
             raise Exception('Expected either a word embeddings file or a word embeddings object!')
 
@@ -36,13 +44,60 @@ class WordEmbedding:
         :param output_file:
         :return: None
         """
-        out = codecs.open(output_file, 'w', 'utf-8')
-        for k, v in self._word_embedding_dict.items():
-            answer = dict()
-            answer[k] = v
-            json.dump(answer, out)
-            out.write('\n')
-        out.close()
+        with Instrumentation.timer('WordEmbedding.write'):
+            EmbeddingIO.write_jlines_embeddings(self._word_embedding_dict, output_file)
+
+    def write_embeddings_to_binary_file(self, output_file):
+        """
+        Writes the embeddings out in the binary format of EmbeddingIO, which loads much faster than json lines
+        and can be memory-mapped.
+        :param output_file:
+        :return: None
+        """
+        with Instrumentation.timer('WordEmbedding.write'):
+            EmbeddingIO.write_binary_embeddings(self._word_embedding_dict, output_file)
+
+    def write_embeddings_to_quantized_file(self, output_file, dtype=np.int8):
+        """
+        Like write_embeddings_to_binary_file, but the vectors are quantized (see QuantizedEmbeddingMatrix) to a
+        quarter (int8) or half (int16) of the size. Read the file back in as usual; it is memory-mapped, and
+        searched with a QuantizedIndex.
+        :param output_file:
+        :param dtype: np.int8 (default) or np.int16
+        :return: None
+        """
+        embeddings = self._word_embedding_dict
+        if not isinstance(embeddings, QuantizedEmbeddingMatrix):
+            embeddings = QuantizedEmbeddingMatrix.quantize(embeddings, dtype=dtype)
+        EmbeddingIO.write_binary_embeddings(embeddings, output_file)
+
+    def quantize(self, dtype=np.int8):
+        """
+        Replaces the embeddings by a QuantizedEmbeddingMatrix, to save memory. Similarity search then scores the
+        quantized vectors directly (see QuantizedIndex). Use measure_quantization_recall first, to see what
+        this costs in accuracy.
+        :param dtype: np.int8 (default) or np.int16
+        :return: None
+        """
+        if not isinstance(self._word_embedding_dict, QuantizedEmbeddingMatrix):
+            self._word_embedding_dict = QuantizedEmbeddingMatrix.quantize(self._word_embedding_dict, dtype=dtype)
+            self._exact_index = None
+
+    def measure_quantization_recall(self, dtype=np.int8, k=10, sample_size=100, seed=0):
+        """
+        Measures recall@k of search over the quantized vectors against search over the (float) vectors, over a
+        random sample of queries. The embeddings themselves are not modified.
+        :param dtype: np.int8 (default) or np.int16
+        :param k:
+        :param sample_size: number of queries
+        :param seed: seed for sampling the queries
+        :return: the recall, a float between 0.0 and 1.0
+        """
+        if isinstance(self._word_embedding_dict, QuantizedEmbeddingMatrix):
+            raise Exception('The embeddings are already quantized; there are no float vectors to compare to.')
+        keys = list(self._word_embedding_dict.keys())
+        sample = Random(seed).sample(keys, min(sample_size, len(keys)))
+        return QuantizedIndex(self._word_embedding_dict, dtype=dtype).measure_recall(self.build_index(), sample, k=k)
 
     def get_similar_words(self, words, k=10, prune_threshold=1.0, print_warning=True):
         """
@@ -56,6 +111,10 @@ class WordEmbedding:
         in embeddings dictionary. Disable at your own risk.
         :return: A list of k most similar words. A word may be 'multi-token' if you learned embeddings with max_n_grams
         > 1
+
+        The first call builds (and caches) an ExactIndex over the embeddings. All the words are then scored
+        together, with blocked matrix-matrix products, so passing many words in one call is far cheaper than
+        calling this function once per word. See build_index.
         """
         list_of_words = list()
         # print type(words)
@@ -68,17 +127,50 @@ class WordEmbedding:
                 return None
         else:
             list_of_words = words
-        results = dict()
+        seed_tokens = list()
         for seed_token in list_of_words:
             if seed_token not in self._word_embedding_dict:
                 if print_warning:
                     print 'Warning. Your word '+seed_token+' is not in the embeddings dictionary. Skipping word...'
                 continue
-            scored_dict = self._generate_scored_dict(seed_token, prune_threshold=prune_threshold)
-            results[seed_token] = WordEmbedding.extract_top_k(scored_dict, k=k)
+            seed_tokens.append(seed_token)
 
+        index = self.build_index()
+        start = time.time()
+        results = index.query_keys_batch(seed_tokens, k=k, prune_threshold=prune_threshold)
+        Instrumentation.add_time('WordEmbedding.query', time.time() - start, calls=len(seed_tokens))
+        return results
+
+    def get_similar_words_to_vectors(self, vectors, k=10, prune_threshold=1.0):
+        """
+        Like get_similar_words, but the queries are arbitrary vectors (e.g. as returned by get_vector for a
+        list of words). All queries are scored together, in memory-bounded blocks.
+        :param vectors: a list of vectors, or a 2-d numpy array with one query per row
+        :param k: Number of entries to retrieve per query.
+        :param prune_threshold: see get_similar_words
+        :return: a list, with the i-th element holding the k most similar words to the i-th vector
+        """
+        index = self.build_index()
+        start = time.time()
+        results = index.query_vectors_batch(vectors, k=k, prune_threshold=prune_threshold)
+        Instrumentation.add_time('WordEmbedding.query', time.time() - start, calls=len(vectors))
         return results
 
+    def build_index(self, rebuild=False):
+        """
+        Builds the (normalized, vectorized) index used by get_similar_words, if it has not been built already.
+        Call with rebuild=True if you modified the embeddings after the index was built.
+        :param rebuild:
+        :return: the ExactIndex (a QuantizedIndex, if the embeddings are quantized)
+        """
+        if self._exact_index is None or rebuild:
+            with Instrumentation.timer('WordEmbedding.build_index'):
+                if isinstance(self._word_embedding_dict, QuantizedEmbeddingMatrix):
+                    self._exact_index = QuantizedIndex(self._word_embedding_dict)
+                else:
+                    self._exact_index = ExactIndex(self._word_embedding_dict)
+        return self._exact_index
+
     def get_vector(self, words, print_warning=True):
         """
 
@@ -112,19 +204,6 @@ class WordEmbedding:
         else:
             return add_vectors(result)
 
-    def _generate_scored_dict(self, word, prune_threshold):
-        scored_dict = dict()
-        seed_vector = self._word_embedding_dict[word]
-        for token, vector in self._word_embedding_dict.items():
-            if token == word or VectorUtils.non_zero_element_fraction(vector) > prune_threshold:
-                continue
-            else:
-                score = WordEmbedding.compute_abs_cosine_sim(seed_vector, vector)
-                if score not in scored_dict:
-                    scored_dict[score] = list()
-                scored_dict[score].append(token)
-        return scored_dict
-
     @staticmethod
     def compute_abs_cosine_sim(vector1, vector2):
         if len(vector1) != len(vector2):
@@ -0,0 +1,201 @@
+"""
+Applies the models written out by trainer.train_annotation_models to new documents. For each document, every
+occurrence of a candidate word (e.g. each extracted city) gets a context vector, exactly as in training; the
+context vectors are normalized, reduced to the selected features and classified a chunk of documents at a time,
+so the feature model and the random forest are each called once per chunk rather than once per candidate. For
+example:
+    import annotator
+    annotator.annotate_file('pages.jl', 'scored-pages.jl', 'high_recall_readability_text', 'extracted_cities',
+                            'classification_model', 'feature_model', word_embedding_file='unigrams.jl',
+                            additional_params={'num_workers': 4})
+"""
+from collections import deque
+import trainer
+import EmbeddingIO
+import Instrumentation
+import TextUtils
+import VectorUtils
+import codecs
+import json
+import multiprocessing
+import numpy as np
+from sklearn.externals import joblib
+
+_worker_state = None    # set before forking the worker processes, see score_candidates
+
+
+def score_candidates(json_objects, text_attribute, candidate_attribute, classification_model_file,
+                     feature_model_file, word_embedding_object=None, word_embedding_file=None,
+                     additional_params=None):
+    """
+    Scores the candidates of each of a stream of documents.
+    :param json_objects: an iterable of json objects (dicts), e.g. parsed from a json lines file
+    :param text_attribute: the text field, as in train_annotation_models
+    :param candidate_attribute: the field with the list of candidate words (single- or multi-token) of a
+    document, like annotated_attribute in train_annotation_models
+    :param classification_model_file: as written out by train_annotation_models
+    :param feature_model_file: as written out by train_annotation_models
+    :param word_embedding_object: the word embedding object that the models were trained with
+    :param word_embedding_file: in case you wrote out the embedding to file (json lines or binary)
+    :param additional_params: A dictionary of additional parameters. We currently use the following keys, if
+    they exist:
+        tokenizer: must be the tokenizer the models were trained with. 'nltk' (default), 'regex' or a tokenizer
+        function; see TextUtils.get_tokenizer
+        chunk_size: the number of documents classified at a time (default 1000)
+        num_workers: if greater than 1 (default 1), the chunks are scored in this many processes. The workers
+        are forked after the models and the embedding are loaded, so they share them rather than copying them.
+        aggregate: how the scores of a candidate's occurrences are combined; 'max' (default) or 'mean'
+    :return: a generator that yields, for each object (in order), a dict with each candidate that has at least
+    one context vector referencing its score, the probability that it is correct. Candidates that do not occur in
+    the text (or only next to words without embeddings) are absent.
+    """
+    global _worker_state
+    if not word_embedding_object:
+        if word_embedding_file:
+            word_embedding_object = EmbeddingIO.read_embeddings(word_embedding_file)
+        else:
+            raise Exception('you have not trained/specified a word embedding...')
+    aggregate = trainer._get_param(additional_params, 'aggregate', 'max')
+    if aggregate not in ('max', 'mean'):
+        raise Exception('Unrecognized aggregate: ' + str(aggregate))
+    state = {'feature_model': joblib.load(feature_model_file),
+             'classification_model': joblib.load(classification_model_file),
+             'word_embedding_object': word_embedding_object, 'text_attribute': text_attribute,
+             'candidate_attribute': candidate_attribute, 'aggregate': aggregate,
+             'tokenizer': trainer._get_param(additional_params, 'tokenizer', 'nltk')}
+    chunk_size = trainer._get_param(additional_params, 'chunk_size', 1000)
+    num_workers = trainer._get_param(additional_params, 'num_workers', 1)
+    chunks = trainer._iterate_blocks(json_objects, chunk_size)
+    progress = Instrumentation.progress('annotator.score_candidates')
+    if num_workers <= 1:
+        for chunk in chunks:
+            for scores in _score_objects(chunk, state):
+                progress.update(documents=1, candidates=len(scores))
+                yield scores
+        progress.close()
+        return
+
+    _worker_state = state
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        # a bounded number of chunks in flight (for backpressure), collected in order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_score_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                for scores in pending.popleft().get():
+                    progress.update(documents=1, candidates=len(scores))
+                    yield scores
+        while pending:
+            for scores in pending.popleft().get():
+                progress.update(documents=1, candidates=len(scores))
+                yield scores
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_state = None
+    progress.close()
+
+
+def annotate_file(input_file, output_file, text_attribute, candidate_attribute, classification_model_file,
+                  feature_model_file, word_embedding_object=None, word_embedding_file=None, score_attribute=None,
+                  additional_params=None):
+    """
+    Scores the candidates in a json lines file (see score_candidates), and writes each object back out with the
+    scores added to it.
+    :param input_file: a json lines file
+    :param output_file: the json lines file to write
+    :param text_attribute:
+    :param candidate_attribute:
+    :param classification_model_file:
+    :param feature_model_file:
+    :param word_embedding_object:
+    :param word_embedding_file:
+    :param score_attribute: the field to add the scores to, a dict with each candidate referencing its score.
+    Defaults to candidate_attribute + '_scores'.
+    :param additional_params: see score_candidates
+    :return: None
+    """
+    if score_attribute is None:
+        score_attribute = candidate_attribute + '_scores'
+    # the objects are scored in order, so we only hold on to those that are in flight
+    buffered = deque()
+    with codecs.open(input_file, 'r', 'utf-8') as f, codecs.open(output_file, 'w', 'utf-8') as out:
+        for scores in score_candidates(_parse_and_buffer(f, buffered), text_attribute, candidate_attribute,
+                                       classification_model_file, feature_model_file, word_embedding_object,
+                                       word_embedding_file, additional_params):
+            obj = buffered.popleft()
+            obj[score_attribute] = scores
+            out.write(json.dumps(obj))
+            out.write('\n')
+
+
+def _parse_and_buffer(lines, buffered):
+    for line in lines:
+        obj = json.loads(line)
+        buffered.append(obj)
+        yield obj
+
+
+def _score_chunk(chunk):
+    """
+    For internal use only. Runs in a worker process.
+    """
+    return _score_objects(chunk, _worker_state)
+
+
+def _score_objects(json_objects, state):
+    """
+    For internal use only. Scores the candidates of a chunk of objects, with one call to each model.
+    :param json_objects: a list of json objects. They are not modified.
+    :param state: the models and parameters (see score_candidates)
+    :return: a list with a dict of candidate scores per object
+    """
+    text_attribute = state['text_attribute']
+    candidate_attribute = state['candidate_attribute']
+    blocks = list()
+    owners = list()     # (object, candidate) of each block
+    for i in range(0, len(json_objects)):
+        candidates = json_objects[i].get(candidate_attribute)
+        if not candidates:
+            continue
+        list_of_words, words = _preprocess_candidates(json_objects[i], text_attribute, candidates,
+                                                      state['tokenizer'])
+        context_vecs_dict = trainer._batch_context_generator(words, list_of_words, state['word_embedding_object'],
+                                                             tokenizer=state['tokenizer'])
+        seen = set()
+        for candidate, word in zip(candidates, words):
+            if word in context_vecs_dict and candidate not in seen:
+                seen.add(candidate)
+                blocks.append(context_vecs_dict[word])
+                owners.append((i, candidate))
+    answer = [dict() for obj in json_objects]
+    if not blocks:
+        return answer
+    features = state['feature_model'].transform(VectorUtils.normalize_matrix(np.vstack(blocks)))
+    model = state['classification_model']
+    probabilities = model.predict_proba(features)[:, list(model.classes_).index(1)]
+    start = 0
+    for k in range(0, len(blocks)):
+        scores = probabilities[start:start + len(blocks[k])]
+        start += len(blocks[k])
+        i, candidate = owners[k]
+        answer[i][candidate] = float(scores.max() if state['aggregate'] == 'max' else scores.mean())
+    return answer
+
+
+def _preprocess_candidates(obj, text_attribute, candidates, tokenizer):
+    """
+    For internal use only. Preprocesses an object's text and candidates the way trainer._preprocess_annotated_object
+    does for training, but touches only those two fields, so that other (e.g. numeric) fields are left alone.
+    :return: a tuple (list of lower-cased tokens of the text, list of lower-cased candidates). The list of tokens
+    is None if the object has no (or an empty) text.
+    """
+    if not obj.get(text_attribute):
+        return None, candidates
+    tokenized_field = TextUtils.tokenize_field(obj, text_attribute, tokenizer)
+    if not tokenized_field:
+        return None, candidates
+    return (TextUtils.preprocess_tokens(tokenized_field, options=["lower"]),
+            TextUtils.preprocess_tokens(candidates, options=["lower"]))
+
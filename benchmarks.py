@@ -0,0 +1,341 @@
+"""
+Benchmarks for the hot paths of this package. Unlike examples.py, these are meant to be run from the command line,
+and print out their results as json. For example:
+    python benchmarks.py tokenizers --input_file raw-lines.txt --max_lines 10000
+    python benchmarks.py suite --vocab_sizes 1000,10000 --dimensions 100,200 --output results.json
+    python benchmarks.py suite --output new.json --baseline results.json
+
+The suite runs on a seeded synthetic corpus (see generate_synthetic_corpus), so that results are comparable
+across machines and commits. Each benchmark runs in a fresh python interpreter, so that its peak RSS is its own.
+"""
+from WordEmbedding import WordEmbedding
+from DocEmbedding import DocEmbedding
+import EmbeddingIO
+import TextUtils
+import trainer
+import argparse
+import codecs
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from collections import Counter
+
+# for each metric reported by the suite, whether higher values are better
+_METRIC_DIRECTIONS = {'tokens_per_second': True, 'docs_per_second': True, 'seconds': False,
+                      'json_load_seconds': False, 'binary_load_seconds': False, 'index_build_seconds': False,
+                      'p50_ms': False, 'p99_ms': False, 'peak_rss_mb': False}
+
+
+def benchmark_tokenizers(lines, tokenizers=('nltk', 'regex'), reference='nltk'):
+    """
+    Times each tokenizer on the same (lower-cased) lines, as the trainers would tokenize them, and measures
+    how often each tokenizer agrees with the reference tokenizer.
+    :param lines: a list of lines
+    :param tokenizers: tokenizer names (or functions), see TextUtils.get_tokenizer
+    :param reference: the tokenizer to compare against. Must be in tokenizers.
+    :return: a dict with each tokenizer referencing a dict of measurements. For each tokenizer other than the
+    reference, speedup is relative to the reference, line_agreement is the fraction of lines that were tokenized
+    identically, and token_agreement is the fraction of tokens (counted as multisets, per line) they share.
+    """
+    lines = [line.lower() for line in lines]
+    tokenized = dict()
+    results = dict()
+    for tokenizer in tokenizers:
+        start = time.time()
+        tokenized[tokenizer] = TextUtils.tokenize_strings(lines, tokenizer)
+        elapsed = time.time() - start
+        num_tokens = sum(len(tokens) for tokens in tokenized[tokenizer])
+        results[str(tokenizer)] = {'seconds': elapsed, 'lines': len(lines), 'tokens': num_tokens,
+                                   'lines_per_second': len(lines) / max(elapsed, 1e-9),
+                                   'tokens_per_second': num_tokens / max(elapsed, 1e-9)}
+    for tokenizer in tokenizers:
+        if tokenizer == reference:
+            continue
+        identical_lines = 0
+        shared_tokens = 0
+        total_tokens = 0
+        for expected, actual in zip(tokenized[reference], tokenized[tokenizer]):
+            if expected == actual:
+                identical_lines += 1
+            shared_tokens += sum((Counter(expected) & Counter(actual)).values())
+            total_tokens += max(len(expected), len(actual))
+        result = results[str(tokenizer)]
+        result['speedup'] = results[str(reference)]['seconds'] / max(result['seconds'], 1e-9)
+        result['line_agreement'] = identical_lines / float(max(len(lines), 1))
+        result['token_agreement'] = shared_tokens / float(max(total_tokens, 1))
+    return results
+
+
+def generate_synthetic_corpus(num_lines, vocab_size, words_per_line=20, seed=0):
+    """
+    Generates lines of random words, with word frequencies following Zipf's law (the i-th most frequent word
+    is drawn with probability proportional to 1/i), as in natural text.
+    :param num_lines:
+    :param vocab_size: the number of distinct words (w0, w1...) that may be drawn
+    :param words_per_line:
+    :param seed: the same seed always generates the same corpus
+    :return: a list of lines (without newlines)
+    """
+    rng = np.random.RandomState(seed)
+    probabilities = 1.0 / np.arange(1, vocab_size + 1)
+    probabilities /= probabilities.sum()
+    word_ids = rng.choice(vocab_size, size=(num_lines, words_per_line), p=probabilities)
+    return [u' '.join([u'w' + unicode(i) for i in row]) for row in word_ids]
+
+
+def benchmark_train_word_embeddings(corpus_file, dimensions, tokenizer='regex'):
+    """
+    :return: a dict with the training time and throughput (in tokens per second)
+    """
+    num_tokens = 0
+    with codecs.open(corpus_file, 'r', 'utf-8') as f:
+        for line in f:
+            num_tokens += len(line.split())
+    start = time.time()
+    trainer.train_word_embeddings(corpus_file, dimensions=dimensions, additional_params={'tokenizer': tokenizer})
+    elapsed = time.time() - start
+    return {'seconds': elapsed, 'tokens_per_second': num_tokens / max(elapsed, 1e-9)}
+
+
+def benchmark_train_doc_embeddings(doc_file, word_embedding_file, tokenizer='regex'):
+    """
+    :return: a dict with the training time and throughput (in docs i.e. lines per second)
+    """
+    with codecs.open(doc_file, 'r', 'utf-8') as f:
+        num_docs = sum(1 for line in f)
+    word_embedding_object = EmbeddingIO.read_embeddings(word_embedding_file)
+    start = time.time()
+    trainer.train_doc_embeddings(doc_file, word_embedding_object, additional_params={'tokenizer': tokenizer})
+    elapsed = time.time() - start
+    return {'seconds': elapsed, 'docs_per_second': num_docs / max(elapsed, 1e-9)}
+
+
+def benchmark_load(json_file, binary_file):
+    """
+    :return: a dict with the time taken to load the same embedding from json lines and from the binary format
+    """
+    start = time.time()
+    WordEmbedding(word_embedding_file=json_file)
+    json_elapsed = time.time() - start
+    start = time.time()
+    WordEmbedding(word_embedding_file=binary_file)
+    binary_elapsed = time.time() - start
+    return {'json_load_seconds': json_elapsed, 'binary_load_seconds': binary_elapsed}
+
+
+def benchmark_queries(embedding_file, kind='word', num_queries=200, k=10, seed=0):
+    """
+    Issues num_queries single-key queries (get_similar_words or get_similar_docs), one at a time.
+    :return: a dict with the time to build the index (incurred by the first query) and the p50/p99 latencies
+    of the remaining queries, in milliseconds
+    """
+    if kind == 'word':
+        embedding = WordEmbedding(word_embedding_file=embedding_file)
+        query = embedding.get_similar_words
+        keys = embedding._word_embedding_dict.keys()
+    else:
+        embedding = DocEmbedding(doc_embedding_file=embedding_file)
+        query = embedding.get_similar_docs
+        keys = embedding._doc_embedding_dict.keys()
+    rng = np.random.RandomState(seed)
+    queries = [keys[i] for i in rng.randint(0, len(keys), size=num_queries + 1)]
+    start = time.time()
+    query(queries[0], k=k)
+    index_build_seconds = time.time() - start
+    latencies = list()
+    for q in queries[1:]:
+        start = time.time()
+        query(q, k=k)
+        latencies.append(1000.0 * (time.time() - start))
+    return {'index_build_seconds': index_build_seconds, 'p50_ms': float(np.percentile(latencies, 50)),
+            'p99_ms': float(np.percentile(latencies, 99))}
+
+
+def run_suite(vocab_sizes=(1000, 10000), dimensions_list=(100, 200), num_lines=20000, words_per_line=20,
+              tokenizer='regex', seed=0):
+    """
+    Runs every benchmark for every (vocab size, dimensions) combination, each in its own process.
+    :param vocab_sizes:
+    :param dimensions_list:
+    :param num_lines: lines in the synthetic corpus. The doc corpus uses the same lines, one doc per line.
+    :param words_per_line:
+    :param tokenizer: the tokenizer used by the trainers. 'regex' by default, since the corpus is synthetic.
+    :param seed: see generate_synthetic_corpus
+    :return: a dict with the configuration and a list of results (one per benchmark and combination)
+    """
+    folder = tempfile.mkdtemp()
+    results = list()
+    try:
+        for vocab_size in vocab_sizes:
+            lines = generate_synthetic_corpus(num_lines, vocab_size, words_per_line=words_per_line, seed=seed)
+            corpus_file = os.path.join(folder, 'corpus.txt')
+            doc_file = os.path.join(folder, 'docs.txt')
+            with codecs.open(corpus_file, 'w', 'utf-8') as out:
+                for line in lines:
+                    out.write(line + u'\n')
+            with codecs.open(doc_file, 'w', 'utf-8') as out:
+                for i in range(0, len(lines)):
+                    out.write(unicode(i) + u'\t' + lines[i] + u'\n')
+            for dimensions in dimensions_list:
+                word_json = os.path.join(folder, 'words.jl')
+                word_binary = os.path.join(folder, 'words.bin')
+                doc_binary = os.path.join(folder, 'docs.bin')
+                word_embedding_object = trainer.train_word_embeddings(corpus_file, output_file=word_json,
+                                            dimensions=dimensions, additional_params={'tokenizer': tokenizer})
+                EmbeddingIO.write_binary_embeddings(word_embedding_object, word_binary)
+                trainer.train_doc_embeddings(doc_file, word_embedding_object, output_file=doc_binary,
+                                             additional_params={'tokenizer': tokenizer, 'output_format': 'binary'})
+                del word_embedding_object
+                benchmarks = [('train_word_embeddings', benchmark_train_word_embeddings,
+                               (corpus_file, dimensions, tokenizer)),
+                              ('train_doc_embeddings', benchmark_train_doc_embeddings,
+                               (doc_file, word_binary, tokenizer)),
+                              ('load_word_embeddings', benchmark_load, (word_json, word_binary)),
+                              ('get_similar_words', benchmark_queries, (word_binary, 'word')),
+                              ('get_similar_docs', benchmark_queries, (doc_binary, 'doc'))]
+                for name, function, args in benchmarks:
+                    result = _run_isolated(function, args)
+                    result.update({'benchmark': name, 'vocab_size': vocab_size, 'dimensions': dimensions})
+                    results.append(result)
+                    print >> sys.stderr, json.dumps(result, sort_keys=True)
+    finally:
+        shutil.rmtree(folder)
+    config = {'vocab_sizes': list(vocab_sizes), 'dimensions': list(dimensions_list), 'num_lines': num_lines,
+              'words_per_line': words_per_line, 'tokenizer': tokenizer, 'seed': seed}
+    return {'config': config, 'results': results}
+
+
+def compare_to_baseline(suite_results, baseline_results, tolerance=0.1):
+    """
+    Compares two outputs of run_suite, benchmark by benchmark.
+    :param suite_results:
+    :param baseline_results:
+    :param tolerance: a metric has regressed if it is more than this fraction worse than in the baseline
+    :return: a list of dicts, one per metric present in both, with the baseline and current values, their ratio
+    (current/baseline) and whether the metric regressed.
+    """
+    baseline = dict()
+    for result in baseline_results['results']:
+        baseline[(result['benchmark'], result['vocab_size'], result['dimensions'])] = result
+    comparisons = list()
+    for result in suite_results['results']:
+        key = (result['benchmark'], result['vocab_size'], result['dimensions'])
+        if key not in baseline:
+            continue
+        for metric, higher_is_better in _METRIC_DIRECTIONS.items():
+            if metric not in result or metric not in baseline[key]:
+                continue
+            ratio = result[metric] / max(baseline[key][metric], 1e-9)
+            if higher_is_better:
+                regressed = ratio < 1.0 - tolerance
+            else:
+                regressed = ratio > 1.0 + tolerance
+            comparisons.append({'benchmark': key[0], 'vocab_size': key[1], 'dimensions': key[2], 'metric': metric,
+                                'baseline': baseline[key][metric], 'current': result[metric], 'ratio': ratio,
+                                'regressed': regressed})
+    return comparisons
+
+
+def _run_isolated(function, args):
+    """
+    Runs function(*args) in a fresh python interpreter, and adds the peak RSS of that process (in MB) to the
+    returned dict. A forked process would start out with the pages of this one (the corpus, the trained embeddings
+    etc.) and count them in its peak RSS; see _get_peak_rss_mb for why even a fresh interpreter has to be measured
+    with care.
+    :param function: a function of this module, returning a json-serializable dict
+    :param args: a tuple of json-serializable arguments
+    """
+    handle, result_file = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    code = 'import sys; sys.path.insert(0, %r); import benchmarks; benchmarks._isolated_main(sys.argv[1:])' % \
+           os.path.dirname(os.path.abspath(__file__))
+    try:
+        subprocess.check_call([sys.executable, '-c', code, function.__name__, json.dumps(args), result_file])
+        with open(result_file, 'r') as f:
+            return json.load(f)
+    finally:
+        os.remove(result_file)
+
+
+def _isolated_main(argv):
+    """
+    For internal use only. The entry point of the interpreter started by _run_isolated.
+    :param argv: the function name, its arguments (a json list) and the file to write the result (json) to
+    """
+    name, args, result_file = argv
+    result = globals()[name](*json.loads(args))
+    result['peak_rss_mb'] = _get_peak_rss_mb()
+    with open(result_file, 'w') as out:
+        json.dump(result, out)
+
+
+def _get_peak_rss_mb():
+    """
+    For internal use only. On linux, ru_maxrss survives exec, so in an interpreter started by a large process it
+    would include the memory of the forked copy of that process; VmHWM (the high water mark of the current address
+    space) does not. ru_maxrss is only used where /proc is not available.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0    # in KB
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0   # in KB on linux
+
+
+def _read_lines(input_file, max_lines):
+    lines = list()
+    with codecs.open(input_file, 'r', 'utf-8') as f:
+        for line in f:
+            if max_lines and len(lines) >= max_lines:
+                break
+            lines.append(line)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for fast-word-embeddings.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    tokenizers_parser = subparsers.add_parser('tokenizers', help='compare the regex tokenizer against nltk')
+    tokenizers_parser.add_argument('--input_file', required=True, help='a text file, one line per document')
+    tokenizers_parser.add_argument('--max_lines', type=int, default=10000)
+    suite_parser = subparsers.add_parser('suite', help='training, loading and query benchmarks')
+    suite_parser.add_argument('--vocab_sizes', default='1000,10000', help='comma-separated')
+    suite_parser.add_argument('--dimensions', default='100,200', help='comma-separated')
+    suite_parser.add_argument('--num_lines', type=int, default=20000)
+    suite_parser.add_argument('--tokenizer', default='regex')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--output', help='write the results (json) to this file')
+    suite_parser.add_argument('--baseline', help='compare against the results (json) in this file')
+    suite_parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    if args.benchmark == 'tokenizers':
+        results = benchmark_tokenizers(_read_lines(args.input_file, args.max_lines))
+        print json.dumps(results, indent=2, sort_keys=True)
+        return 0
+    results = run_suite(vocab_sizes=[int(x) for x in args.vocab_sizes.split(',')],
+                        dimensions_list=[int(x) for x in args.dimensions.split(',')], num_lines=args.num_lines,
+                        tokenizer=args.tokenizer, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            comparisons = compare_to_baseline(results, json.load(f), tolerance=args.tolerance)
+        results['comparison'] = comparisons
+    print json.dumps(results, indent=2, sort_keys=True)
+    if args.baseline and [c for c in results['comparison'] if c['regressed']]:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
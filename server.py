@@ -0,0 +1,482 @@
+"""
+A local similarity-query service for word or doc embeddings, over HTTP (TCP or a Unix socket). For example:
+    python server.py embeddings.bin --port 8000 --num_workers 4
+    curl 'localhost:8000/query?key=obama&k=5'
+    curl -d '{"keys": ["obama", "clinton"], "k": 5, "timeout": 0.5}' localhost:8000/query
+    curl -d '{"vectors": [[0.1, 0.2, ...]], "k": 5}' localhost:8000/query
+    curl localhost:8000/metrics
+
+The normalized vectors are written out once (as an ExactIndex, next to the embeddings file) and memory-mapped by
+every worker process, so the workers share a single copy in the page cache and start up almost instantly. Within
+a worker, concurrent requests are queued and scored together in micro-batches (see QueryBatcher), which is much
+cheaper than one scan of the vocabulary per request.
+
+Each request may set its own k (capped by --max_k) and timeout (in seconds); a request that is not answered in
+time gets a 504. Responses to key queries map each key to its most similar keys (or null, for a key that is not
+in the embeddings); responses to vector queries are lists, in query order.
+
+Python 2 has no asyncio, so the server is built from the standard library's threading HTTP server: a thread per
+connection in each of a number of forked worker processes.
+"""
+from SimilarityIndex import ExactIndex
+import EmbeddingIO
+import BaseHTTPServer
+import Queue
+import SocketServer
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import urlparse
+from collections import deque
+
+# per-worker counters, kept in shared memory so that any worker can report the totals
+_METRIC_FIELDS = ['requests', 'queries', 'timeouts', 'errors', 'batches', 'total_latency', 'max_latency']
+
+
+class QueryBatcher:
+    """
+    Coalesces concurrent queries into micro-batches. Request threads call query, which blocks until the
+    batching thread has answered (or the timeout expires). The batching thread waits for the first query, then
+    keeps collecting queries for at most max_wait seconds (or until it has max_batch_size of them), and scores
+    them all with a single call to ExactIndex.query_keys_batch (and/or query_vectors_batch). If a batched call
+    fails, its queries are answered one request at a time, so that the error only reaches the request at fault.
+    """
+
+    def __init__(self, index, max_batch_size=256, max_wait=0.002, prune_threshold=1.0):
+        """
+
+        :param index: an ExactIndex
+        :param max_batch_size: the maximum number of queries (keys or vectors, not requests) per batch
+        :param max_wait: the maximum time (in seconds) to wait for more queries once a batch has been started
+        :param prune_threshold: see ExactIndex.query_key
+        """
+        self._index = index
+        self._dimensions = index.get_normalized_matrix().shape[1]
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._prune_threshold = prune_threshold
+        self._queue = Queue.Queue()
+        self._num_batches = 0
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def query(self, keys=None, vectors=None, k=10, timeout=None):
+        """
+        :param keys: a list of keys, or None
+        :param vectors: a list of vectors, or None. Exactly one of keys and vectors must be given.
+        :param k:
+        :param timeout: in seconds, or None to wait indefinitely
+        :return: for keys, a dict with each key referencing a list of (at most) k keys, or None if the key is not
+        in the index; for vectors, a list of lists of keys. Returns None if the timeout expired.
+        """
+        job = _QueryJob(keys, vectors, k)
+        self._queue.put(job)
+        if not job.done.wait(timeout):
+            job.cancelled = True
+            return None
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def get_num_batches(self):
+        return self._num_batches
+
+    def get_dimensions(self):
+        return self._dimensions
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            size = jobs[0].size()
+            deadline = time.time() + self._max_wait
+            while size < self._max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self._queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                jobs.append(job)
+                size += job.size()
+            jobs = [job for job in jobs if not job.cancelled]
+            key_jobs = [job for job in jobs if job.keys is not None]
+            if key_jobs:
+                self._answer_separately_on_error(self._answer_keys, key_jobs)
+            vector_jobs = [job for job in jobs if job.vectors is not None]
+            if vector_jobs:
+                self._answer_separately_on_error(self._answer_vectors, vector_jobs)
+            for job in jobs:
+                job.done.set()
+            self._num_batches += 1
+
+    def _answer_separately_on_error(self, answer, jobs):
+        try:
+            answer(jobs)
+        except Exception as e:
+            if len(jobs) == 1:
+                jobs[0].error = e
+                return
+            for job in jobs:
+                try:
+                    answer([job])
+                except Exception as e:
+                    job.error = e
+
+    def _answer_keys(self, jobs):
+        keys = list(set(key for job in jobs for key in job.keys if key in self._index))
+        results = self._index.query_keys_batch(keys, k=max(job.k for job in jobs),
+                                               prune_threshold=self._prune_threshold)
+        for job in jobs:
+            job.result = dict()
+            for key in job.keys:
+                job.result[key] = results[key][0:job.k] if key in results else None
+
+    def _answer_vectors(self, jobs):
+        vectors = [vector for job in jobs for vector in job.vectors]
+        if not vectors:
+            results = list()
+        else:
+            results = self._index.query_vectors_batch(vectors, k=max(job.k for job in jobs),
+                                                      prune_threshold=self._prune_threshold)
+        start = 0
+        for job in jobs:
+            job.result = [result[0:job.k] for result in results[start:start + len(job.vectors)]]
+            start += len(job.vectors)
+
+
+class _QueryJob:
+    """
+    For internal use only. A request's queries, and (once done is set) its result.
+    """
+
+    def __init__(self, keys, vectors, k):
+        if (keys is None) == (vectors is None):
+            raise Exception('Expected either keys or vectors.')
+        self.keys = keys
+        self.vectors = vectors
+        self.k = k
+        self.done = threading.Event()
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def size(self):
+        return len(self.keys) if self.keys is not None else len(self.vectors)
+
+
+class QueryWorker:
+    """
+    The state of one worker process: the (memory-mapped) index, the batcher and the metrics.
+    """
+
+    def __init__(self, index_file, worker_id, shared_metrics, max_batch_size=256, max_wait=0.002, default_k=10,
+                 max_k=1000, default_timeout=5.0, prune_threshold=1.0):
+        """
+
+        :param index_file: written by ExactIndex.save
+        :param worker_id: the slot of this worker in shared_metrics
+        :param shared_metrics: a multiprocessing.Array of doubles with len(_METRIC_FIELDS) slots per worker
+        :param max_batch_size: see QueryBatcher
+        :param max_wait: see QueryBatcher
+        :param default_k: used if a request does not set k
+        :param max_k: the largest k a request may ask for
+        :param default_timeout: used if a request does not set a timeout (in seconds)
+        :param prune_threshold: see ExactIndex.query_key
+        """
+        self._batcher = QueryBatcher(ExactIndex.load(index_file), max_batch_size=max_batch_size, max_wait=max_wait,
+                                     prune_threshold=prune_threshold)
+        self._worker_id = worker_id
+        self._shared_metrics = shared_metrics
+        self._default_k = default_k
+        self._max_k = max_k
+        self._default_timeout = default_timeout
+        self._start_time = time.time()
+        self._recent_latencies = deque(maxlen=10000)
+        self._lock = threading.Lock()
+
+    def handle_query(self, request):
+        """
+        :param request: a dict with either 'keys' (a list, or a single key) or 'vectors', and optionally 'k'
+        and 'timeout'
+        :return: a tuple (HTTP status code, response dict). Malformed requests get a 400, and are not batched.
+        """
+        start = time.time()
+        try:
+            keys, vectors, k, timeout = self._parse_query(request)
+        except ValueError as e:
+            return self.reject(str(e), start)
+        try:
+            result = self._batcher.query(keys=keys, vectors=vectors, k=k, timeout=timeout)
+        except Exception as e:
+            self._record(start, 0, error=True)
+            return 500, {'error': str(e)}
+        num_queries = len(keys) if keys is not None else len(vectors)
+        if result is None:
+            self._record(start, num_queries, timed_out=True)
+            return 504, {'error': 'Timed out after ' + str(timeout) + ' seconds.'}
+        self._record(start, num_queries)
+        return 200, {'results': result}
+
+    def reject(self, message, start=None):
+        """
+        Counts a malformed request as an error.
+        :param message: what is wrong with the request
+        :param start: when the request arrived, if known
+        :return: a tuple (400, response dict)
+        """
+        self._record(start if start is not None else time.time(), 0, error=True)
+        return 400, {'error': message}
+
+    def get_metrics(self):
+        """
+        :return: a dict with the totals over all the workers (requests, throughput etc.), and latency
+        percentiles (in milliseconds) over the recent requests of this worker
+        """
+        num_fields = len(_METRIC_FIELDS)
+        totals = dict((field, 0.0) for field in _METRIC_FIELDS)
+        for i in range(0, len(self._shared_metrics) / num_fields):
+            for j in range(0, num_fields):
+                if _METRIC_FIELDS[j] == 'max_latency':
+                    totals['max_latency'] = max(totals['max_latency'], self._shared_metrics[i * num_fields + j])
+                else:
+                    totals[_METRIC_FIELDS[j]] += self._shared_metrics[i * num_fields + j]
+        uptime = time.time() - self._start_time
+        metrics = {'uptime_seconds': uptime, 'requests': int(totals['requests']), 'queries': int(totals['queries']),
+                   'timeouts': int(totals['timeouts']), 'errors': int(totals['errors']),
+                   'batches': int(totals['batches']),
+                   'requests_per_second': totals['requests'] / max(uptime, 1e-9),
+                   'queries_per_second': totals['queries'] / max(uptime, 1e-9),
+                   'mean_latency_ms': 1000.0 * totals['total_latency'] / max(totals['requests'], 1.0),
+                   'max_latency_ms': 1000.0 * totals['max_latency']}
+        with self._lock:
+            latencies = sorted(self._recent_latencies)
+        for percentile in (50, 90, 99):
+            name = 'worker_p' + str(percentile) + '_ms'
+            metrics[name] = 1000.0 * latencies[(len(latencies) - 1) * percentile / 100] if latencies else 0.0
+        metrics['worker_id'] = self._worker_id
+        return metrics
+
+    def _parse_query(self, request):
+        """
+        For internal use only. Checks a request (see handle_query), so that a malformed one cannot fail the batch
+        it would have joined.
+        :return: a tuple (keys, vectors, k, timeout), with one of keys and vectors None
+        """
+        if not isinstance(request, dict):
+            raise ValueError('Expected a json object.')
+        try:
+            k = int(request.get('k', self._default_k))
+        except (TypeError, ValueError):
+            raise ValueError('k must be an integer.')
+        if k <= 0:
+            raise ValueError('k must be positive.')
+        try:
+            timeout = float(request.get('timeout', self._default_timeout))
+        except (TypeError, ValueError):
+            raise ValueError('timeout must be a number (of seconds).')
+        if not timeout > 0:
+            raise ValueError('timeout must be positive.')
+        keys = request.get('keys')
+        if keys is not None and not isinstance(keys, list):
+            keys = [keys]
+        vectors = request.get('vectors')
+        if (keys is None) == (vectors is None):
+            raise ValueError('Expected either keys or vectors.')
+        if keys is not None:
+            for key in keys:
+                if not isinstance(key, basestring):
+                    raise ValueError('Keys must be strings.')
+        else:
+            dimensions = self._batcher.get_dimensions()
+            if not isinstance(vectors, list):
+                raise ValueError('vectors must be a list of vectors.')
+            for vector in vectors:
+                if not isinstance(vector, list) or len(vector) != dimensions:
+                    raise ValueError('Each vector must be a list of ' + str(dimensions) + ' numbers.')
+                for element in vector:
+                    if isinstance(element, bool) or not isinstance(element, (int, long, float)):
+                        raise ValueError('Each vector must be a list of ' + str(dimensions) + ' numbers.')
+        return keys, vectors, min(k, self._max_k), timeout
+
+    def _record(self, start, num_queries, timed_out=False, error=False):
+        latency = time.time() - start
+        offset = self._worker_id * len(_METRIC_FIELDS)
+        with self._lock:
+            values = {'requests': 1, 'queries': num_queries, 'timeouts': int(timed_out), 'errors': int(error),
+                      'total_latency': latency}
+            for j in range(0, len(_METRIC_FIELDS)):
+                if _METRIC_FIELDS[j] in values:
+                    self._shared_metrics[offset + j] += values[_METRIC_FIELDS[j]]
+            max_index = offset + _METRIC_FIELDS.index('max_latency')
+            self._shared_metrics[max_index] = max(self._shared_metrics[max_index], latency)
+            self._shared_metrics[offset + _METRIC_FIELDS.index('batches')] = self._batcher.get_num_batches()
+            self._recent_latencies.append(latency)
+
+
+class _QueryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    For internal use only. GET /query?key=...&key=...&k=...&timeout=..., POST /query (json body) and
+    GET /metrics.
+    """
+
+    protocol_version = 'HTTP/1.1'   # keep-alive
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        worker = self.server.worker
+        if url.path == '/metrics':
+            self._respond(200, worker.get_metrics())
+        elif url.path == '/query':
+            params = urlparse.parse_qs(url.query)
+            request = {'keys': [key.decode('utf-8') for key in params.get('key', list())]}
+            for name in ('k', 'timeout'):
+                if name in params:
+                    request[name] = params[name][0]
+            self._respond(*worker.handle_query(request))
+        else:
+            self._respond(404, {'error': 'Unknown path: ' + url.path})
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/query':
+            self._respond(404, {'error': 'Unknown path: ' + url.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        except ValueError:
+            self._respond(*self.server.worker.reject('Expected a json body.'))
+            return
+        self._respond(*self.server.worker.handle_query(request))
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        pass    # one line per request on stderr is far too much at our request rates
+
+    def _respond(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def build_index_file(embedding_file, index_file):
+    """
+    Writes out the normalized vectors of an embeddings file (in either format) as an ExactIndex.
+    :param embedding_file:
+    :param index_file:
+    :return: None
+    """
+    ExactIndex(EmbeddingIO.read_embeddings(embedding_file)).save(index_file)
+
+
+def serve(index_file, host='127.0.0.1', port=8000, unix_socket=None, num_workers=1, **worker_params):
+    """
+    Serves queries until interrupted. The listening socket is created once, and shared by num_workers forked
+    worker processes, each of which memory-maps index_file.
+    :param index_file: written by build_index_file (or ExactIndex.save)
+    :param host:
+    :param port:
+    :param unix_socket: if not None, listen on this Unix socket path instead of host:port
+    :param num_workers: the number of worker processes. With 1, we serve from the current process.
+    :param worker_params: passed on to QueryWorker (max_batch_size, max_wait, default_k, max_k, default_timeout,
+    prune_threshold)
+    :return: None
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(unix_socket)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+    listener.listen(128)
+    listener.setblocking(0)     # the workers race to accept; the losers just go back to waiting
+    shared_metrics = multiprocessing.Array('d', num_workers * len(_METRIC_FIELDS), lock=False)
+    children = list()
+    try:
+        if num_workers == 1:
+            _run_worker(listener, unix_socket, index_file, 0, shared_metrics, worker_params)
+        for worker_id in range(0, num_workers):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                try:
+                    _run_worker(listener, unix_socket, index_file, worker_id, shared_metrics, worker_params)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+def _run_worker(listener, unix_socket, index_file, worker_id, shared_metrics, worker_params):
+    server_class = _ThreadingUnixServer if unix_socket else _ThreadingTCPServer
+    server = server_class(listener.getsockname(), _QueryRequestHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = listener
+    server.worker = QueryWorker(index_file, worker_id, shared_metrics, **worker_params)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local similarity-query server for fast-word-embeddings.')
+    parser.add_argument('embedding_file', help='word or doc embeddings, in json lines or binary format')
+    parser.add_argument('--index_file', help='where to keep the normalized vectors (default: embedding_file.index);'
+                                             ' built if missing or older than embedding_file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', help='listen on this Unix socket path instead of host:port')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_wait_ms', type=float, default=2.0)
+    parser.add_argument('--default_k', type=int, default=10)
+    parser.add_argument('--max_k', type=int, default=1000)
+    parser.add_argument('--default_timeout', type=float, default=5.0, help='in seconds')
+    parser.add_argument('--prune_threshold', type=float, default=1.0)
+    args = parser.parse_args()
+    index_file = args.index_file or args.embedding_file + '.index'
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(args.embedding_file):
+        build_index_file(args.embedding_file, index_file)
+    try:
+        serve(index_file, host=args.host, port=args.port, unix_socket=args.unix_socket, num_workers=args.num_workers,
+              max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000.0, default_k=args.default_k,
+              max_k=args.max_k, default_timeout=args.default_timeout, prune_threshold=args.prune_threshold)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import annotator
+import trainer
+import codecs
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+
+class AnnotatorTest(unittest.TestCase):
+
+    def setUp(self):
+        r = random.Random(3)
+        self.directory = tempfile.mkdtemp()
+        self.embeddings = dict(('w%d' % i, [r.randint(-5, 5) for _ in range(32)]) for i in range(30))
+        annotated_file = os.path.join(self.directory, 'annotated.jl')
+        with codecs.open(annotated_file, 'w', 'utf-8') as out:
+            for i in range(0, 100):
+                words = ['w%d' % r.randint(0, 40) for _ in range(30)]
+                candidates = list(set(words[:6]))
+                out.write(json.dumps({'text': ' '.join(words), 'cands': candidates, 'correct': candidates[:1]}))
+                out.write('\n')
+        self.classification_model_file = os.path.join(self.directory, 'classification_model')
+        self.feature_model_file = os.path.join(self.directory, 'feature_model')
+        trainer.train_annotation_models(annotated_file, 'text', 'cands', 'correct', self.embeddings,
+                                        self.classification_model_file, self.feature_model_file,
+                                        additional_params={'tokenizer': 'regex'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _score(self, json_objects):
+        return list(annotator.score_candidates(json_objects, 'text', 'cands', self.classification_model_file,
+                                               self.feature_model_file, self.embeddings,
+                                               additional_params={'tokenizer': 'regex'}))
+
+    def test_non_string_fields(self):
+        obj = {'text': 'w1 w2 W3 w4 w5', 'cands': ['W3'], 'timestamp': 12345, 'crawled': True, 'parent': None}
+        scores = self._score([obj, dict(obj, text=None)])
+        self.assertEqual(['W3'], scores[0].keys())
+        self.assertEqual(dict(), scores[1])
+        self.assertEqual({'text': 'w1 w2 W3 w4 w5', 'cands': ['W3'], 'timestamp': 12345, 'crawled': True,
+                          'parent': None}, obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
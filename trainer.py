@@ -3,75 +3,803 @@ import codecs
 import json
 import re
 import VectorUtils
-from random import shuffle
+import EmbeddingIO
+import Instrumentation
+import Phrases
+import Queue
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import struct
+import tempfile
+import threading
+from collections import deque, OrderedDict
+from random import shuffle, Random
 import numpy as np
+import scipy.sparse
+import scipy.special
+from EmbeddingMatrix import EmbeddingMatrix
 from sklearn.externals import joblib
 from sklearn.feature_selection import f_classif, SelectKBest
 from sklearn.ensemble import RandomForestClassifier
 
+# the maximum number of sorted runs merged at a time (see _write_spilled_doc_vectors)
+_MAX_RUNS_PER_MERGE = 128
+
 
 def train_word_embeddings(input_file, output_file=None, max_n_grams=1, dimensions=200, percent_non_zero=0.01,
                           additional_params=None):
     """
     A modular, lightweight word-embeddings trainer. The trainer is case-insensitive.
-    At present, the implementation scans through the file twice, although it's possible to re-implement this algorithm
-    so that we only need one pass. The latter is more useful for streaming data.
+    Each word's context vector is generated deterministically from a seeded hash of the word, so it can be
+    recomputed at any time, and runs with the same seed produce compatible spaces.
+    By default, the implementation scans through the file twice (once to build the vocabulary, once to train).
+    If the single_pass parameter is set (or input_file is not a path), we only make one pass, generating each word's
+    context vector the first time we see it. The latter is more useful for streaming data e.g. lines arriving over
+    a pipe. Both give the same result.
     :param input_file: an ordinary text file. We analyze the file at the level of tokens (using tokenizer functions
     in TextUtils). A new line represents a boundary i.e. the file is best thought of as a 'bag' (not 'list') of lines.
-    :param output_file: If not None, write out the word embedding object in json lines format
-    :param max_n_grams: learns embeddings for words up to this many token n-grams. At present only supported for
-    unigrams (i.e. =1)
+    You can also pass in any iterable of lines (e.g. sys.stdin), in which case we train in single-pass mode.
+    :param output_file: If not None, write out the word embedding object in json lines (or binary) format
+    :param max_n_grams: learns embeddings for words and for phrases (frequent n-grams, see Phrases.PhraseDetector)
+    of up to this many tokens. A phrase's key is its tokens joined by single spaces e.g. 'new york'. Phrases get
+    hashed context vectors like words, and accumulate the context vectors of the words around them; they are not
+    themselves used as context, so the word embeddings are the same as with max_n_grams=1.
+    Phrases are detected during the vocabulary pass. In single-pass (or parallel) mode with a path, we make one
+    extra pass over the file to detect them; with an iterable of lines, pass in the phrases (see below).
     :param dimensions: the number of dimensions in the embedding. We found 200 to work well in many of our experiments
     :param percent_non_zero: the number of non-zero elements in each context vector. Change at your own risk.
-    :param additional_params: A dictionary of additional parameters. Currently only uses the context_window_size
-    parameter, if one exists.
-    :return: the word embedding object, which is a dict, with a word referencing its embedding.
+    :param additional_params: A dictionary of additional parameters. We currently use the following keys, if
+    they exist:
+        context_window_size (default 2)
+        single_pass: if True, train in one pass over the input (default False, unless input_file is not a path)
+        seed: the seed used for hashing words into context vectors (default 0). Runs with the same seed generate
+        the same context vectors.
+        embedding_store: 'dict' (default) or 'matrix'. If 'matrix', the embeddings are kept in an (int32)
+        EmbeddingMatrix rather than a dict of lists, which takes a fraction of the memory.
+        output_format: 'json' (default) or 'binary'. The format of output_file; see EmbeddingIO.
+        tokenizer: 'nltk' (default), 'regex' (much faster, see TextUtils.regex_tokenize_string) or a tokenizer
+        function. With num_workers > 1, a function must be picklable (i.e. defined at the top level of a module).
+        num_workers: if greater than 1 (default 1), input_file (which must be a path) is split into this many
+        byte ranges on line boundaries, each range is trained in its own process and the results are summed.
+        Since context vectors are hashed from the seed, the result is identical to a single-pass run.
+        tokenizer_workers: if greater than 1 (default 1), and num_workers is not, lines are tokenized in this many
+        processes while the main process trains on the tokens of earlier lines (see _pipelined_map). The result
+        is the same. As with num_workers, a tokenizer function must be picklable.
+        tokenization_cache: a TextUtils.TokenizationCache, or the maximum number of lines to cache in a new one.
+        Repeated lines are then only tokenized once (while they are in the cache). Call get_stats on the cache for
+        its hit rate; if instrumentation is enabled, hits and misses are also counted there.
+        duplicate_lines: what to do with exact duplicate lines; 'keep' (default) trains on every copy, 'skip'
+        ignores lines that are in the tokenization cache (i.e. repeats of recently seen lines; a cache of 100000
+        lines is used if none is given), and 'weight' trains once on each distinct line of each block of 10000
+        lines, weighted by its number of copies. 'weight' gives the same result as 'keep', with less work.
+        Neither tokenization_cache nor duplicate_lines can be combined with num_workers or tokenizer_workers.
+        metadata_file: if set, we write the parameters needed to regenerate the context vectors (seed, dimensions
+        etc.) to this (json) file. Pass it to update_word_embeddings to train the embedding further on new text.
+        context_vector_file: if set, we also write the context vectors of all words to this file, in compact
+        sparse form (see EmbeddingIO.write_context_vectors). Since they can always be regenerated from the seed,
+        this is only needed by consumers that cannot (or should not) recompute them.
+        phrases: only used if max_n_grams > 1. The phrases to learn embeddings for, rather than detecting them:
+        a Phrases.PhraseMatcher, a Phrases.PhraseDetector that has already seen the text, or a path written by
+        PhraseMatcher.save.
+        phrase_min_count (default 5), phrase_threshold (default 10.0) and phrase_capacity (default 100000): see
+        Phrases.PhraseDetector. Only used if the phrases are detected here.
+    :return: the word embedding object, which is a dict (or EmbeddingMatrix), with a word referencing its embedding.
     """
-    if additional_params and 'context_window_size' in additional_params:
-        context_window_size = additional_params['context_window_size']
+    context_window_size = _get_param(additional_params, 'context_window_size', 2)
+    embedding_store = _get_param(additional_params, 'embedding_store', 'dict')
+    tokenizer = _get_param(additional_params, 'tokenizer', 'nltk')
+    if max_n_grams < 1:
+        raise Exception('max_n_grams must be at least 1.')
+    num_workers = _get_param(additional_params, 'num_workers', 1)
+    single_pass = _get_param(additional_params, 'single_pass', False) or not isinstance(input_file, basestring)
+    metadata_file = _get_param(additional_params, 'metadata_file', None)
+    context_vector_file = _get_param(additional_params, 'context_vector_file', None)
+    seed = _get_param(additional_params, 'seed', 0)
+    tokenizer_workers = _get_param(additional_params, 'tokenizer_workers', 1)
+    duplicate_lines = _get_param(additional_params, 'duplicate_lines', 'keep')
+    cache = _get_tokenization_cache(additional_params, duplicate_lines)
+    if (cache is not None or duplicate_lines != 'keep') and num_workers > 1:
+        raise Exception('Parallel training (num_workers > 1) cannot use tokenization_cache or duplicate_lines.')
+    context_vector_dict = None
+    phrase_matcher = None
+    phrase_detector = None
+    if max_n_grams > 1:
+        phrases = _get_param(additional_params, 'phrases', None)
+        if phrases is not None:
+            phrase_matcher = _get_phrase_matcher(phrases)
+        elif single_pass or num_workers > 1:
+            if not isinstance(input_file, basestring):
+                raise Exception('Phrases cannot be detected in a single pass; please pass them in as phrases.')
+            with Instrumentation.timer('trainer.phrase_pass'):
+                phrase_detector = _new_phrase_detector(max_n_grams, additional_params)
+                for list_of_tokens, weight in _tokenize_weighted_lines(_iterate_lines(input_file), tokenizer,
+                                                    tokenizer_workers, cache, duplicate_lines):
+                    phrase_detector.update(list_of_tokens, weight)
+                phrase_matcher = phrase_detector.get_matcher()
+        else:
+            phrase_detector = _new_phrase_detector(max_n_grams, additional_params)
+    if num_workers > 1:
+        if not isinstance(input_file, basestring):
+            raise Exception('Parallel training (num_workers > 1) requires input_file to be a path.')
+        with Instrumentation.timer('trainer.parallel_training'):
+            word_embeddings_obj = _train_word_embeddings_parallel(input_file, num_workers, dimensions,
+                                    percent_non_zero, context_window_size, seed, embedding_store, tokenizer,
+                                    phrase_matcher)
+    elif single_pass:
+        weighted_lists_of_tokens = _tokenize_weighted_lines(_iterate_lines(input_file), tokenizer, tokenizer_workers,
+                                                            cache, duplicate_lines)
+        context_vector_dict = dict()
+        with Instrumentation.timer('trainer.training_pass'):
+            word_embeddings_obj = _train_word_embeddings_single_pass(weighted_lists_of_tokens, dimensions,
+                                    percent_non_zero, context_window_size, seed, embedding_store,
+                                    context_vector_dict=context_vector_dict, phrase_matcher=phrase_matcher)
     else:
-        context_window_size = 2
-    if max_n_grams != 1:
-        raise Exception('At present, we only support unigram embeddings. Please set to 1, or use default.')
-    set_of_words = set()
-    with codecs.open(input_file, 'r', 'utf-8') as f:
-        for line in f:
-            set_of_words = set_of_words.union(set(TextUtils.tokenize_string(line.lower())))
-    context_vector_dict = _generate_context_vectors(set_of_words, d=dimensions, non_zero_ratio=percent_non_zero)
-    word_embeddings_obj = _init_word_embeddings_obj(context_vector_dict)
-    with codecs.open(input_file, 'r', 'utf-8') as f:
-        for line in f:
-            list_of_tokens = TextUtils.tokenize_string(line.lower())
-            v = list_of_tokens
-            for i in range(0, len(v)):  # iterate over token list
-                token = v[i]
-                if token not in word_embeddings_obj:
-                    continue
-                min = i - context_window_size
-                if min < 0:
-                    min = 0
-                max = i + context_window_size
-                if max > len(v):
-                    max = len(v)
-                for j in range(min, max):   # iterate over context
-                    if j == i:
-                        continue
-                    context_token = v[j]
-                    if context_token not in context_vector_dict:
-                        continue
-                    word_embeddings_obj[token] = VectorUtils.add_vectors([word_embeddings_obj[token],
-                                                                          context_vector_dict[context_token]])
+        set_of_words = set()
+        with Instrumentation.timer('trainer.vocabulary_pass'):
+            for list_of_tokens, weight in _tokenize_weighted_lines(_iterate_lines(input_file), tokenizer,
+                                                                   tokenizer_workers, cache, duplicate_lines):
+                set_of_words.update(list_of_tokens)
+                if phrase_detector is not None:
+                    phrase_detector.update(list_of_tokens, weight)
+            if phrase_detector is not None and phrase_matcher is None:
+                phrase_matcher = phrase_detector.get_matcher()
+            context_vector_dict = _generate_context_vectors(set_of_words, d=dimensions,
+                                                            non_zero_ratio=percent_non_zero, seed=seed)
+        word_embeddings_obj = _init_word_embeddings_obj(context_vector_dict, dimensions, embedding_store)
+        with Instrumentation.timer('trainer.training_pass'):
+            progress = Instrumentation.progress('trainer.train_word_embeddings')
+            instrumented = Instrumentation.is_enabled()
+            for list_of_tokens, weight in _tokenize_weighted_lines(_iterate_lines(input_file), tokenizer,
+                                                                   tokenizer_workers, cache, duplicate_lines):
+                _accumulate_context_vectors(list_of_tokens, word_embeddings_obj, context_vector_dict,
+                                            context_window_size, weight)
+                if phrase_matcher is not None:
+                    num_phrases = _accumulate_phrase_vectors(list_of_tokens, phrase_matcher, word_embeddings_obj,
+                                        context_vector_dict, dimensions, percent_non_zero, context_window_size, seed,
+                                        weight=weight)
+                    if instrumented:
+                        progress.update(phrases=num_phrases * weight)
+                if instrumented:
+                    progress.update(lines=weight, tokens=len(list_of_tokens) * weight,
+                                    pairs=_count_context_pairs(len(list_of_tokens), context_window_size) * weight)
+            progress.close()
     if output_file:
-        out = codecs.open(output_file, 'w', 'utf-8')
-        for k, v in word_embeddings_obj.items():
-            answer = dict()
-            answer[k] = v
-            json.dump(answer, out)
-            out.write('\n')
-        out.close()
+        with Instrumentation.timer('trainer.write'):
+            EmbeddingIO.write_embeddings(word_embeddings_obj, output_file,
+                                         _get_param(additional_params, 'output_format', 'json'))
+    if metadata_file:
+        _write_model_metadata(metadata_file, dimensions, percent_non_zero, context_window_size, seed, tokenizer,
+                              phrase_matcher)
+    if context_vector_file:
+        if context_vector_dict is None:
+            context_vector_dict = _generate_context_vectors(word_embeddings_obj.keys(), d=dimensions,
+                                                            non_zero_ratio=percent_non_zero, seed=seed)
+        EmbeddingIO.write_context_vectors(context_vector_dict, context_vector_file, dimensions)
+    return word_embeddings_obj
+
+
+def update_word_embeddings(input_file, word_embedding_file, metadata_file, output_file=None, additional_params=None):
+    """
+    Trains an existing word embedding further on new text, without retraining on the old text. Since random
+    indexing is additive and the context vectors are regenerated from the seed in metadata_file, the result is
+    exactly what train_word_embeddings would have returned on the old text followed by the new text. Words
+    that were never seen before get new embeddings.
+    :param input_file: the new text; a path or an iterable of lines (see train_word_embeddings)
+    :param word_embedding_file: the existing embedding (json lines or binary), as written by train_word_embeddings
+    :param metadata_file: the metadata_file written by train_word_embeddings for this embedding
+    :param output_file: where to write the updated embedding (in the format of word_embedding_file). If None,
+    word_embedding_file is replaced.
+    :param additional_params: A dictionary of additional parameters. We currently use the following keys, if
+    they exist:
+        tokenizer: only needed if the embedding was trained with a tokenizer function rather than a name
+        tokenizer_workers, tokenization_cache and duplicate_lines: see train_word_embeddings
+        context_vector_file: context vectors written out by train_word_embeddings (see context_vector_file
+        there). If set, these are used for the words they cover, rather than regenerating them from the seed;
+        new words still get hashed context vectors.
+    The phrases (if any) in metadata_file are trained further too; no new phrases are detected.
+    :return: the updated word embedding object
+    """
+    with codecs.open(metadata_file, 'r', 'utf-8') as f:
+        metadata = json.load(f)
+    tokenizer = _get_param(additional_params, 'tokenizer', metadata['tokenizer'])
+    if tokenizer is None:
+        raise Exception('The embedding was trained with a tokenizer function; please pass it in as tokenizer.')
+    word_embeddings_obj = EmbeddingIO.read_embeddings(word_embedding_file)
+    if isinstance(word_embeddings_obj, EmbeddingMatrix):    # copy the (read-only) memory-mapped vectors
+        word_embeddings_obj = EmbeddingMatrix.from_arrays(word_embeddings_obj.get_keys(),
+                                                          np.array(word_embeddings_obj.get_matrix()))
+        output_format = 'binary'
+    else:
+        output_format = 'json'
+    context_vector_dict = dict()
+    context_vector_file = _get_param(additional_params, 'context_vector_file', None)
+    if context_vector_file:
+        context_vector_dict, dimensions = EmbeddingIO.read_context_vectors(context_vector_file)
+        if dimensions != metadata['dimensions']:
+            raise Exception('The context vectors do not match the dimensions of the embedding.')
+    phrase_matcher = None
+    if metadata.get('phrases'):
+        phrase_matcher = Phrases.PhraseMatcher(metadata['phrases'], metadata['max_n_grams'])
+    duplicate_lines = _get_param(additional_params, 'duplicate_lines', 'keep')
+    weighted_lists_of_tokens = _tokenize_weighted_lines(_iterate_lines(input_file), tokenizer,
+                                    _get_param(additional_params, 'tokenizer_workers', 1),
+                                    _get_tokenization_cache(additional_params, duplicate_lines), duplicate_lines)
+    _train_word_embeddings_single_pass(weighted_lists_of_tokens, metadata['dimensions'], metadata['percent_non_zero'],
+                                       metadata['context_window_size'], metadata['seed'],
+                                       word_embeddings_obj=word_embeddings_obj,
+                                       context_vector_dict=context_vector_dict, phrase_matcher=phrase_matcher)
+    if not output_file:
+        output_file = word_embedding_file
+    temporary_file = output_file + '.tmp'
+    EmbeddingIO.write_embeddings(word_embeddings_obj, temporary_file, output_format)
+    os.rename(temporary_file, output_file)   # never leave a half-written embedding behind
+    return word_embeddings_obj
+
+
+def _write_model_metadata(metadata_file, dimensions, percent_non_zero, context_window_size, seed, tokenizer,
+                          phrase_matcher=None):
+    """
+    For internal use only. Writes out everything that update_word_embeddings needs to regenerate the context
+    vectors and process new text the same way.
+    """
+    metadata = {'dimensions': dimensions, 'percent_non_zero': percent_non_zero,
+                'context_window_size': context_window_size, 'seed': seed,
+                'tokenizer': tokenizer if isinstance(tokenizer, basestring) else None}
+    if phrase_matcher is not None:
+        metadata['max_n_grams'] = phrase_matcher.get_max_n_grams()
+        metadata['phrases'] = sorted(phrase_matcher.get_phrases())
+    with codecs.open(metadata_file, 'w', 'utf-8') as out:
+        json.dump(metadata, out)
+
+
+def _train_word_embeddings_single_pass(weighted_lists_of_tokens, dimensions, percent_non_zero, context_window_size,
+                                       seed, embedding_store='dict', include_context_vectors=True,
+                                       word_embeddings_obj=None, context_vector_dict=None, phrase_matcher=None):
+    """
+    For internal use only. Trains the embeddings in one pass over the (tokenized) lines. A word's context vector
+    (and its initial embedding) is created the first time we see the word; since the vector is derived from a hash
+    of the word, the result is the same as for a two-pass run that uses the same hashed context vectors.
+    :param weighted_lists_of_tokens: an iterable of (list of tokens, weight) tuples, one per line (or per distinct
+    line, weighted by its number of copies), e.g. from _tokenize_weighted_lines
+    :param dimensions:
+    :param percent_non_zero:
+    :param context_window_size:
+    :param seed: see _generate_hashed_sparse_vector
+    :param embedding_store: 'dict' or 'matrix'
+    :param include_context_vectors: if False, each embedding starts at zero rather than at the word's own
+    context vector i.e. we only return the accumulated context. Used when training shards in parallel.
+    :param word_embeddings_obj: if not None, we continue training this (previously trained) object in place,
+    rather than starting a new one. Must have been trained with the same seed.
+    :param context_vector_dict: if not None, the context vectors of the words seen so far. New words are added
+    to it (so the caller can persist them). Words in it must already be in word_embeddings_obj.
+    :param phrase_matcher: if not None, a Phrases.PhraseMatcher; we also train embeddings for its phrases
+    :return: the word embedding object
+    """
+    if context_vector_dict is None:
+        context_vector_dict = dict()
+    if word_embeddings_obj is None:
+        word_embeddings_obj = _new_embeddings_obj(dimensions, embedding_store)
+    progress = Instrumentation.progress('trainer.train_word_embeddings')
+    instrumented = Instrumentation.is_enabled()
+    num_context_vectors = len(context_vector_dict)
+    for list_of_tokens, weight in weighted_lists_of_tokens:
+        for token in list_of_tokens:
+            if token not in context_vector_dict:
+                context_vector_dict[token] = _generate_hashed_sparse_indices(token, dimensions, percent_non_zero,
+                                                                             seed)
+                if token in word_embeddings_obj:
+                    continue
+                elif include_context_vectors:
+                    word_embeddings_obj[token] = _densify_sparse_vector(context_vector_dict[token], dimensions)
+                else:
+                    word_embeddings_obj[token] = [0]*dimensions
+        _accumulate_context_vectors(list_of_tokens, word_embeddings_obj, context_vector_dict, context_window_size,
+                                    weight)
+        if phrase_matcher is not None:
+            num_phrases = _accumulate_phrase_vectors(list_of_tokens, phrase_matcher, word_embeddings_obj,
+                                context_vector_dict, dimensions, percent_non_zero, context_window_size, seed,
+                                include_context_vectors, weight)
+            if instrumented:
+                progress.update(phrases=num_phrases * weight)
+        if instrumented:
+            progress.update(lines=weight, tokens=len(list_of_tokens) * weight,
+                            pairs=_count_context_pairs(len(list_of_tokens), context_window_size) * weight)
+    if instrumented:
+        # every token occurrence looks up its context vector; the first occurrence of a word is a miss
+        misses = len(context_vector_dict) - num_context_vectors
+        Instrumentation.increment('trainer.context_vector_cache_misses', misses)
+        Instrumentation.increment('trainer.context_vector_cache_hits', progress.get_counts().get('tokens', 0) - misses)
+    progress.close()
     return word_embeddings_obj
 
 
+def _train_word_embeddings_parallel(input_file, num_workers, dimensions, percent_non_zero, context_window_size, seed,
+                                    embedding_store='dict', tokenizer='nltk', phrase_matcher=None):
+    """
+    For internal use only. Random indexing is additive, so we can train each byte range of the file in a separate
+    process (with the same seeded context vectors) and sum up the accumulated context vectors.
+    :param input_file: a path
+    :param num_workers: number of processes (and byte ranges)
+    :param dimensions:
+    :param percent_non_zero:
+    :param context_window_size:
+    :param seed:
+    :param embedding_store: 'dict' or 'matrix'
+    :param tokenizer: see TextUtils.get_tokenizer. Must be picklable.
+    :param phrase_matcher: if not None, a Phrases.PhraseMatcher; we also train embeddings for its phrases
+    :return: the word embedding object
+    """
+    tasks = list()
+    for start, end in _compute_byte_ranges(input_file, num_workers):
+        tasks.append((input_file, start, end, dimensions, percent_non_zero, context_window_size, seed, tokenizer,
+                      phrase_matcher))
+    merged = EmbeddingMatrix(dimensions, dtype=np.int32)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for keys, matrix in pool.imap(_train_byte_range, tasks):
+            for key in keys:
+                if key not in merged:
+                    merged[key] = _densify_sparse_vector(_generate_hashed_sparse_indices(key, dimensions,
+                                                                            percent_non_zero, seed), dimensions)
+            rows = [merged.get_row_index(key) for key in keys]
+            merged.get_matrix()[rows] += matrix
+    finally:
+        pool.close()
+        pool.join()
+    if embedding_store == 'dict':
+        return merged.to_dict()
+    else:
+        return merged
+
+
+def _train_byte_range(task):
+    """
+    For internal use only. Runs in a worker process. Trains on the lines in one byte range of the input file.
+    :param task: a tuple (input_file, start, end, dimensions, percent_non_zero, context_window_size, seed,
+    tokenizer, phrase_matcher)
+    :return: a tuple (list of words and phrases, int32 matrix of accumulated context vectors, one row per key)
+    """
+    input_file, start, end, dimensions, percent_non_zero, context_window_size, seed, tokenizer, phrase_matcher = task
+    weighted_lists_of_tokens = _tokenize_weighted_lines(_iterate_byte_range(input_file, start, end), tokenizer)
+    accumulated = _train_word_embeddings_single_pass(weighted_lists_of_tokens, dimensions,
+                        percent_non_zero, context_window_size, seed, 'matrix', include_context_vectors=False,
+                        phrase_matcher=phrase_matcher)
+    return accumulated.get_keys(), accumulated.get_matrix()
+
+
+def _compute_byte_ranges(input_file, num_ranges):
+    """
+    For internal use only. Splits the file into (roughly) equal byte ranges, making sure that each range
+    starts at the beginning of a line.
+    :param input_file: a path
+    :param num_ranges: the maximum number of ranges. There may be fewer if the file is small.
+    :return: a list of (start, end) byte offsets
+    """
+    size = os.path.getsize(input_file)
+    boundaries = [0]
+    with open(input_file, 'rb') as f:
+        for i in range(1, num_ranges):
+            f.seek(max(size * i / num_ranges - 1, 0))
+            f.readline()    # move to the start of the next line
+            boundary = f.tell()
+            if boundaries[-1] < boundary < size:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return [(boundaries[i], boundaries[i+1]) for i in range(0, len(boundaries) - 1)]
+
+
+def _iterate_byte_range(input_file, start, end):
+    """
+    For internal use only. Yields the (unicode) lines that start within [start, end) of the file. Lines are split
+    the same way as codecs.open would split them, so that a byte range yields the same lines as _iterate_lines.
+    :param input_file: a path
+    :param start: must be the start of a line
+    :param end:
+    :return: a generator of lines
+    """
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            for sub_line in line.decode('utf-8').splitlines(True):
+                yield sub_line
+
+
+def _accumulate_context_vectors(list_of_tokens, word_embeddings_obj, context_vector_dict, context_window_size,
+                                weight=1):
+    """
+    For internal use only. Adds the context vectors of each token's neighbours (within the window) to the
+    token's embedding. word_embeddings_obj is modified in place; since the context vectors are sparse, each
+    (token, context) pair only touches the non-zero positions of the context vector.
+    :param list_of_tokens: the tokens of a single line
+    :param word_embeddings_obj:
+    :param context_vector_dict: a dict with words referencing sparse context vectors
+    :param context_window_size:
+    :param weight: the number of times the line occurs i.e. the context vectors are added weight times
+    :return: None
+    """
+    v = list_of_tokens
+    for i in range(0, len(v)):  # iterate over token list
+        token = v[i]
+        if token not in word_embeddings_obj:
+            continue
+        embedding = word_embeddings_obj[token]
+        min = i - context_window_size
+        if min < 0:
+            min = 0
+        max = i + context_window_size
+        if max > len(v):
+            max = len(v)
+        for j in range(min, max):   # iterate over context
+            if j == i:
+                continue
+            context_token = v[j]
+            if context_token not in context_vector_dict:
+                continue
+            _add_sparse_vector(embedding, context_vector_dict[context_token], weight)
+
+
+def _accumulate_phrase_vectors(list_of_tokens, phrase_matcher, word_embeddings_obj, context_vector_dict, dimensions,
+                               percent_non_zero, context_window_size, seed, include_context_vectors=True, weight=1):
+    """
+    For internal use only. The phrase counterpart of _accumulate_context_vectors: adds the context vectors of the
+    tokens within the window on either side of each phrase occurrence to the phrase's embedding. A phrase's own
+    context vector (and initial embedding) is created the first time we see it, as for words in
+    _train_word_embeddings_single_pass.
+    :param list_of_tokens: the tokens of a single line
+    :param phrase_matcher: a Phrases.PhraseMatcher
+    :param word_embeddings_obj:
+    :param context_vector_dict: a dict with words (and phrases) referencing sparse context vectors
+    :param dimensions:
+    :param percent_non_zero:
+    :param context_window_size:
+    :param seed:
+    :param include_context_vectors: see _train_word_embeddings_single_pass
+    :param weight: see _accumulate_context_vectors
+    :return: the number of phrase occurrences in the line
+    """
+    v = list_of_tokens
+    spans = phrase_matcher.find(v)
+    for start, end, phrase in spans:
+        if phrase not in context_vector_dict:
+            context_vector_dict[phrase] = _generate_hashed_sparse_indices(phrase, dimensions, percent_non_zero, seed)
+            if phrase not in word_embeddings_obj:
+                if include_context_vectors:
+                    word_embeddings_obj[phrase] = _densify_sparse_vector(context_vector_dict[phrase], dimensions)
+                else:
+                    word_embeddings_obj[phrase] = [0]*dimensions
+        embedding = word_embeddings_obj[phrase]
+        # the same (asymmetric) window as a unigram, with the phrase standing in for a single token
+        for j in range(max(start - context_window_size, 0), min(end - 1 + context_window_size, len(v))):
+            if start <= j < end:
+                continue
+            context_token = v[j]
+            if context_token not in context_vector_dict:
+                continue
+            _add_sparse_vector(embedding, context_vector_dict[context_token], weight)
+    return len(spans)
+
+
+def _get_phrase_matcher(phrases):
+    """
+    For internal use only.
+    :param phrases: a Phrases.PhraseMatcher, a Phrases.PhraseDetector or a path written by PhraseMatcher.save
+    :return: a Phrases.PhraseMatcher
+    """
+    if isinstance(phrases, Phrases.PhraseMatcher):
+        return phrases
+    elif isinstance(phrases, Phrases.PhraseDetector):
+        return phrases.get_matcher()
+    elif isinstance(phrases, basestring):
+        return Phrases.PhraseMatcher.load(phrases)
+    else:
+        raise Exception('Unsupported phrases parameter; pass a PhraseMatcher, a PhraseDetector or a path.')
+
+
+def _new_phrase_detector(max_n_grams, additional_params):
+    return Phrases.PhraseDetector(max_n_grams, min_count=_get_param(additional_params, 'phrase_min_count', 5),
+                                  threshold=_get_param(additional_params, 'phrase_threshold', 10.0),
+                                  capacity=_get_param(additional_params, 'phrase_capacity', 100000))
+
+
+def _count_context_pairs(num_tokens, context_window_size):
+    """
+    For internal use only (instrumentation). The number of (token, context) pairs that
+    _accumulate_context_vectors visits in a line of num_tokens tokens.
+    """
+    total = 0
+    for i in range(0, num_tokens):
+        total += min(i + context_window_size, num_tokens) - max(i - context_window_size, 0) - 1
+    return total
+
+
+def _iterate_lines(input_file):
+    """
+    For internal use only. Yields unicode lines from either a path or an iterable of lines (e.g. an open file,
+    sys.stdin or a list of strings).
+    :param input_file: a path, or an iterable of lines
+    :return: a generator of lines
+    """
+    if isinstance(input_file, basestring):
+        with codecs.open(input_file, 'r', 'utf-8') as f:
+            for line in f:
+                yield line
+    else:
+        for line in input_file:
+            if isinstance(line, str):
+                line = line.decode('utf-8')
+            yield line
+
+
+def _tokenize_lines(lines, tokenizer='nltk', num_workers=1):
+    """
+    For internal use only. Lower-cases and tokenizes each line.
+    :param lines: an iterable of lines
+    :param tokenizer: see TextUtils.get_tokenizer
+    :param num_workers: if greater than 1, the lines are tokenized in a pool of this many processes (see
+    _pipelined_map). tokenizer must then be picklable.
+    :return: a generator with one list of tokens per line, in order
+    """
+    if num_workers > 1:
+        return _pipelined_map(_tokenize_line_batch, lines, (tokenizer,), num_workers)
+    tokenize = TextUtils.get_tokenizer(tokenizer)
+    return (tokenize(line.lower()) for line in lines)
+
+
+def _tokenize_weighted_lines(lines, tokenizer='nltk', num_workers=1, cache=None, duplicate_lines='keep',
+                             block_size=10000):
+    """
+    For internal use only. Like _tokenize_lines, but with a weight per list of tokens, and optionally a
+    tokenization cache.
+    :param lines: an iterable of lines
+    :param tokenizer: see TextUtils.get_tokenizer
+    :param num_workers: see _tokenize_lines. Cannot be combined with cache or duplicate_lines.
+    :param cache: if not None, a TextUtils.TokenizationCache
+    :param duplicate_lines: see train_word_embeddings. With 'skip', the cache is cleared first, so that every pass
+    over the same lines skips the same lines.
+    :param block_size: with duplicate_lines='weight', the number of lines in which we look for duplicates
+    :return: a generator of (list of tokens, weight) tuples
+    """
+    if cache is None and duplicate_lines == 'keep':
+        return ((list_of_tokens, 1) for list_of_tokens in _tokenize_lines(lines, tokenizer, num_workers))
+    if num_workers > 1:
+        raise Exception('tokenizer_workers cannot be combined with tokenization_cache or duplicate_lines.')
+    tokenize = TextUtils.get_tokenizer(tokenizer)
+    if duplicate_lines == 'skip':
+        cache.clear()
+    return ((list_of_tokens, weight) for line, list_of_tokens, weight in
+            _iterate_weighted_tokens((line.lower() for line in lines), tokenize, cache, duplicate_lines, block_size))
+
+
+def _iterate_weighted_tokens(strings, tokenize, cache, duplicate_lines, block_size):
+    """
+    For internal use only. See _tokenize_weighted_lines and _tokenize_doc_lines.
+    :param strings: an iterable of (lower-cased) lines
+    :param tokenize: a tokenizer function
+    :param cache: a TextUtils.TokenizationCache, or None (unless duplicate_lines is 'skip')
+    :param duplicate_lines: 'keep', 'skip' or 'weight'
+    :param block_size:
+    :return: a generator of (string, tokenize(string), weight) tuples
+    """
+    if duplicate_lines == 'weight':
+        for block in _iterate_blocks(strings, block_size):
+            counts = dict()
+            distinct_strings = list()   # in order of first occurrence
+            for string in block:
+                if string in counts:
+                    counts[string] += 1
+                else:
+                    counts[string] = 1
+                    distinct_strings.append(string)
+            for string in distinct_strings:
+                if cache is None:
+                    yield string, tokenize(string), counts[string]
+                else:
+                    yield string, cache.tokenize(string, tokenize), counts[string]
+    elif duplicate_lines == 'skip':
+        for string in strings:
+            tokens, is_duplicate = cache.lookup(string, tokenize)
+            if not is_duplicate:
+                yield string, tokens, 1
+    elif duplicate_lines == 'keep':
+        for string in strings:
+            if cache is None:
+                yield string, tokenize(string), 1
+            else:
+                yield string, cache.tokenize(string, tokenize), 1
+    else:
+        raise Exception('Unrecognized duplicate_lines: ' + str(duplicate_lines))
+
+
+def _get_tokenization_cache(additional_params, duplicate_lines='keep'):
+    """
+    For internal use only.
+    :return: the tokenization_cache in additional_params (a TextUtils.TokenizationCache, created if it is given
+    as a size), a new one if duplicate_lines is 'skip', or None
+    """
+    cache = _get_param(additional_params, 'tokenization_cache', None)
+    if isinstance(cache, (int, long)):
+        cache = TextUtils.TokenizationCache(cache)
+    if cache is None and duplicate_lines == 'skip':
+        cache = TextUtils.TokenizationCache()
+    return cache
+
+
+def _tokenize_line_batch(lines, tokenizer):
+    """
+    For internal use only. Runs in a worker process (see _tokenize_lines).
+    """
+    tokenize = TextUtils.get_tokenizer(tokenizer)
+    return [tokenize(line.lower()) for line in lines]
+
+
+def _tokenize_doc_lines(lines, tokenizer='nltk', num_workers=1, cache=None, duplicate_lines='keep',
+                        block_size=10000):
+    """
+    For internal use only. The train_doc_embeddings counterpart of _tokenize_weighted_lines. The cache is keyed
+    by the text after the doc_id, so that boilerplate repeated across docs is only tokenized once; duplicate lines,
+    on the other hand, are recognized by the whole line, so only lines that repeat both the doc_id and the text
+    count as duplicates. With 'skip', the most recent cache.get_max_size() distinct lines are remembered.
+    :param lines: an iterable of tab-delimited lines (see train_doc_embeddings)
+    :param tokenizer: see TextUtils.get_tokenizer
+    :param num_workers: see _tokenize_weighted_lines
+    :param cache: see _tokenize_weighted_lines
+    :param duplicate_lines: see _tokenize_weighted_lines
+    :param block_size: see _tokenize_weighted_lines
+    :return: a generator with a tuple (lower-cased doc_id, list of tokens, weight) per line, in order
+    """
+    if cache is None and duplicate_lines == 'keep':
+        if num_workers > 1:
+            tokenized_lines = _pipelined_map(_tokenize_doc_line_batch, lines, (tokenizer,), num_workers)
+        else:
+            tokenize = TextUtils.get_tokenizer(tokenizer)
+            tokenized_lines = (_split_doc_line(line, tokenize) for line in lines)
+        return ((doc_id, list_of_tokens, 1) for doc_id, list_of_tokens in tokenized_lines)
+    if num_workers > 1:
+        raise Exception('tokenizer_workers cannot be combined with tokenization_cache or duplicate_lines.')
+    tokenize = TextUtils.get_tokenizer(tokenizer)
+
+    def tokenize_text(line):
+        text = ' '.join(re.split('\t', line)[1:])
+        return tokenize(text) if cache is None else cache.tokenize(text, tokenize)
+
+    lower_cased_lines = (line.lower() for line in lines)
+    if duplicate_lines == 'skip':
+        tokenized_lines = ((line, tokenize_text(line), 1) for line in
+                           _skip_recent_duplicates(lower_cased_lines, cache.get_max_size()))
+    else:
+        tokenized_lines = _iterate_weighted_tokens(lower_cased_lines, tokenize_text, None, duplicate_lines,
+                                                   block_size)
+    return ((re.split('\t', line)[0], list_of_tokens, weight) for line, list_of_tokens, weight in tokenized_lines)
+
+
+def _skip_recent_duplicates(strings, max_size):
+    """
+    For internal use only. Drops each string that repeats one of the max_size most recently seen distinct strings
+    (the strings that a TokenizationCache of that size would hold; see _iterate_weighted_tokens).
+    :param strings: an iterable of strings
+    :param max_size:
+    :return: a generator of the strings that are not recent repeats, in order
+    """
+    recent = OrderedDict()  # md5 of each string, least recently seen first
+    for string in strings:
+        key = hashlib.md5(string.encode('utf-8')).digest()
+        if recent.pop(key, None) is not None:
+            recent[key] = True  # move to the most recently seen end
+            continue
+        if max_size > 0:
+            if len(recent) >= max_size:
+                recent.popitem(last=False)
+            recent[key] = True
+        yield string
+
+
+def _tokenize_doc_line_batch(lines, tokenizer):
+    """
+    For internal use only. Runs in a worker process (see _tokenize_doc_lines).
+    """
+    tokenize = TextUtils.get_tokenizer(tokenizer)
+    return [_split_doc_line(line, tokenize) for line in lines]
+
+
+def _split_doc_line(line, tokenize):
+    fields = re.split('\t', line.lower())
+    return fields[0], tokenize(' '.join(fields[1:]))
+
+
+def _pipelined_map(function, items, args=(), num_workers=2, batch_size=1000, max_pending_batches=None):
+    """
+    For internal use only. Applies function to batches of items in a pool of num_workers processes, as a
+    three-stage pipeline: a reader thread pulls items (e.g. lines from a file) into batches, the pool processes
+    the batches (e.g. tokenizes them), and the caller consumes the results (e.g. trains on them) while the next
+    batches are being processed. Results come out in the order of the items, so the caller sees exactly what a
+    serial loop would produce. Only max_pending_batches batches are ever queued or in flight, so the reader
+    waits (rather than filling memory) when the caller falls behind.
+    :param function: a picklable (i.e. top-level) function taking a list of items (and args), and returning a
+    list with one result per item
+    :param items: an iterable
+    :param args: a tuple of extra (picklable) arguments to function
+    :param num_workers:
+    :param batch_size: the number of items per batch
+    :param max_pending_batches: defaults to 2*num_workers
+    :return: a generator of results, one per item
+    """
+    if max_pending_batches is None:
+        max_pending_batches = 2 * num_workers
+    batches = Queue.Queue(maxsize=max_pending_batches)
+    stop = threading.Event()
+    pool = multiprocessing.Pool(num_workers)    # fork before starting the reader thread
+    reader = threading.Thread(target=_read_batches, args=(items, batch_size, batches, stop))
+    reader.daemon = True
+    reader.start()
+    try:
+        pending = deque()
+        done = False
+        while True:
+            while not done and len(pending) < max_pending_batches:
+                kind, value = batches.get()
+                if kind == 'batch':
+                    pending.append(pool.apply_async(function, (value,) + tuple(args)))
+                elif kind == 'error':
+                    raise value[0], value[1], value[2]
+                else:
+                    done = True
+            if not pending:
+                break
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        stop.set()
+        pool.terminate()
+        pool.join()
+
+
+def _read_batches(items, batch_size, batches, stop):
+    """
+    For internal use only. The reader stage of _pipelined_map; runs in its own thread.
+    """
+    try:
+        for batch in _iterate_blocks(items, batch_size):
+            if not _put_unless_stopped(batches, ('batch', batch), stop):
+                return
+        _put_unless_stopped(batches, ('end', None), stop)
+    except Exception:
+        _put_unless_stopped(batches, ('error', sys.exc_info()), stop)
+
+
+def _put_unless_stopped(queue, message, stop):
+    while not stop.is_set():
+        try:
+            queue.put(message, timeout=0.1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+
+def _get_param(additional_params, name, default):
+    """
+    For internal use only. Looks up name in the additional_params dictionary (which may be None).
+    :param additional_params:
+    :param name:
+    :param default: returned if the parameter is not there
+    :return: the parameter value
+    """
+    if additional_params and name in additional_params:
+        return additional_params[name]
+    else:
+        return default
+
+
 def train_doc_embeddings(input_file, word_embedding_object, output_file=None, word_embedding_file=None,
                          word_blacklist=None, additional_params=None):
     """
@@ -84,63 +812,417 @@ def train_doc_embeddings(input_file, word_embedding_object, output_file=None, wo
     :param input_file: A tab-delimited file with the first field being the doc-id and the second field holding
     the tokens. The second field itself may contain tabs. doc_ids may occur in multiple lines; we will consider
     the union of all constituent words.
+    You can also pass in any iterable of such lines.
     :param word_embedding_object: the object that was returned by train_word_embeddings. More generally, this is
     simply a dict with words referencing vectors. You can use this code with other embeddings also.
-    :param word_embedding_file: If you want to read the embeddings from a file.
+    :param word_embedding_file: If you want to read the embeddings from a file (json lines or binary).
     :param word_blacklist: typically stop-words. Can be superset of words in word embeddings. May be set of list.
     Will not consider these when composing doc-vecs.
-    :param additional_params: Currently not in use. In the future, will be used to offer greater degrees
-    of freedom
-    :return: the doc embedding object, which is a dict, with doc-ids referencing the doc vector.
+    :param additional_params: A dictionary of additional parameters. We currently use the following keys, if
+    they exist:
+        output_format: 'json' (default) or 'binary'. The format of output_file; see EmbeddingIO.
+        tokenizer: 'nltk' (default), 'regex' or a tokenizer function; see TextUtils.get_tokenizer
+        tokenizer_workers: if greater than 1 (default 1), lines are tokenized in this many processes while the
+        main process composes the doc vectors (see train_word_embeddings). A tokenizer function must be picklable.
+        tokenization_cache and duplicate_lines: see train_word_embeddings. The cache is keyed by the text after the
+        doc_id, so text repeated across docs (e.g. page templates) is only tokenized once. A line is only a
+        duplicate, however, if both its doc_id and its text are repeated; with 'weight', its word vectors are added
+        once per copy.
+        grouped_input: if True, we assume all the lines of a doc_id are consecutive (e.g. the file is sorted
+        by doc_id). Each doc vector is written to output_file as soon as its doc_id ends, so memory use does
+        not grow with the number of docs.
+        max_docs_in_memory: if set (and grouped_input is not), we keep partial doc vectors for at most this many
+        doc_ids in memory. Beyond that, they are spilled to disk in sorted runs, which are merged at the end
+        (an external sort). Doc vectors are written to output_file in doc_id order.
+        spill_directory: where to write the runs (default: the system's temporary directory)
+        batch_size: if set, doc vectors are composed for this many lines at a time, as a single product of a
+        sparse (doc x vocabulary) count matrix with the embedding matrix. Much faster than adding word vectors
+        one by one, especially with an EmbeddingMatrix word_embedding_object.
+        weighting: 'tfidf' or 'sif'. If set, each word vector is weighted (by its inverse document frequency, or
+        by its smooth inverse frequency) before being added to the doc vector, so that frequent words do not
+        overwhelm the doc vector. The weights are computed from input_file (which must then be a path), in an
+        extra pass. Implies the batch_size path (default 1000).
+        sif_a: the smoothing parameter of the sif weighting (default 1e-3)
+        word_weights: a dict with words referencing weights (words not in it get 1.0). Use this to supply your own
+        weights e.g. computed over a bigger corpus. Overrides weighting.
+    :return: the doc embedding object, which is a dict, with doc-ids referencing the doc vector. If grouped_input
+    or max_docs_in_memory is set, the doc vectors are only written to output_file (which is then required), and
+    we return None.
     """
     if not word_embedding_object:
-        word_embedding_object = train_word_embeddings(word_embedding_file)
+        word_embedding_object = EmbeddingIO.read_embeddings(word_embedding_file)
     if word_blacklist:
         blackset = set(word_blacklist)
     else:
         blackset = set()    # empty set, for compatibility with code below
+    tokenizer = _get_param(additional_params, 'tokenizer', 'nltk')
+    tokenizer_workers = _get_param(additional_params, 'tokenizer_workers', 1)
+    duplicate_lines = _get_param(additional_params, 'duplicate_lines', 'keep')
+    cache = _get_tokenization_cache(additional_params, duplicate_lines)
+    output_format = _get_param(additional_params, 'output_format', 'json')
+    batch_size = _get_param(additional_params, 'batch_size', None)
+    weighting = _get_param(additional_params, 'weighting', None)
+    word_weights = _get_param(additional_params, 'word_weights', None)
+    if batch_size or weighting or word_weights:
+        if isinstance(word_embedding_object, EmbeddingMatrix):
+            embedding_matrix = word_embedding_object
+        else:
+            embedding_matrix = EmbeddingMatrix.from_dict(word_embedding_object,
+                                    dtype=np.asarray(next(iter(word_embedding_object.values()))).dtype)
+        column_of = dict()
+        keys = embedding_matrix.get_keys()
+        for i in range(0, len(keys)):
+            if keys[i] not in blackset:
+                column_of[keys[i]] = i
+        column_weights = None
+        if word_weights:
+            column_weights = np.array([word_weights.get(key, 1.0) for key in keys], dtype=np.float64)
+        elif weighting:
+            if not isinstance(input_file, basestring):
+                raise Exception('weighting requires input_file to be a path (or pass in word_weights instead).')
+            column_weights = _compute_column_weights(
+                                _tokenize_doc_lines(_iterate_lines(input_file), tokenizer, tokenizer_workers, cache,
+                                                    duplicate_lines),
+                                column_of, len(keys), weighting, _get_param(additional_params, 'sif_a', 1e-3),
+                                batch_size or 1000)
+        partial_doc_vectors = _generate_partial_doc_vectors_batched(
+                                _tokenize_doc_lines(_iterate_lines(input_file), tokenizer, tokenizer_workers, cache,
+                                                    duplicate_lines),
+                                embedding_matrix, column_of, batch_size or 1000, column_weights)
+    else:
+        partial_doc_vectors = _generate_partial_doc_vectors(
+                                _tokenize_doc_lines(_iterate_lines(input_file), tokenizer, tokenizer_workers, cache,
+                                                    duplicate_lines),
+                                word_embedding_object, blackset)
+    if Instrumentation.is_enabled():
+        partial_doc_vectors = _track_doc_vectors(partial_doc_vectors)
+    grouped_input = _get_param(additional_params, 'grouped_input', False)
+    max_docs_in_memory = _get_param(additional_params, 'max_docs_in_memory', None)
+    if grouped_input or max_docs_in_memory:
+        if not output_file:
+            raise Exception('Streaming doc embeddings (grouped_input/max_docs_in_memory) requires an output_file.')
+        with Instrumentation.timer('trainer.doc_vectors'):
+            writer = _LazyEmbeddingsWriter(output_file, output_format)
+            if grouped_input:
+                _write_grouped_doc_vectors(partial_doc_vectors, writer)
+            else:
+                _write_spilled_doc_vectors(partial_doc_vectors, writer, max_docs_in_memory,
+                                           _get_param(additional_params, 'spill_directory', None))
+            writer.close()
+        return None
     doc_embeddings_dict = dict()
-    with codecs.open(input_file, 'r', 'utf-8') as f:
-        for line in f:
-            # print line
-            fields = re.split('\t',line.lower())
-            doc_id = fields[0]
-            doc_vec = None
-            list_of_tokens = TextUtils.tokenize_string(' '.join(fields[1:]))
+    with Instrumentation.timer('trainer.doc_vectors'):
+        for doc_id, doc_vec in partial_doc_vectors:
             if doc_id in doc_embeddings_dict:
-                doc_vec = doc_embeddings_dict[doc_id]
-            for token in list_of_tokens:
-                if token not in word_embedding_object:
-                    continue
-                elif token in blackset:
-                    continue
-
-                if not doc_vec:
-                    doc_vec = list(word_embedding_object[token])
-                else:
-                    doc_vec = VectorUtils.add_vectors([doc_vec, word_embedding_object[token]])
-            if doc_vec:
+                doc_embeddings_dict[doc_id] = VectorUtils.add_vectors([doc_embeddings_dict[doc_id], doc_vec])
+            else:
                 doc_embeddings_dict[doc_id] = doc_vec
     if output_file:
-        out = codecs.open(output_file, 'w', 'utf-8')
-        for k, v in doc_embeddings_dict.items():
-            answer = dict()
-            answer[k] = v
-            json.dump(answer, out)
-            out.write('\n')
-        out.close()
+        with Instrumentation.timer('trainer.write'):
+            EmbeddingIO.write_embeddings(doc_embeddings_dict, output_file, output_format)
     return doc_embeddings_dict
 
 
+def _track_doc_vectors(partial_doc_vectors):
+    """
+    For internal use only (instrumentation). Passes the partial doc vectors through, reporting progress.
+    """
+    progress = Instrumentation.progress('trainer.train_doc_embeddings')
+    for doc_id, doc_vec in partial_doc_vectors:
+        progress.update(partial_doc_vectors=1)
+        yield doc_id, doc_vec
+    progress.close()
+
+
+def _generate_partial_doc_vectors(tokenized_lines, word_embedding_object, blackset):
+    """
+    For internal use only. Composes the doc vector of each line (the sum of its word vectors). A doc_id may
+    occur on several lines, so the vectors generated here are partial; they must be summed per doc_id.
+    :param tokenized_lines: an iterable of (doc_id, list of tokens, weight) tuples, one per line (or per distinct
+    line, weighted by its number of copies), see _tokenize_doc_lines
+    :param word_embedding_object:
+    :param blackset: words to ignore
+    :return: a generator of (doc_id, vector) tuples. Lines without any (non-blacklisted) embedded words
+    are skipped.
+    """
+    for doc_id, list_of_tokens, weight in tokenized_lines:
+        doc_vec = None
+        for token in list_of_tokens:
+            if token not in word_embedding_object:
+                continue
+            elif token in blackset:
+                continue
+
+            if not doc_vec:
+                doc_vec = list(word_embedding_object[token])
+            else:
+                doc_vec = VectorUtils.add_vectors([doc_vec, word_embedding_object[token]])
+        if doc_vec:
+            if weight != 1:
+                doc_vec = [weight * element for element in doc_vec]
+            yield doc_id, doc_vec
+
+
+def _generate_partial_doc_vectors_batched(tokenized_lines, embedding_matrix, column_of, batch_size,
+                                          column_weights=None):
+    """
+    For internal use only. Vectorized version of _generate_partial_doc_vectors. For each block of batch_size
+    lines, we build a sparse (doc x vocabulary) matrix of token counts, and compute all the doc vectors of the
+    block as one sparse-dense product with the embedding matrix. Weights are applied to the counts i.e. a
+    diagonal scaling of the vocabulary.
+    :param tokenized_lines: see _generate_partial_doc_vectors
+    :param embedding_matrix: an EmbeddingMatrix of word vectors
+    :param column_of: a dict with each (non-blacklisted) word referencing its row in embedding_matrix
+    :param batch_size: number of lines per block
+    :param column_weights: if not None, a weight for each row of embedding_matrix
+    :return: a generator of (doc_id, vector) tuples, with the vectors as lists (as in
+    _generate_partial_doc_vectors). Lines without any (non-blacklisted) embedded words are skipped.
+    """
+    matrix = embedding_matrix.get_matrix()
+    for block in _iterate_blocks(tokenized_lines, batch_size):
+        doc_ids = list()
+        row_of = dict()   # a doc_id may occur on several lines of a block
+        rows = list()
+        columns = list()
+        weights = list()
+        for doc_id, list_of_tokens, weight in block:
+            if doc_id not in row_of:
+                row_of[doc_id] = len(doc_ids)
+                doc_ids.append(doc_id)
+            row = row_of[doc_id]
+            for token in list_of_tokens:
+                if token in column_of:
+                    rows.append(row)
+                    columns.append(column_of[token])
+                    weights.append(weight)
+        counts = scipy.sparse.coo_matrix((np.array(weights, dtype=matrix.dtype), (rows, columns)),
+                                         shape=(len(doc_ids), matrix.shape[0])).tocsr()   # sums duplicates
+        non_empty = np.diff(counts.indptr) > 0
+        if column_weights is not None:
+            counts.data = counts.data * column_weights[counts.indices]
+        doc_vectors = counts.dot(matrix)
+        for i in range(0, len(doc_ids)):
+            if non_empty[i]:
+                yield doc_ids[i], VectorUtils.to_list(doc_vectors[i])
+
+
+def _compute_column_weights(tokenized_lines, column_of, num_columns, weighting, sif_a=1e-3, batch_size=1000):
+    """
+    For internal use only. Computes a weight per word (i.e. per column of the count matrix) from the doc file.
+    Each line counts as one document.
+    :param tokenized_lines: see _generate_partial_doc_vectors
+    :param column_of: see _generate_partial_doc_vectors_batched
+    :param num_columns:
+    :param weighting: 'tfidf' for the (smoothed) inverse document frequency log((1+N)/(1+df)) + 1, or 'sif' for
+    the smooth inverse frequency a/(a + p(w)) of Arora et al., where p(w) is the word's relative frequency.
+    Either way, frequent words get lower weights, so that they do not overwhelm the doc vectors.
+    :param sif_a: the a in the sif weight
+    :param batch_size:
+    :return: a numpy array of num_columns weights
+    """
+    term_frequency = np.zeros(num_columns, dtype=np.float64)
+    document_frequency = np.zeros(num_columns, dtype=np.float64)
+    num_docs = 0
+    for block in _iterate_blocks(tokenized_lines, batch_size):
+        term_columns = list()
+        term_weights = list()
+        document_columns = list()
+        document_weights = list()
+        for doc_id, list_of_tokens, weight in block:
+            columns = [column_of[token] for token in list_of_tokens if token in column_of]
+            term_columns += columns
+            term_weights += [weight] * len(columns)
+            columns = set(columns)
+            document_columns += columns
+            document_weights += [weight] * len(columns)
+            num_docs += weight
+        term_frequency += np.bincount(term_columns, weights=term_weights, minlength=num_columns)
+        document_frequency += np.bincount(document_columns, weights=document_weights, minlength=num_columns)
+    if weighting == 'tfidf':
+        return np.log((1.0 + num_docs) / (1.0 + document_frequency)) + 1.0
+    elif weighting == 'sif':
+        return sif_a / (sif_a + term_frequency / max(term_frequency.sum(), 1.0))
+    else:
+        raise Exception('Unrecognized weighting: ' + str(weighting))
+
+
+def _iterate_blocks(iterable, block_size):
+    """
+    For internal use only.
+    :return: a generator of lists of (at most) block_size consecutive items of iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        block = list(itertools.islice(iterator, block_size))
+        if not block:
+            break
+        yield block
+
+
+def _write_grouped_doc_vectors(partial_doc_vectors, writer):
+    """
+    For internal use only. Assumes that all the lines of a doc_id are consecutive, so that a doc vector can be
+    written out as soon as the doc_id changes. Only one doc vector is ever in memory.
+    :param partial_doc_vectors: see _generate_partial_doc_vectors
+    :param writer: see _LazyEmbeddingsWriter
+    :return: None
+    """
+    current_doc_id = None
+    current_vec = None
+    for doc_id, doc_vec in partial_doc_vectors:
+        if doc_id == current_doc_id:
+            current_vec = VectorUtils.add_vectors([current_vec, doc_vec])
+            continue
+        if current_doc_id is not None:
+            writer.add(current_doc_id, current_vec)
+        current_doc_id = doc_id
+        current_vec = doc_vec
+    if current_doc_id is not None:
+        writer.add(current_doc_id, current_vec)
+
+
+def _write_spilled_doc_vectors(partial_doc_vectors, writer, max_docs_in_memory, spill_directory=None):
+    """
+    For internal use only. Sums partial doc vectors in memory for up to max_docs_in_memory doc_ids at a time.
+    When that limit is reached, the partial vectors are written to disk as a run sorted by doc_id. At the end,
+    all the runs are merged (an external merge sort), summing the vectors of each doc_id across runs, and the
+    doc vectors are written out in doc_id order.
+    :param partial_doc_vectors: see _generate_partial_doc_vectors
+    :param writer: see _LazyEmbeddingsWriter
+    :param max_docs_in_memory:
+    :param spill_directory: where to write the runs. If None, the system's temporary directory is used.
+    :return: None
+    """
+    buffer = dict()
+    run_files = list()
+    run_directory = tempfile.mkdtemp(dir=spill_directory)
+    try:
+        for doc_id, doc_vec in partial_doc_vectors:
+            if doc_id in buffer:
+                buffer[doc_id] += doc_vec
+            else:
+                buffer[doc_id] = np.array(doc_vec)
+                if len(buffer) >= max_docs_in_memory:
+                    run_files.append(_write_sorted_run(buffer, run_directory, len(run_files)))
+                    buffer = dict()
+        if not run_files:     # everything fit in memory
+            for doc_id in sorted(buffer.keys()):
+                writer.add(doc_id, buffer[doc_id])
+            return
+        if buffer:
+            run_files.append(_write_sorted_run(buffer, run_directory, len(run_files)))
+        del buffer
+        num_runs = len(run_files)
+        while len(run_files) > _MAX_RUNS_PER_MERGE:   # bound the number of simultaneously open files
+            merged_file = os.path.join(run_directory, 'run-' + str(num_runs))
+            num_runs += 1
+            with open(merged_file, 'wb') as out:
+                for doc_id, doc_vec in _merge_sorted_runs(run_files[0:_MAX_RUNS_PER_MERGE]):
+                    _write_run_record(out, doc_id, doc_vec)
+            run_files = run_files[_MAX_RUNS_PER_MERGE:] + [merged_file]
+        for doc_id, doc_vec in _merge_sorted_runs(run_files):
+            writer.add(doc_id, doc_vec)
+    finally:
+        shutil.rmtree(run_directory)
+
+
+def _write_sorted_run(buffer, run_directory, run_number):
+    """
+    For internal use only. Writes the partial doc vectors in buffer to a new run file, sorted by doc_id.
+    :return: the path of the run file
+    """
+    run_file = os.path.join(run_directory, 'run-' + str(run_number))
+    with open(run_file, 'wb') as out:
+        for doc_id in sorted(buffer.keys()):
+            _write_run_record(out, doc_id, buffer[doc_id])
+    return run_file
+
+
+def _write_run_record(out, doc_id, doc_vec):
+    """
+    For internal use only. A run record is the utf-8 doc_id and the dtype of the vector (each preceded by its
+    length), followed by the vector's raw bytes.
+    """
+    key = doc_id.encode('utf-8')
+    doc_vec = np.asarray(doc_vec)
+    dtype = doc_vec.dtype.str
+    out.write(struct.pack('<IBI', len(key), len(dtype), len(doc_vec)))
+    out.write(key)
+    out.write(dtype)
+    out.write(doc_vec.tostring())
+
+
+def _read_run_records(run_file):
+    """
+    For internal use only. Reads back the records written by _write_run_record.
+    :return: a generator of (doc_id, numpy vector) tuples
+    """
+    header_size = struct.calcsize('<IBI')
+    with open(run_file, 'rb') as f:
+        while True:
+            header = f.read(header_size)
+            if not header:
+                break
+            key_length, dtype_length, dimensions = struct.unpack('<IBI', header)
+            doc_id = f.read(key_length).decode('utf-8')
+            dtype = np.dtype(f.read(dtype_length))
+            yield doc_id, np.fromstring(f.read(dimensions * dtype.itemsize), dtype=dtype)
+
+
+def _merge_sorted_runs(run_files):
+    """
+    For internal use only. Merges sorted runs, summing the vectors of a doc_id that occurs in several runs.
+    :return: a generator of (doc_id, vector) tuples, in doc_id order
+    """
+    def _numbered(run_number):     # the run number breaks ties between equal doc_ids, so vectors are never compared
+        for doc_id, doc_vec in _read_run_records(run_files[run_number]):
+            yield doc_id, run_number, doc_vec
+    current_doc_id = None
+    current_vec = None
+    for doc_id, run_number, doc_vec in heapq.merge(*[_numbered(i) for i in range(0, len(run_files))]):
+        if doc_id == current_doc_id:
+            current_vec = current_vec + doc_vec
+            continue
+        if current_doc_id is not None:
+            yield current_doc_id, current_vec
+        current_doc_id = doc_id
+        current_vec = doc_vec
+    if current_doc_id is not None:
+        yield current_doc_id, current_vec
+
+
+class _LazyEmbeddingsWriter:
+    """
+    For internal use only. Opens an EmbeddingIO writer once the first vector (and hence the number of
+    dimensions) is known.
+    """
+
+    def __init__(self, output_file, output_format):
+        self._output_file = output_file
+        self._output_format = output_format
+        self._writer = None
+
+    def add(self, key, vector):
+        if self._writer is None:
+            self._writer = EmbeddingIO.open_embeddings_writer(self._output_file, len(vector), self._output_format)
+        self._writer.add(key, vector)
+
+    def close(self):
+        if self._writer is None:
+            self._writer = EmbeddingIO.open_embeddings_writer(self._output_file, 0, self._output_format)
+        self._writer.close()
+
+
 def train_annotation_models(annotated_jlines_file, text_attribute, annotated_attribute, correct_attribute,
-        word_embedding_object, classification_model_output_file, feature_model_output_file, word_embedding_file=None):
+        word_embedding_object, classification_model_output_file, feature_model_output_file, word_embedding_file=None,
+        additional_params=None):
     """
     This is an involved function. For usage, see annotation_trainer_example in examples
 
-    This version assumes the annotated file isn't too big, so it reads the whole thing into memory.
-    We also have a memory-light version in a different package. You can also modify this function to make
-    it more memory-efficient, but at the cost of 'merging' the various steps below, making the code
-    harder to understand and debug.
+    By default, we assume the annotated file isn't too big, so we read the whole thing into memory. For large
+    files, set streaming (see below): the file is then processed in chunks, and the (normalized) context vectors
+    are written to a memory-mapped float32 feature file instead of being kept in memory. Only the labels (one
+    byte per vector) and the k selected features of the (balanced) training data are held in memory.
 
     We use random forest and k-best feature selection for the actual models.
     :param annotated_jlines_file:
@@ -148,65 +1230,51 @@ def train_annotation_models(annotated_jlines_file, text_attribute, annotated_att
     :param annotated_attribute:
     :param correct_attribute:
     :param word_embedding_object: e.g. as output by train_word_embeddings
-    :param word_embedding_file: in case you wrote out the embedding to file
+    :param word_embedding_file: in case you wrote out the embedding to file (json lines or binary)
+    :param additional_params: A dictionary of additional parameters. We currently use the following keys, if
+    they exist:
+        tokenizer: 'nltk' (default), 'regex' or a tokenizer function; see TextUtils.get_tokenizer
+        tokenizer_workers: if greater than 1 (default 1), the objects are parsed in the main process but
+        tokenized in this many processes, while the main process extracts the features of earlier objects (see
+        train_word_embeddings). A tokenizer function must be picklable.
+        streaming: if True (default False), train out-of-core, as described above. The models are the same,
+        up to the randomness in balancing and in the random forest.
+        chunk_size: with streaming, the number of json objects processed at a time (default 10000)
+        feature_file: with streaming, where to write the feature file. By default, a temporary file that is
+        deleted at the end.
     :return:
     """
     # first, get the embeddings object
     if not word_embedding_object:
-        word_embedding_object = dict()
         if word_embedding_file:
-            with codecs.open(word_embedding_file, 'r', 'utf-8') as f:
-                for line in f:
-                    obj = json.loads(line)
-                    for k, v in obj.items():
-                        word_embedding_object[k] = v
+            word_embedding_object = EmbeddingIO.read_embeddings(word_embedding_file)
         else:
             raise Exception('you have not trained/specified a word embedding...')
 
+    tokenizer = _get_param(additional_params, 'tokenizer', 'nltk')
+    tokenizer_workers = _get_param(additional_params, 'tokenizer_workers', 1)
+    if _get_param(additional_params, 'streaming', False):
+        _train_annotation_models_streaming(annotated_jlines_file, text_attribute, annotated_attribute,
+                correct_attribute, word_embedding_object, classification_model_output_file,
+                feature_model_output_file, tokenizer, _get_param(additional_params, 'chunk_size', 10000),
+                _get_param(additional_params, 'feature_file', None), tokenizer_workers)
+        return
+
     # second, read in the file and preprocess the data
-    json_objects = list()
     with codecs.open(annotated_jlines_file, 'r', 'utf-8') as f:
-        for line in f:
-            obj = json.loads(line)
-            tokenized_field = TextUtils.tokenize_field(obj, text_attribute)
-            if tokenized_field:
-                obj[text_attribute] = TextUtils.preprocess_tokens(tokenized_field, options=["lower"])
-                for k in obj.keys():
-                    obj[k] = TextUtils.preprocess_tokens(obj[k], options=["lower"])
-            json_objects.append(obj)
-
-    # third, generate and collect training vectors
+        json_objects = list(_preprocess_annotated_objects(f, text_attribute, tokenizer, tokenizer_workers))
+
+    # third, generate and collect training vectors (one matrix of context vectors per annotated word)
     pos_features = list()
     neg_features = list()
     for obj in json_objects:
-        for word in obj[annotated_attribute]:
-            word_tokens = TextUtils.tokenize_string(word)
-            if len(word_tokens) <= 1:  # we're dealing with a single word
-                if word not in obj[text_attribute]:
-                    print 'skipping word not found in text field: ',
-                    print word
-                    continue
-                context_vecs = _context_generator(word, obj[text_attribute], word_embedding_object)
-            elif TextUtils.is_sublist_in_big_list(obj[text_attribute], word_tokens):
-                context_vecs = _context_generator(word, obj[text_attribute], word_embedding_object, multi=True)
-            else:
-                continue
-
-            if not context_vecs:
-                print 'context_generator did not return anything for word: ',
-                print word
-                continue
-
-            for context_vec in context_vecs:
-                if word in obj[correct_attribute]:
-                    pos_features.append(context_vec)
-                else:
-                    neg_features.append(context_vec)
+        _collect_annotation_features(obj, text_attribute, annotated_attribute, correct_attribute,
+                                     word_embedding_object, tokenizer, pos_features, neg_features)
     if not pos_features or not neg_features:
         raise Exception('One (or both) of the positive/negative feature sets is empty. Exiting...')
     features = dict()
-    features[0] = VectorUtils.normalize_matrix(np.matrix(neg_features))
-    features[1] = VectorUtils.normalize_matrix(np.matrix(pos_features))
+    features[0] = VectorUtils.normalize_matrix(np.vstack(neg_features))
+    features[1] = VectorUtils.normalize_matrix(np.vstack(pos_features))
     data_dict = _prepare_training_data(features)
 
     # four, train the model and write out the various models to the output
@@ -219,6 +1287,189 @@ def train_annotation_models(annotated_jlines_file, text_attribute, annotated_att
     joblib.dump(model, classification_model_output_file)
 
 
+def _train_annotation_models_streaming(annotated_jlines_file, text_attribute, annotated_attribute, correct_attribute,
+        word_embedding_object, classification_model_output_file, feature_model_output_file, tokenizer,
+        chunk_size=10000, feature_file=None, tokenizer_workers=1):
+    """
+    For internal use only. The out-of-core version of train_annotation_models (see streaming there).
+    """
+    temporary = feature_file is None
+    if temporary:
+        handle, feature_file = tempfile.mkstemp(suffix='.features')
+        os.close(handle)
+    try:
+        # second and third, preprocess the data and write out the training vectors, a chunk at a time
+        labels = bytearray()
+        dimensions = None
+        with open(feature_file, 'wb') as out, codecs.open(annotated_jlines_file, 'r', 'utf-8') as f:
+            json_objects = _preprocess_annotated_objects(f, text_attribute, tokenizer, tokenizer_workers)
+            for chunk in _iterate_blocks(json_objects, chunk_size):
+                pos_features = list()
+                neg_features = list()
+                for obj in chunk:
+                    _collect_annotation_features(obj, text_attribute, annotated_attribute, correct_attribute,
+                                                 word_embedding_object, tokenizer, pos_features, neg_features)
+                for label, blocks in ((1, pos_features), (0, neg_features)):
+                    if not blocks:
+                        continue
+                    block = VectorUtils.normalize_matrix(np.vstack(blocks)).astype(np.float32)
+                    dimensions = block.shape[1]
+                    out.write(block.tostring())
+                    labels.extend(chr(label) * block.shape[0])
+        labels = np.frombuffer(bytes(labels), dtype=np.uint8)
+        if not labels.any() or labels.all():
+            raise Exception('One (or both) of the positive/negative feature sets is empty. Exiting...')
+        features = np.memmap(feature_file, dtype=np.float32, mode='r', shape=(len(labels), dimensions))
+
+        # four, train the model on the balanced data (referenced by index), and write out the models
+        indices = _prepare_training_indices(labels)
+        # the selector is fitted on the scores computed a chunk at a time, and on a couple of rows, since fit only
+        # needs X for its shape; it then refers to f_classif, just like the in-memory selector
+        scores, pvalues = _chunked_f_classif(features, labels, indices, chunk_size)
+        kBest = SelectKBest(_PrecomputedScores(scores, pvalues), k=20)
+        kBest.fit(np.asarray(features[indices[0:2]]), labels[indices[0:2]])
+        kBest.set_params(score_func=f_classif)
+        joblib.dump(kBest, feature_model_output_file)
+        support = kBest.get_support(indices=True)
+        train_data = np.zeros((len(indices), len(support)), dtype=np.float32)
+        for start in range(0, len(indices), chunk_size):
+            rows = indices[start:start + chunk_size]
+            train_data[start:start + len(rows)] = features[rows][:, support]
+        del features
+        model = RandomForestClassifier()
+        model.fit(train_data, labels[indices])
+        joblib.dump(model, classification_model_output_file)
+    finally:
+        if temporary and os.path.exists(feature_file):
+            os.remove(feature_file)
+
+
+def _preprocess_annotated_objects(lines, text_attribute, tokenizer='nltk', num_workers=1):
+    """
+    For internal use only. Parses and preprocesses (see _preprocess_annotated_object) each json line.
+    :param lines: an iterable of json lines
+    :param text_attribute:
+    :param tokenizer:
+    :param num_workers: see _tokenize_lines
+    :return: a generator of preprocessed objects, in order
+    """
+    json_objects = (json.loads(line) for line in lines)
+    if num_workers > 1:
+        return _pipelined_map(_preprocess_annotated_batch, json_objects, (text_attribute, tokenizer), num_workers)
+    return (_preprocess_annotated_object(obj, text_attribute, tokenizer) for obj in json_objects)
+
+
+def _preprocess_annotated_batch(json_objects, text_attribute, tokenizer):
+    """
+    For internal use only. Runs in a worker process (see _preprocess_annotated_objects).
+    """
+    return [_preprocess_annotated_object(obj, text_attribute, tokenizer) for obj in json_objects]
+
+
+def _preprocess_annotated_object(obj, text_attribute, tokenizer='nltk'):
+    """
+    For internal use only. Tokenizes the text field of an annotated json object and lower-cases all of its
+    fields, in place.
+    :return: the object
+    """
+    tokenized_field = TextUtils.tokenize_field(obj, text_attribute, tokenizer)
+    if tokenized_field:
+        obj[text_attribute] = TextUtils.preprocess_tokens(tokenized_field, options=["lower"])
+        for k in obj.keys():
+            obj[k] = TextUtils.preprocess_tokens(obj[k], options=["lower"])
+    return obj
+
+
+def _collect_annotation_features(obj, text_attribute, annotated_attribute, correct_attribute, word_embedding_object,
+                                 tokenizer, pos_features, neg_features):
+    """
+    For internal use only. Appends the (unnormalized) context vectors of the annotated words of a preprocessed
+    object to pos_features (for the correct words) or neg_features, as one matrix per annotated word.
+    :return: None
+    """
+    context_vecs_dict = _batch_context_generator(obj[annotated_attribute], obj.get(text_attribute),
+                                                 word_embedding_object, tokenizer=tokenizer)
+    for word in obj[annotated_attribute]:
+        if word not in context_vecs_dict:
+            print 'context_generator did not return anything for word: ',
+            print word
+            continue
+        if word in obj[correct_attribute]:
+            pos_features.append(context_vecs_dict[word])
+        else:
+            neg_features.append(context_vecs_dict[word])
+
+
+def _prepare_training_indices(labels, balanced_training=True):
+    """
+    For internal use only. The by-index version of _prepare_training_data: rather than copying the (re-sampled)
+    vectors, we return the rows of the positive vectors followed by those of the negative vectors, with the
+    lesser class oversampled (see _sample_and_extend) if balanced_training is True.
+    :param labels: a numpy array with the label (0 or 1) of each vector
+    :param balanced_training:
+    :return: a numpy array of row indices
+    """
+    pos = np.where(labels == 1)[0]
+    neg = np.where(labels == 0)[0]
+    if balanced_training:
+        if len(pos) < len(neg):
+            pos = np.append(pos, pos[_sample_indices(len(pos), total_samples=len(neg))])
+        elif len(pos) > len(neg):
+            neg = np.append(neg, neg[_sample_indices(len(neg), total_samples=len(pos))])
+    return np.append(pos, neg)
+
+
+def _chunked_f_classif(features, labels, indices, chunk_size=10000):
+    """
+    For internal use only. Computes the same ANOVA F-values (and p-values) as sklearn's f_classif on
+    features[indices], labels[indices], but reads the rows a chunk at a time, accumulating the per-class sums and
+    sums of squares.
+    :param features: a 2-d numpy array (or memmap)
+    :param labels: a numpy array with the class of each row of features
+    :param indices: the rows to use (with repetitions)
+    :param chunk_size:
+    :return: a tuple (F-values, p-values)
+    """
+    classes = np.unique(labels[indices])
+    counts = np.zeros(len(classes), dtype=np.float64)
+    sums = np.zeros((len(classes), features.shape[1]), dtype=np.float64)
+    squares = np.zeros(features.shape[1], dtype=np.float64)
+    for start in range(0, len(indices), chunk_size):
+        rows = indices[start:start + chunk_size]
+        chunk = np.asarray(features[rows], dtype=np.float64)
+        chunk_labels = labels[rows]
+        squares += (chunk * chunk).sum(axis=0)
+        for c in range(0, len(classes)):
+            in_class = chunk_labels == classes[c]
+            counts[c] += in_class.sum()
+            sums[c] += chunk[in_class].sum(axis=0)
+    # as in sklearn's f_oneway
+    n_samples = counts.sum()
+    square_of_sums_alldata = sums.sum(axis=0) ** 2
+    sstot = squares - square_of_sums_alldata / n_samples
+    ssbn = ((sums ** 2) / counts[:, np.newaxis]).sum(axis=0) - square_of_sums_alldata / n_samples
+    sswn = sstot - ssbn
+    msb = ssbn / float(len(classes) - 1)
+    msw = sswn / float(n_samples - len(classes))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = msb / msw
+    return f, scipy.special.fdtrc(len(classes) - 1, n_samples - len(classes), f)
+
+
+class _PrecomputedScores:
+    """
+    For internal use only. A score_func for SelectKBest that returns scores computed beforehand (see
+    _chunked_f_classif), whatever data it is given.
+    """
+
+    def __init__(self, scores, pvalues):
+        self._scores = scores
+        self._pvalues = pvalues
+
+    def __call__(self, X, y):
+        return self._scores, self._pvalues
+
+
 def _prepare_training_data(data_vectors, balanced_training=True):
     """
     For internal use only. data_vectors is a simple 2-element dictionary with 0 referencing a matrix of
@@ -267,23 +1518,33 @@ def _sample_and_extend(list_of_vectors, total_samples):
     is higher than the length of list_of_vectors
     :return: the over-sampled list
     """
-    if len(list_of_vectors) >= total_samples:
+    new_data = [list(list_of_vectors[i]) for i in _sample_indices(len(list_of_vectors), total_samples)]
+    # print new_data
+    return np.append(list_of_vectors, new_data, axis=0)
+
+
+def _sample_indices(num_vectors, total_samples):
+    """
+    For internal use only. The re-sampling behind _sample_and_extend.
+    :param num_vectors: the number of vectors that are going to be re-sampled (randomly)
+    :param total_samples: the total number of vectors that we want. Must be higher than num_vectors
+    :return: a list of the total_samples - num_vectors (randomly chosen) indices of the vectors to add
+    """
+    if num_vectors >= total_samples:
         raise Exception('Check your lengths!')
 
-    indices = range(0, len(list_of_vectors))
+    indices = range(0, num_vectors)
     shuffle(indices)
-    desired_samples = total_samples - len(list_of_vectors)
+    desired_samples = total_samples - num_vectors
     # print desired_samples>len(list_of_vectors)
     while desired_samples > len(indices):
         new_indices = list(indices)
         shuffle(new_indices)
         indices += new_indices
-    new_data = [list(list_of_vectors[i]) for i in indices[0:desired_samples]]
-    # print new_data
-    return np.append(list_of_vectors, new_data, axis=0)
+    return indices[0:desired_samples]
 
 
-def _context_generator(word, list_of_words, embeddings_dict, window_size=2, multi=False):
+def _context_generator(word, list_of_words, embeddings_dict, window_size=2, multi=False, tokenizer='nltk'):
     """
         The algorithm will search for occurrences of word in list_of_words (there could be multiple or even 0), then
         symmetrically look backward and forward up to the window_size. If the words in the window (not including
@@ -295,6 +1556,7 @@ def _context_generator(word, list_of_words, embeddings_dict, window_size=2, mult
         :param embeddings_dict: the word embedding object
         :param window_size
         :param multi: If True, then word is multi-token. You must tokenize it first, then generate context embedd.
+        :param tokenizer: used to tokenize word, if multi is True. See TextUtils.get_tokenizer
         :return: a list of lists, with each inner list representing the context vectors. If there are no occurrences
         of word, will return None. Check for this in your code.
     """
@@ -302,7 +1564,7 @@ def _context_generator(word, list_of_words, embeddings_dict, window_size=2, mult
         return None
     context_vecs = list()
     if multi:
-        word_tokens = TextUtils.tokenize_string(word)
+        word_tokens = TextUtils.get_tokenizer(tokenizer)(word)
     for i in range(0, len(list_of_words)):
         if multi:
             if list_of_words[i] == word_tokens[0] and list_of_words[i:i + len(word_tokens)] == word_tokens:
@@ -325,7 +1587,7 @@ def _context_generator(word, list_of_words, embeddings_dict, window_size=2, mult
         new_context_vec = []
         for j in range(min_index, max_index + 1):
             if multi:  # we do not want the vector of the word/work_tokens itself
-                if i+len(word_tokens) < j >= i:
+                if i <= j < i + len(word_tokens):
                     continue
             elif j == i:
                 continue
@@ -348,6 +1610,86 @@ def _context_generator(word, list_of_words, embeddings_dict, window_size=2, mult
         return context_vecs
 
 
+def _batch_context_generator(words, list_of_words, embeddings_dict, window_size=2, tokenizer='nltk'):
+    """
+    Batched version of _context_generator, for all the (single- or multi-token) words annotated in a document.
+    Rather than scanning list_of_words once per word, we find the occurrences of every word in one pass (looking
+    up each n-gram of the document, for the n-gram lengths of the words, in a hash table), gather the embeddings
+    of the document's tokens into a matrix once, and compute every window sum as the difference of two rows of
+    its prefix sums. The context vectors are the same as _context_generator's.
+    :param words: the words, e.g. the annotated words of a document
+    :param list_of_words: a list of words (the document)
+    :param embeddings_dict: the word embedding object
+    :param window_size:
+    :param tokenizer: used to tokenize the words. See TextUtils.get_tokenizer
+    :return: a dict with each word that has at least one context vector referencing a 2-d numpy array, with one
+    context vector (row) per occurrence of the word, in order of occurrence. Words without any context vectors
+    (e.g. that do not occur) are absent.
+    """
+    if not list_of_words or not words:
+        return dict()
+    tokenize = TextUtils.get_tokenizer(tokenizer)
+    n_grams = dict()    # tuple of tokens -> the words that tokenize to it
+    for word in set(words):
+        word_tokens = tokenize(word)
+        n_gram = tuple(word_tokens) if len(word_tokens) > 1 else (word,)
+        n_grams.setdefault(n_gram, list()).append(word)
+    lengths = sorted(set(len(n_gram) for n_gram in n_grams))
+    n = len(list_of_words)
+    starts = list()
+    ends = list()
+    matches = list()
+    for i in range(0, n):
+        for length in lengths:
+            if i + length > n:
+                break
+            n_gram = tuple(list_of_words[i:i + length])
+            if n_gram in n_grams:
+                starts.append(i)
+                ends.append(i + length)
+                matches.append(n_gram)
+    if not matches:
+        return dict()
+
+    # row 0 of vectors is reserved for tokens without an embedding
+    rows = np.zeros(n, dtype=np.int64)
+    token_rows = dict()
+    vectors = [None]
+    for i in range(0, n):
+        token = list_of_words[i]
+        if token not in token_rows:
+            if token in embeddings_dict:
+                token_rows[token] = len(vectors)
+                vectors.append(np.asarray(embeddings_dict[token], dtype=np.float64))
+            else:
+                token_rows[token] = 0
+        rows[i] = token_rows[token]
+    if len(vectors) == 1:
+        return dict()
+    vectors[0] = np.zeros(len(vectors[1]), dtype=np.float64)
+    prefix_sums = np.zeros((n + 1, len(vectors[1])), dtype=np.float64)
+    np.cumsum(np.array(vectors)[rows], axis=0, out=prefix_sums[1:])
+    prefix_counts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(rows > 0, out=prefix_counts[1:])
+
+    # the window is [start - window_size, end - 1 + window_size], minus the occurrence itself
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    lows = np.maximum(starts - window_size, 0)
+    highs = np.minimum(ends + window_size, n)
+    context_vecs = prefix_sums[highs] - prefix_sums[lows] - (prefix_sums[ends] - prefix_sums[starts])
+    counts = prefix_counts[highs] - prefix_counts[lows] - (prefix_counts[ends] - prefix_counts[starts])
+    occurrences = dict()
+    for i in range(0, len(matches)):
+        if counts[i] > 0:   # at least one neighbour has an embedding
+            occurrences.setdefault(matches[i], list()).append(i)
+    answer = dict()
+    for n_gram, indices in occurrences.items():
+        for word in n_grams[n_gram]:
+            answer[word] = context_vecs[indices]
+    return answer
+
+
 def _generate_random_sparse_vector(d, non_zero_ratio):
     """
     Suppose d =200 and the ratio is 0.01. Then there will be 2 +1s and 2 -1s and all the rest are 0s.
@@ -355,18 +1697,79 @@ def _generate_random_sparse_vector(d, non_zero_ratio):
     :param non_zero_ratio:
     :return: a randomly generated vector with d dimensions
     """
-    answer = [0]*d
+    return _densify_sparse_vector(_generate_random_sparse_indices(d, non_zero_ratio), d)
+
+
+def _generate_random_sparse_indices(d, non_zero_ratio):
+    """
+    Sparse version of _generate_random_sparse_vector. Rather than the full d-dimensional vector, we only return
+    the positions of the +1s and the -1s.
+    :param d: the number of dimensions
+    :param non_zero_ratio:
+    :return: a tuple (list of +1 indices, list of -1 indices)
+    """
     indices = [i for i in range(d)]
     shuffle(indices)
     k = int(non_zero_ratio*d)
-    for i in range(0, k):
-        answer[indices[i]] = 1
-    for i in range(k, 2*k):
-        answer[indices[i]] = -1
+    return indices[0:k], indices[k:2*k]
+
+
+def _generate_hashed_sparse_vector(word, d, non_zero_ratio, seed=0):
+    """
+    Same as _generate_random_sparse_vector, except that the positions of the +1s and -1s are derived
+    deterministically from a hash of the seed and the word. Hence, the same (word, seed) pair always gets the
+    same vector, in any process and on any run.
+    :param word:
+    :param d: the number of dimensions
+    :param non_zero_ratio:
+    :param seed: any value with a string representation e.g. an int
+    :return: a vector with d dimensions
+    """
+    return _densify_sparse_vector(_generate_hashed_sparse_indices(word, d, non_zero_ratio, seed), d)
+
+
+def _generate_hashed_sparse_indices(word, d, non_zero_ratio, seed=0):
+    """
+    Sparse version of _generate_hashed_sparse_vector.
+    :param word:
+    :param d: the number of dimensions
+    :param non_zero_ratio:
+    :param seed:
+    :return: a tuple (list of +1 indices, list of -1 indices)
+    """
+    digest = hashlib.md5((u'%s\t%s' % (seed, word)).encode('utf-8')).hexdigest()
+    rng = Random(int(digest, 16))
+    k = int(non_zero_ratio*d)
+    indices = rng.sample(xrange(d), 2*k)
+    return indices[0:k], indices[k:2*k]
+
+
+def _densify_sparse_vector(sparse_vector, d):
+    """
+    :param sparse_vector: a tuple (list of +1 indices, list of -1 indices)
+    :param d: the number of dimensions
+    :return: the equivalent d-dimensional list
+    """
+    answer = [0]*d
+    _add_sparse_vector(answer, sparse_vector)
     return answer
 
 
-def _generate_context_vectors(set_of_words, d, non_zero_ratio):
+def _add_sparse_vector(vector, sparse_vector, weight=1):
+    """
+    Adds sparse_vector (times weight) to vector in place. Only the non-zero positions of sparse_vector are touched.
+    :param vector: a list or a numpy array (e.g. a row of an EmbeddingMatrix)
+    :param sparse_vector: a tuple (list of +1 indices, list of -1 indices)
+    :param weight: an integer
+    :return: None
+    """
+    for i in sparse_vector[0]:
+        vector[i] += weight
+    for i in sparse_vector[1]:
+        vector[i] -= weight
+
+
+def _generate_context_vectors(set_of_words, d, non_zero_ratio, seed=0):
     """
     Generate context vectors. For info on the dummies, see notes.txt
     :param idf_dict:
@@ -374,16 +1777,36 @@ def _generate_context_vectors(set_of_words, d, non_zero_ratio):
     vectors for those as well.
     :param d:
     :param non_zero_ratio:
-    :return: A dictionary with the word as key, and a context vector as value.
+    :param seed: see _generate_hashed_sparse_vector
+    :return: A dictionary with the word as key, and a sparse context vector (a tuple of the +1 and -1 indices)
+    as value.
     """
     context_dict = dict()
     for k in set_of_words:
-        context_dict[k] = _generate_random_sparse_vector(d, non_zero_ratio)
+        context_dict[k] = _generate_hashed_sparse_indices(k, d, non_zero_ratio, seed)
     return context_dict
 
 
-def _init_word_embeddings_obj(context_vec_dict):
-    embeddings = dict()
+def _init_word_embeddings_obj(context_vec_dict, d, embedding_store='dict'):
+    if embedding_store == 'matrix':
+        embeddings = EmbeddingMatrix(d, dtype=np.int32, initial_capacity=len(context_vec_dict))
+    else:
+        embeddings = dict()
     for k, v in context_vec_dict.items():
-        embeddings[k] = list(v)  # deep copy of list
-    return embeddings
\ No newline at end of file
+        embeddings[k] = _densify_sparse_vector(v, d)
+    return embeddings
+
+
+def _new_embeddings_obj(dimensions, embedding_store='dict'):
+    """
+    For internal use only. Returns an empty embeddings object of the requested type.
+    :param dimensions:
+    :param embedding_store: 'dict' or 'matrix'
+    :return: a dict or an (int32) EmbeddingMatrix
+    """
+    if embedding_store == 'matrix':
+        return EmbeddingMatrix(dimensions, dtype=np.int32)
+    elif embedding_store == 'dict':
+        return dict()
+    else:
+        raise Exception('Unrecognized embedding_store: ' + str(embedding_store))
\ No newline at end of file